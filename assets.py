@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import gzip
+import hashlib
+import mimetypes
+import tempfile
+
+from threading import Thread, RLock
+
+from flask import request, Response, abort
+from werkzeug.wsgi import wrap_file
+
+from config import atomic_write
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DEFAULT_CACHE = os.path.expanduser('~/.cache/puppet-master/assets')
+
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.xml', '.txt', '.ico', '.map')
+MIN_COMPRESS_SIZE = 512
+INDEX_FILE = 'index.json'
+RELOAD_INTERVAL = 2.0
+
+IMMUTABLE_AGE = 365 * 24 * 3600
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_variant(path, data):
+    dirname = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp.', dir=dirname)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def compress(path, digest, cache_dir):
+    """ Returns {encoding: (path, size)} of the precompressed variants of path.
+
+    Variants are stored in cache_dir by content hash, so they are only
+    computed once per content, and only kept if smaller than the original.
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    encoders = [('gzip', '.gz', lambda d: gzip.compress(d, 9))]
+    if brotli is not None:
+        encoders.append(('br', '.br', lambda d: brotli.compress(d, quality=11)))
+
+    variants = {}
+    for encoding, ext, encode in encoders:
+        variant = os.path.join(cache_dir, digest + ext)
+        if not os.path.exists(variant):
+            _write_variant(variant, encode(data))
+        size = os.path.getsize(variant)
+        if size < len(data):
+            variants[encoding] = (variant, size)
+    return variants
+
+
+class AssetIndex(object):
+    """ Precomputed index of a static folder, served with fingerprinted URLs.
+
+    For each file the index holds its size, mtime, ETag and precompressed
+    variants (gzip, and brotli if the brotli module is installed), so a
+    request is answered without any os.stat. The file is sent through
+    the server's wsgi.file_wrapper (sendfile with gunicorn), with Range
+    and If-None-Match/If-Modified-Since support.
+
+    With fingerprint, the ETag is the content hash and url_for('static',
+    ...) adds it to the URL (v=<hash>): such URLs never change content, so
+    they are served as immutable for a year. Otherwise (and without, or
+    with an outdated, hash) the file is revalidated on each use. For large
+    trees, fingerprint=False uses mtime and size instead of hashing every
+    file, and max_age lets browsers reuse unversioned files that long
+    before revalidating them.
+
+    Scanning a large tree and compressing its files takes minutes on a
+    Raspberry Pi, so a single process does it: build() (python assets.py
+    at install time), or scan() in the background of the process which
+    supervises the server, again every refresh_interval seconds if set.
+    It saves the index along the variants, in a subfolder of cache_dir of
+    its own, and the processes serving the files only load it, again
+    whenever it changes. Until there is one, the files are served as they
+    are, without variants or fingerprints. The variants of no scanned file
+    anymore (changed or removed) are deleted by the next scan.
+
+    """
+    def __init__(self, root, cache_dir=DEFAULT_CACHE, fingerprint=True,
+                 max_age=None, refresh_interval=None):
+        self.root = os.path.abspath(root)
+        self.cache_dir = os.path.join(cache_dir, hashlib.sha1(self.root.encode()).hexdigest()[:12])
+        self.fingerprint = fingerprint
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.index_file = os.path.join(self.cache_dir, INDEX_FILE)
+
+        self._lock = RLock()
+        self._files = {}
+        self._built = None
+        self._loaded = None  # mtime of the saved index in use
+        self._checked = 0
+
+    def _entry(self, path, name, st, previous):
+        if previous is not None and (previous['size'], previous['mtime']) == (st.st_size, st.st_mtime):
+            return previous
+
+        if self.fingerprint:
+            digest = file_hash(path)
+            etag = digest
+        else:
+            digest = hashlib.sha1('{}:{}:{}'.format(path, st.st_size, st.st_mtime).encode()).hexdigest()
+            etag = '{:x}-{:x}'.format(int(st.st_mtime), st.st_size)
+
+        variants = {}
+        if name.endswith(COMPRESSIBLE) and st.st_size >= MIN_COMPRESS_SIZE:
+            variants = compress(path, digest, self.cache_dir)
+
+        return {
+            'path': path,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'etag': etag,
+            'version': digest[:12] if self.fingerprint else None,
+            'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'variants': variants,
+        }
+
+    def _unscanned(self, filename):
+        # before the first scan: the file as it is, without variants nor fingerprint
+        path = os.path.abspath(os.path.join(self.root, filename))
+        if not path.startswith(self.root + os.sep):
+            return None
+        try:
+            st = os.stat(path)
+        except (IOError, OSError):
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        return {
+            'path': path,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'etag': '{:x}-{:x}'.format(int(st.st_mtime), st.st_size),
+            'version': None,
+            'mimetype': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'variants': {},
+        }
+
+    def build(self):
+        """ Scans root, hashes (if fingerprinting) and precompresses the new or changed files, saves the index. """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        started = time.time()
+        # after a restart, the saved index spares hashing the unchanged files again
+        previous = self._files or self._read_index() or {}
+        files = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                filename = os.path.relpath(path, self.root).replace(os.sep, '/')
+                try:
+                    st = os.stat(path)
+                    files[filename] = self._entry(path, name, st, previous.get(filename))
+                except (IOError, OSError):
+                    continue
+
+        atomic_write(self.index_file, json.dumps(files))
+        with self._lock:
+            self._files = files
+            self._built = time.time()
+            self._loaded = os.path.getmtime(self.index_file)
+
+        self._prune(files, started)
+        return self
+
+    def _read_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _prune(self, files, started):
+        # variants of contents no file has anymore, but those written since the scan
+        # started: another process may have scanned a newer version of the file
+        used = set(os.path.basename(path) for entry in files.values()
+                   for path, _ in entry['variants'].values())
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if name not in used and name != INDEX_FILE and os.path.getmtime(path) < started:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def scan(self):
+        """ Builds the index in a background thread, then again every refresh_interval (if set). """
+        def loop():
+            while True:
+                try:
+                    self.build()
+                except (IOError, OSError):
+                    pass
+                if self.refresh_interval is None:
+                    return
+                time.sleep(self.refresh_interval)
+
+        t = Thread(target=loop)
+        t.daemon = True
+        t.start()
+
+    def _reload(self):
+        # the index saved by the scanning process, if it changed (looked at every RELOAD_INTERVAL)
+        now = time.time()
+        with self._lock:
+            if now - self._checked < RELOAD_INTERVAL:
+                return
+            self._checked = now
+
+        try:
+            mtime = os.path.getmtime(self.index_file)
+        except OSError:
+            return
+        if mtime == self._loaded:
+            return
+
+        files = self._read_index()
+        if files is not None:
+            with self._lock:
+                self._files = files
+                self._built = mtime
+                self._loaded = mtime
+
+    def __contains__(self, filename):
+        return filename in self._files
+
+    def items(self):
+        return sorted(self._files.items())
+
+    def version(self, filename):
+        self._reload()
+        entry = self._files.get(filename)
+        return entry['version'] if entry is not None else None
+
+    def _representation(self, entry):
+        """ (path, size, content-encoding or None) best accepted by the client. """
+        # ranges are only served on the file itself
+        if 'Range' not in request.headers:
+            for encoding in ('br', 'gzip'):
+                if encoding in entry['variants'] and request.accept_encodings[encoding]:
+                    path, size = entry['variants'][encoding]
+                    return path, size, encoding
+        return entry['path'], entry['size'], None
+
+    def send(self, filename):
+        self._reload()
+
+        if self._built is None:
+            find = self._unscanned
+        else:
+            find = self._files.get
+        entry = find(filename)
+        if entry is None and (filename == '' or filename.endswith('/')):
+            entry = find(filename + 'index.html')
+        if entry is None:
+            abort(404)
+
+        path, size, encoding = self._representation(entry)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            if encoding is None:
+                # removed since the last scan
+                abort(404)
+            # variant pruned by another process: the file itself
+            path, size, encoding = entry['path'], entry['size'], None
+            try:
+                f = open(path, 'rb')
+            except (IOError, OSError):
+                abort(404)
+
+        response = Response(wrap_file(request.environ, f),
+                            mimetype=entry['mimetype'], direct_passthrough=True)
+        response.content_length = size
+        response.last_modified = entry['mtime']
+        response.set_etag(entry['etag'] + ('-' + encoding if encoding else ''))
+        if entry['variants']:
+            response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.content_encoding = encoding
+
+        if entry['version'] is not None and request.args.get('v') == entry['version']:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_AGE
+            response.cache_control.immutable = True
+        elif self.max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+        else:
+            response.cache_control.no_cache = True
+
+        return response.make_conditional(request.environ, accept_ranges=True,
+                                         complete_length=size)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Precompress the static assets')
+    parser.add_argument('root', type=str, nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'),
+                        help='static folder (or the snap and poppy-monitor folders)')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE,
+                        help='where to store the precompressed variants')
+    parser.add_argument('--no-fingerprint', action='store_true',
+                        help='do not hash the files (as for the snap and poppy-monitor folders)')
+    args = parser.parse_args()
+
+    index = AssetIndex(args.root, args.cache_dir, fingerprint=not args.no_fingerprint).build()
+    for filename, entry in index.items():
+        print('{} {} {}'.format(entry['etag'][:12], filename, ' '.join(sorted(entry['variants']))))
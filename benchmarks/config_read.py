@@ -0,0 +1,61 @@
+""" Read-throughput of the config: yaml re-parse on every access vs ConfigStore.
+
+    python benchmarks/config_read.py [--reads 2000]
+
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from string import Template
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from config import Config, ConfigStore
+
+
+def make_configfile(path):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    with open(os.path.join(root, 'default_config.yaml')) as f:
+        s = Template(f.read())
+
+    with open(path, 'w') as f:
+        f.write(s.substitute(name='bench', creature='poppy-ergo-jr',
+                             home=tempfile.gettempdir(),
+                             board='Raspberry Pi', branch='master'))
+
+
+def page_render(get_config):
+    # Same accesses as bouteillederouge.inject_robot_config before the store.
+    for section in ('robot', 'info', 'wifi', 'hotspot', 'poppyPort',
+                    'poppyLog', 'services', 'version'):
+        getattr(get_config(), section)
+    get_config().robot.name
+
+
+def run(get_config, reads):
+    start = time.time()
+    for _ in range(reads):
+        page_render(get_config)
+    return reads / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--reads', type=int, default=2000,
+                        help='number of simulated page renders')
+    args = parser.parse_args()
+
+    configfile = os.path.join(tempfile.mkdtemp(), 'poppy_config.yaml')
+    make_configfile(configfile)
+
+    store = ConfigStore.for_file(configfile)
+
+    baseline = run(lambda: Config.from_file(configfile), args.reads)
+    cached = run(lambda: store.config, args.reads)
+
+    print('Config.from_file: {:10.1f} renders/s'.format(baseline))
+    print('ConfigStore:      {:10.1f} renders/s'.format(cached))
+    print('speedup:          {:10.1f}x'.format(cached / baseline))
@@ -0,0 +1,241 @@
+""" Microbenchmarks of the control-plane hot paths, compared against a baseline.
+
+    python benchmarks/control_plane.py [--output results.json]
+                                       [--baseline benchmarks/baseline.json] [--threshold 0.2]
+                                       [--save-baseline] [--log-sizes 1,10,100] [--min-time 1]
+
+The web interface is loaded in test mode (dummy_pm.PuppetMaster) and
+driven through Flask's test client. Each benchmark is run for at least
+min-time seconds; its median, 95th percentile and mean durations are
+written as JSON. With a baseline (written by --save-baseline on the same
+machine), a benchmark whose median got more than threshold slower is a
+regression: they are listed and the exit code is 1. Timings only compare
+on one machine, so no baseline is shipped: without one, the exit code
+is 2.
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import platform
+import tempfile
+import subprocess
+
+from contextlib import contextmanager
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from config import Config, attrsetter
+from config_read import make_configfile
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+MB = 1024 * 1024
+
+
+@contextmanager
+def quiet():
+    # the test mode prints the commands it would run
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def measure(func, min_time=1.0, min_runs=5, number=1):
+    """ Times func (called number times per run) for min_time seconds and min_runs runs. """
+    times = []
+    deadline = time.time() + min_time
+    while len(times) < min_runs or time.time() < deadline:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        'median': times[len(times) // 2],
+        'p95': times[min(int(len(times) * 0.95), len(times) - 1)],
+        'mean': mean,
+        'ops_per_sec': 1.0 / mean if mean else None,
+        'runs': len(times) * number,
+    }
+
+
+def load_app(creature):
+    """ Imports the web interface in test mode, returns the module. """
+    os.chdir(ROOT)
+    argv = sys.argv
+    sys.argv = ['bouteillederouge.py', '--test', '--creature', creature]
+    try:
+        with quiet():
+            import bouteillederouge
+    finally:
+        sys.argv = argv
+    return bouteillederouge
+
+
+def write_log(path, size):
+    line = b'2016-07-18 12:00:00 INFO pypot.server.snap: GET /motors/alias 200 OK\n'
+    chunk = line * (MB // len(line) + 1)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            data = chunk[:size - written]
+            f.write(data)
+            written += len(data)
+
+
+def full_settings_form(config, i):
+    """ Every field of the settings page, changed on each call. """
+    on = 'on' if i % 2 else 'off'
+    return {
+        'robot_name': config.robot.name,
+        'robot_firstPage': on,
+        'robot_autoStart': 'off',
+        'robot_camera': on,
+        'robot_virtualBot': '0',
+        'wifi_start': on,
+        'wifi_ssid': 'My-Router-{}'.format(i % 2),
+        'wifi_psk': 'my-psk-{}'.format(i % 2),
+        'hotspot_start': on,
+        'hotspot_ssid': 'Poppy-Hotspot-{}'.format(i % 2),
+        'hotspot_psk': 'poppyproject{}'.format(i % 2),
+    }
+
+
+def checked(response):
+    if response.status_code >= 400:
+        raise SystemError('{} {}'.format(response.status_code, response.data[:200]))
+    return response
+
+
+def run_benchmarks(creature, log_sizes, min_time):
+    results = {}
+
+    def bench(name, func, **kwargs):
+        with quiet():
+            results[name] = measure(func, min_time=min_time, **kwargs)
+        print('{:32} {:12.6f} ms'.format(name, results[name]['median'] * 1000))
+
+    tmp = tempfile.mkdtemp()
+    configfile = os.path.join(tmp, 'poppy_config.yaml')
+    make_configfile(configfile)
+
+    bench('config.from_file', lambda: Config.from_file(configfile))
+
+    config = Config.from_file(configfile)
+    setter = attrsetter('robot.name')
+    bench('config.attrsetter', lambda: setter(config, 'bench'), number=1000)
+
+    b = load_app(creature)
+    pm, client = b.pm, b.app.test_client()
+
+    values = iter(range(10 ** 9))
+    bench('pm.update_config', lambda: pm.update_config('robot.camera', next(values) % 2 == 0))
+
+    for route in ('/', '/settings', '/infos'):
+        bench('render {}'.format(route), lambda: checked(client.get(route)))
+
+    for size in log_sizes:
+        path = os.path.join(tmp, 'bench_{}mb.log'.format(size))
+        write_log(path, size * MB)
+        pm.update_config('poppyLog.viewer', path)
+        bench('raw_logs {}MB'.format(size),
+              lambda: checked(client.post('/api/raw_logs', data={'id': -1})), min_runs=3)
+        os.remove(path)
+
+    forms = iter(range(10 ** 9))
+    bench('settings_update full form',
+          lambda: checked(client.post('/settings/settings_update',
+                                      data=full_settings_form(pm.config, next(forms)))))
+
+    shutil.rmtree(tmp)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """ Prints the changes against baseline, returns the names of the regressions. """
+    regressions = []
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        change = result['median'] / base['median'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{:32} {:12.6f} ms  (baseline {:12.6f} ms, {:+7.1%}){}'.format(
+            name, result['median'] * 1000, base['median'] * 1000, change,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--creature', type=str, default='poppy-ergo-jr')
+    parser.add_argument('--output', type=str,
+                        help='where to write the results (JSON)')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE,
+                        help='results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown of a median counted as a regression')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--log-sizes', type=str, default='1,10,100',
+                        help='sizes of the logs read by raw_logs, in MB')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='seconds each benchmark runs for, at least')
+    args = parser.parse_args()
+
+    log_sizes = [int(size) for size in args.log_sizes.split(',') if size]
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+        },
+        'results': run_benchmarks(args.creature, log_sizes, args.min_time),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        sys.stderr.write('\nNo baseline at {}: nothing compared. Save one on this machine with '
+                         '--save-baseline (e.g. on the commit to compare against).\n'.format(args.baseline))
+        sys.exit(2)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print('\nAgainst the baseline of {} (commit {}):'.format(
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(baseline['meta']['time'])),
+        baseline['meta']['commit']))
+    regressions = compare(report['results'], baseline, args.threshold)
+    if regressions:
+        print('\n{} regression(s): {}'.format(len(regressions), ', '.join(regressions)))
+        sys.exit(1)
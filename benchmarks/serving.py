@@ -0,0 +1,119 @@
+""" Throughput of the web interface: Flask development server vs production server.
+
+    python benchmarks/serving.py [--clients 16] [--duration 10] [--workers 2] [--threads 8]
+
+Each server is started in test mode (python bouteillederouge.py --test),
+then hammered by concurrent keep-alive clients on a mix of pages and
+API routes.
+
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import requests
+import subprocess
+
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ports import wait_port
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ROUTES = ['/', '/infos', '/api/status', '/settings/updating', '/api/clones']
+
+
+def start_server(creature, port, extra_args):
+    # the development server logs every request: to a file, not a pipe nobody reads
+    log = tempfile.TemporaryFile()
+    p = subprocess.Popen([sys.executable, 'bouteillederouge.py',
+                          '--test', '--creature', creature] + extra_args,
+                         cwd=ROOT, stdout=log, stderr=log,
+                         preexec_fn=os.setsid)
+    if not wait_port(port, 60, alive=lambda: p.poll() is None):
+        stop_server(p)
+        log.seek(0)
+        raise SystemError('Server did not start:\n{}'.format(log.read().decode()))
+    return p
+
+
+def stop_server(p):
+    os.killpg(p.pid, signal.SIGTERM)
+    p.wait()
+
+
+def client(url, deadline, latencies, errors):
+    session = requests.Session()
+    i = 0
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            r = session.get(url + ROUTES[i % len(ROUTES)], timeout=10)
+            if r.status_code >= 400:
+                errors.append(r.status_code)
+        except requests.RequestException as e:
+            errors.append(repr(e))
+        latencies.append(time.time() - start)
+        i += 1
+
+
+def load(port, clients, duration):
+    url = 'http://localhost:{}'.format(port)
+    latencies, errors = [], []
+
+    # warm up (first renders, probes)
+    for route in ROUTES:
+        requests.get(url + route)
+
+    start = time.time()
+    threads = [Thread(target=client, args=(url, start + duration, latencies, errors))
+               for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--creature', type=str, default='poppy-ergo-jr')
+    parser.add_argument('--port', type=int, default=2280,
+                        help='puppetMaster port of the test config')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of load per server')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    servers = [
+        ('app.run', []),
+        ('gunicorn {}x{}'.format(args.workers, args.threads),
+         ['--production', '--workers', str(args.workers), '--threads', str(args.threads)]),
+    ]
+
+    for name, extra_args in servers:
+        p = start_server(args.creature, args.port, extra_args)
+        try:
+            r = load(args.port, args.clients, args.duration)
+        finally:
+            stop_server(p)
+
+        print('{:16} {:8.1f} req/s  p50 {:7.1f} ms  p99 {:7.1f} ms  '
+              '({} requests, {} errors)'.format(name, r['rps'], r['p50'], r['p99'],
+                                                 r['requests'], r['errors']))
@@ -1,27 +1,41 @@
 import os
+import re
 import sys
+import glob
 import json
+import time
 import requests
 import argparse
 import subprocess
 
-from threading import Thread
+from platform import platform
 
 from flask import (Flask, request, Markup,
                    redirect, url_for,
                    render_template, flash,
-                   send_from_directory, Response,
-                   copy_current_request_context)
-
-from pypot.creatures import installed_poppy_creatures
-from pypot.server.snap import find_local_ip
+                   Response,
+                   jsonify, abort, g)
 
 from poppyd import PoppyDaemon
+from logtail import read_tail
+from logstream import stream_log, multiplex_logs, parse_cursors
+from logindex import LogIndex, LEVELS as LOG_LEVELS
+from camera import mjpeg_stream
+from probes import Probe, ProbeCache, run_command, find_local_ip
+from creatures import CreatureManifest
+from assets import AssetIndex
+from server import serve, server_options, stream_limit, StreamLimiter
+from metrics import REGISTRY
+from wsrelay import WsRelay, sse_stream
+from robot_state import FIELDS as ROBOT_FIELDS, offline_snapshot
+from moves import MoveLibrary, ENCODINGS as MOVE_ENCODINGS
+from profiling import RequestProfiler, profiling_options, bounded_options, FORMATS as PROFILE_FORMATS
 
 if sys.version_info < (3, 3):
     from urlparse import urlparse
+    from urllib import quote
 else:
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, quote
 
 
 parser = argparse.ArgumentParser(description='Serve the webinterface '
@@ -31,8 +45,14 @@ parser.add_argument('--debug', action='store_true',
 parser.add_argument('--test', action='store_true',
                     help='does not modify anything on your machine '
                          '(except from a config file in /tmp)')
-parser.add_argument('--creature', choices=installed_poppy_creatures.keys(),
+parser.add_argument('--creature', choices=CreatureManifest.for_path().names or None,
                     help='Which creature to use (by default will use the one set in the yaml config).')
+parser.add_argument('--production', action='store_true',
+                    help='serve with gunicorn instead of the Flask development server')
+parser.add_argument('--workers', type=int,
+                    help='number of worker processes of the production server')
+parser.add_argument('--threads', type=int,
+                    help='number of threads per worker of the production server')
 args = parser.parse_args()
 
 
@@ -42,7 +62,8 @@ else:
     from puppet_master import PuppetMaster
 
 
-app = Flask(__name__)
+# static files are served from the AssetIndex (see static below)
+app = Flask(__name__, static_folder=None)
 app.secret_key = os.urandom(24)
 
 if args.debug:
@@ -67,38 +88,170 @@ pm = PuppetMaster(DaemonCls=PoppyDaemon,
                   configfile=configfile,
                   pidfile=pidfile)
 
-if os.path.exists(pidfile):
-    pm.force_clean()
+# nothing from a previous run is supervised anymore
+pm.state.clear()
 
-pm.update_config('version.creature', getattr(__import__(pm.config.robot.creature.replace('-','_')), '__version__'))
+def startup():
+    """ Takes the robot API and the virtual bots over, scans the static folders, publishes metrics.
 
-if pm.config.robot.autoStart:
-    pm.start()
-else:
-    with open(pm.config.info.logfile, 'w') as log:
-        log.write('Robot API autostart is disabled! \nGo to the configuration page to enable autostart, or start it manually.')
-        log.close()
+    It is run by the process which supervises them: with the production
+    server, once the workers are forked (no thread must run before).
+
+    """
+    REGISTRY.start()
+    # the workers load the indexes of the static folders it saves
+    for index in (assets, snap_files, monitor_files):
+        index.scan()
+
+    if os.path.exists(pidfile):
+        pm.force_clean()
+
+    if pm.config.robot.autoStart:
+        pm.start()
+    else:
+        with open(pm.config.info.logfile, 'w') as log:
+            log.write('Robot API autostart is disabled! \nGo to the configuration page to enable autostart, or start it manually.')
+            log.close()
 
-number=int(pm.config.robot.virtualBot)
-if number>0:
-    pm.clone(number)
+    number=int(pm.config.robot.virtualBot)
+    if number>0:
+        # in the background: each bot is waited for until it is ready
+        pm.jobs.submit('clone', start_clones, (number, ), concurrency='fleet')
+
+def start_clones(number):
+    # the clone job of the startup: a failure is logged, nothing else depends on it
+    try:
+        return pm.clone(number)
+    except (SystemError, OSError) as e:
+        with open(pm.config.poppyLog.puppetMaster, 'a') as log:
+            log.write('Could not start the {} virtual bots at startup: {}\n'.format(number, e))
+        raise
+
+def worker_init():
+    """ Starts the background threads of a process serving requests (its probes).
+
+    With the production server, it is run by each worker once forked.
+
+    """
+    REGISTRY.start()
+    probes.start()
 
 flash_msg = json.load(open('multilangue_flash_msg.json', 'r'))
+platform_version = platform().replace('-',' ')
 
 @app.context_processor
 def inject_robot_config():
-    return dict(robot=pm.config.robot,
-                info=pm.config.info,
-                wifi=pm.config.wifi,
-                hotspot=pm.config.hotspot,
-                port=pm.config.poppyPort,
-                log=pm.config.poppyLog,
-                services=pm.config.services,
-                version=pm.config.version,
-                clone=pm.nb_clone)
+    config = pm.config
+    clones = pm.fleet.summary
+    return dict(robot=config.robot,
+                info=config.info,
+                wifi=config.wifi,
+                hotspot=config.hotspot,
+                port=config.poppyPort,
+                log=config.poppyLog,
+                services=config.services,
+                version=config.version,
+                clone=len(clones),
+                clones=clones)
+
+# the indexes are built in the background by startup()
+assets = AssetIndex(os.path.join(app.root_path, 'static'))
+
+# Snap! and poppy-monitor are installed alongside puppet-master: too large to
+# be hashed, they are cached 10 minutes by the browsers and rescanned every
+# minute in case they got updated
+shared_path = app.root_path.replace('/puppet-master', '')
+snap_files = AssetIndex(os.path.join(shared_path, 'snap'), fingerprint=False,
+                        max_age=600, refresh_interval=60)
+monitor_files = AssetIndex(os.path.join(shared_path, 'poppy-monitor'), fingerprint=False,
+                           max_age=600, refresh_interval=60)
+
+@app.route('/static/<path:filename>', endpoint='static')
+def static(filename):
+    return assets.send(filename)
+
+@app.url_defaults
+def static_version(endpoint, values):
+    # fingerprints the static URLs with the content hash of the file
+    if endpoint == 'static' and 'v' not in values:
+        version = assets.version(values.get('filename'))
+        if version is not None:
+            values['v'] = version
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'puppet_master_http_requests_total',
+    'Requests answered, by route.', ['method', 'endpoint', 'status'])
+HTTP_DURATION = REGISTRY.histogram(
+    'puppet_master_http_request_duration_seconds',
+    'Time to answer a request (to its first byte for the streams), by route.', ['endpoint'])
+LOG_BYTES = REGISTRY.counter(
+    'puppet_master_log_bytes_served_total',
+    'Bytes of logs sent to the clients.', ['log'])
+REGISTRY.gauge('puppet_master_clones', 'Running virtual bots.',
+               lambda: len(pm.fleet))
+REGISTRY.gauge('puppet_master_daemon_state', 'State of the robot API (1 for the current one).',
+               lambda: {pm.daemon_state['state']: 1}, ['state'])
+
+def log_kind(name):
+    # one series per kind of log, not one per virtual bot
+    return 'virtualBot' if name.startswith('virtualBot') else name
+
+def serve_log(name):
+    g.served_log = log_kind(name)
+
+# each open stream holds a thread of the worker (server.maxStreams)
+streams = StreamLimiter(stream_limit(server_options(pm.config, threads=args.threads)))
+
+def stream_response(chunks, mimetype='text/event-stream'):
+    # past the cap of open streams, 503 rather than a worker without any thread left for the pages
+    stream = streams.open(chunks)
+    if stream is None:
+        chunks.close()
+        return Response('Too many open streams, retry later.\n', status=503, mimetype='text/plain',
+                        headers={'Retry-After': '10'})
+    return Response(stream, mimetype=mimetype, headers={'X-Accel-Buffering': 'no'})
+
+def counted_stream(name, chunks):
+    for chunk in chunks:
+        LOG_BYTES.inc(len(chunk), log=name)
+        yield chunk
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+# sampled (config profiling.sampleRate) and slow (profiling.slowThreshold) requests
+profiler = RequestProfiler(pm.state)
+
+@app.before_request
+def start_profile():
+    options = profiling_options(pm.config)
+    g.profile = profiler.begin(options['sampleRate'], options['slowThreshold'])
+
+@app.teardown_request
+def end_profile(exc):
+    capture = g.pop('profile', None)
+    if capture is not None:
+        options = profiling_options(pm.config)
+        profiler.end(capture, options['slowThreshold'], options['keep'],
+                     method=request.method, path=request.full_path.rstrip('?'),
+                     endpoint=request.endpoint, status=g.get('status', 500))
+
+@app.after_request
+def record_request(response):
+    g.status = response.status_code
+    endpoint = request.endpoint or 'unknown'
+    HTTP_REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    if 'request_start' in g:
+        HTTP_DURATION.observe(time.time() - g.request_start, endpoint=endpoint)
+    if 'served_log' in g and not response.is_streamed:
+        LOG_BYTES.inc(response.content_length or 0, log=g.served_log)
+    return response
 
 @app.after_request
 def cache_buster(response):
+    if request.endpoint in ('static', 'base_static_snap', 'base_static_monitor'):
+        return response
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
@@ -114,39 +267,32 @@ def index():
 
 @app.route('/opening/end')
 def end_opening():
-    pm.update_config('robot.firstPage', False)
-    pm.update_config('robot.autoStart', True)
+    pm.update_configs([('robot.firstPage', False),
+                       ('robot.autoStart', True)])
     return render_template(pm.config.info.langage+'/index.html')
 
 @app.route('/infos')
 def infos():
-    from platform import platform as platform_version
-    from notebook import __version__ as notebook_version
-    web_access=True
-    try:
-        requests.get('https://www.poppy-project.org/')
-    except:
-        web_access=False
-    check_version()
-    def service_running(service):
-        if os.system('sudo systemctl is-active {}'.format(service)) == 0:
-            return True
-        else:
-            return False
+    probe = probes.values()
+    services = probe['services']
     return render_template(
         'infos.html',
-        ip=find_local_ip(),
-        platform_version=platform_version().replace('-',' '),
+        ip=probe['ip'],
+        platform_version=platform_version,
         python_version=sys.version.replace('\n',''),
-        notebook_version=notebook_version,
-        web_access=web_access,
+        notebook_version=probe['notebook_version'],
+        web_access=probe['web_access'],
         api_running=pm.running,
-        pm_running=service_running(pm.config.services.PuppetMaster),
-        jupyter_running=service_running(pm.config.services.JupyterNotebook),
-        docs_running=service_running(pm.config.services.PoppyDocs),
-        viewer_running=service_running(pm.config.services.PoppyViewer)
+        pm_running=services.get(pm.config.services.PuppetMaster),
+        jupyter_running=services.get(pm.config.services.JupyterNotebook),
+        docs_running=services.get(pm.config.services.PoppyDocs),
+        viewer_running=services.get(pm.config.services.PoppyViewer)
     )
 
+@app.route('/infos/probes')
+def infos_probes():
+    return jsonify(probes.status())
+
 @app.route('/docs')
 def docs():
     return render_template( 'base-iframe.html', iframe_src='http://{}:{}/{}/'.format(urlparse(request.url_root).hostname, pm.config.poppyPort.docs,  str(pm.config.info.langage).lower()))
@@ -174,6 +320,7 @@ def docs_img_content(img_path):
 
 @app.route('/docs/log')
 def docs_log():
+    serve_log('docs')
     try:
         with open(pm.config.poppyLog.docs) as f:
             content = f.read()
@@ -201,8 +348,7 @@ def monitor():
     )
 @app.route('/monitoring/monitor/<path:filename>')
 def base_static_monitor(filename):
-    path=app.root_path.replace('/puppet-master','')
-    return send_from_directory(path + '/poppy-monitor/', filename)
+    return monitor_files.send(filename)
 
 @app.route('/monitoring/recorder')
 def move_recorder():
@@ -212,12 +358,7 @@ def move_recorder():
         source=None
     else:
         source='http://{}:{}'.format(urlparse(request.url_root).hostname, pm.config.poppyPort.snap)
-        try:
-            response = requests.get(source)
-            if response.status_code==200: connect=True
-            else: connect=False
-        except:
-            connect=False
+        connect=pm.robot.is_snap_reachable()
     return render_template(pm.config.info.langage+'/move-recorder.html', motors=pm._get_robot_motor_list(), source=source, connect=connect)
 
 @app.route('/monitoring/visualisator')
@@ -237,7 +378,22 @@ def multiview():
 def camera():
     if not pm.running:
         flash(Markup(flash_msg['api_is_stop'][pm.config.info.langage].format('Web Camera', url_for('logs'),url_for('APIstart'))), 'alert')
-    return render_template('camera.html', source='http://{}:{}/frame.png'.format(urlparse(request.url_root).hostname, pm.config.poppyPort.snap), FPS=6)
+    return render_template('camera.html', source='http://{}:{}/frame.png'.format(urlparse(request.url_root).hostname, pm.config.poppyPort.snap), FPS=camera_config()['fps'])
+
+@app.route('/monitoring/camera/stream')
+def camera_stream():
+    config = camera_config()
+    # no faster than the grabber pulls the frames
+    fps = min(request.args.get('fps', config['fps'], type=float), config['fps'])
+    return stream_response(
+        mjpeg_stream('http://localhost:{}/frame.png'.format(pm.config.poppyPort.snap),
+                     max_fps=fps, fps=config['fps'], quality=config['quality']),
+        mimetype='multipart/x-mixed-replace; boundary=frame')
+
+def camera_config():
+    config = {'fps': 6, 'quality': 75}
+    config.update(pm.config.as_dict().get('camera', {}))
+    return config
 
 @app.route('/programming')
 def programming():
@@ -253,8 +409,7 @@ def snap():
     )
 @app.route('/programming/snap/<path:filename>')
 def base_static_snap(filename):
-    path=app.root_path.replace('/puppet-master','')
-    return send_from_directory(path + '/snap/', filename)
+    return snap_files.send(filename)
 
 @app.route('/programming/jupyter')
 def jupyter():
@@ -289,25 +444,28 @@ def settings_update():
             'ssid':'Name',
             'psk':'Password'}
     msg=''
+    config=pm.config
+    changes=[]
     for key, value in request.form.items() :
         if value != '':
             key=key.split('_')
             value=value.replace(' ','')#prevent user mistake
             if value == 'on': value = True
             elif value == 'off': value = False
-            if value != getattr(getattr(pm.config, key[0]), key[1]):
-                pm.update_config('.'.join(key),value)
+            if value != getattr(getattr(config, key[0]), key[1]):
+                changes.append(('.'.join(key),value))
                 msg+= flash_msg['changed'][pm.config.info.langage].format(label[key[1]], key[0])
                 if key[1] == 'name' or key[0] == 'hotspot' or key[0] == 'wifi':
                     msg+= flash_msg['network_need_restart'][pm.config.info.langage].format(url_for('restart_network'))
                 msg+='<br>'
+    pm.update_configs(changes)
     if msg == '': flash(flash_msg['no_changed'][pm.config.info.langage], 'warning')
     else: flash(Markup(msg), 'success')
     return ('', 204)
 
 @app.route('/restart_network')
 def restart_network():
-    pm.restart_network()
+    pm.jobs.submit('network', pm.restart_network)
     goback= request.referrer.replace(urlparse(request.url_root).hostname, pm.config.robot.name+'.local')
     flash(flash_msg['network_restart'][pm.config.info.langage], 'success')
     return redirect(goback)
@@ -347,9 +505,9 @@ def update_logs():
 
 @app.route('/restart_services')
 def restart_services():
-    pm.restart_services()
+    job = pm.jobs.submit('services', pm.restart_services)
     flash(flash_msg['services_restart'][pm.config.info.langage], 'success')
-    return ('', 204)
+    return jsonify(job), 202
 
 @app.route('/api/reset')
 def APIreset():
@@ -376,6 +534,10 @@ def APIstart():
         flash(flash_msg['api_set'][pm.config.info.langage].format('start'), 'success')
     return ('', 204)
 
+@app.route('/api/status')
+def APIstatus():
+    return jsonify(pm.daemon_state)
+
 @app.route('/api/stop')
 def APIstop():
     if pm.running:
@@ -388,12 +550,8 @@ def APIstop():
 
 @app.route('/settings/update')
 def update():
-    @copy_current_request_context
-    def update_in_bg():
-        success = pm.self_update()
-
     if not pm.is_updating:
-        Thread(target=update_in_bg).start()
+        pm.jobs.submit('update', pm.self_update)
 
     return redirect(url_for('update_logs'))
 
@@ -423,15 +581,169 @@ def switch_camera():
 @app.route('/clone', methods=['POST'])
 def clone():
     nb=int(request.form['nb'])
-    pm.clone(nb)
+    job = pm.jobs.submit('clone', pm.clone, (nb, ), concurrency='fleet')
     flash(flash_msg['clone_launch'][pm.config.info.langage].format(nb), 'success')
+    return jsonify(job), 202
+
+@app.route('/clone/scale', methods=['POST'])
+def clone_scale():
+    job = pm.jobs.submit('scale', pm.fleet.scale_to, (int(request.form['target']), ),
+                         concurrency='fleet')
+    return jsonify(job), 202
+
+@app.route('/clone/<int:nb>/stop', methods=['POST'])
+def clone_stop(nb):
+    try:
+        pm.fleet.stop(nb)
+    except KeyError:
+        abort(404)
     return ('', 204)
 
+@app.route('/api/robot/state')
+def robot_state():
+    # aliases, motor registers and running primitives, shared by all the clients,
+    # or only some of them: ?fields=running_primitives
+    fields = [field for field in request.args.get('fields', '').split(',') if field] or ROBOT_FIELDS
+    if any(field not in ROBOT_FIELDS for field in fields):
+        abort(400)
+    if not pm.running:
+        return jsonify(offline_snapshot('API is stopped', fields))
+    return jsonify(pm.robot_state.get(fields))
+
+@app.route('/api/robot/ws/stream')
+@app.route('/api/robot/ws/stream/<int:instance>')
+def robot_ws_stream(instance=0):
+    # the ws stream of the robot (0) or of a virtual bot, relayed over one upstream
+    # connection as Server-Sent Events: ?motors=m1,m2&registers=present_position&rate=10
+    if instance == 0:
+        port = pm.config.poppyPort.ws
+    else:
+        ports = [bot['ports']['ws'] for bot in pm.fleet.summary if bot['id'] == instance]
+        if not ports:
+            abort(404)
+        port = ports[0]
+
+    def names(arg):
+        return [name for name in request.args.get(arg, '').split(',') if name] or None
+
+    motors, registers = names('motors'), names('registers')
+    max_rate = request.args.get('rate', type=float)
+
+    def relayed():
+        # subscribed once the stream is let open
+        relay, subscription = WsRelay.subscribe_to('localhost', int(port), motors=motors,
+                                                   registers=registers, max_rate=max_rate)
+        for event in sse_stream(relay, subscription):
+            yield event
+
+    return stream_response(relayed())
+
+@app.route('/api/robot/registers', methods=['POST'])
+def robot_registers():
+    # {"motors": [...], an alias or names separated by commas, "register": ..., "value": ...}
+    values = request.get_json(silent=True) or request.form
+    if 'register' not in values or 'value' not in values or 'motors' not in values:
+        abort(400)
+    if not pm.running:
+        abort(409)
+
+    value = values['value']
+    if not request.is_json:
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+
+    motors = values['motors']
+    if isinstance(motors, str):
+        aliases = pm.robot_state.get(['aliases'])['aliases']
+        motors = aliases[motors] if motors in aliases else motors.replace(',', ' ').split()
+    if not isinstance(motors, list) or not motors or not all(isinstance(m, str) for m in motors):
+        abort(400)
+    if not isinstance(values['register'], str):
+        abort(400)
+
+    return jsonify(errors=pm.robot_state.set_register(motors, values['register'], value))
+
+@app.route('/api/clones')
+def clones_status():
+    return jsonify(pm.fleet.instances)
+
+@app.route('/api/fleet/state')
+def fleet_state():
+    # motor registers, health and latency of every virtual bot, collected concurrently
+    return jsonify(pm.fleet_state.snapshot())
+
+@app.route('/api/fleet/state/stream')
+def fleet_state_stream():
+    rate = min(max(request.args.get('rate', 1.0, type=float), 0.1), 10.0)
+    return stream_response(pm.fleet_state.stream(rate))
+
+@app.route('/api/moves')
+def moves_list():
+    # metadata of the moves of the library, from its index
+    return jsonify(MoveLibrary.from_config(pm.config).list())
+
+@app.route('/api/moves/<name>', methods=['GET', 'PUT', 'DELETE'])
+def move(name):
+    library = MoveLibrary.from_config(pm.config)
+    try:
+        if request.method == 'PUT':
+            # a pypot Move JSON, stored as ?encoding=float32 (default) or delta (quantised)
+            data = request.get_json(silent=True, force=True)
+            encoding = request.args.get('encoding', 'float32')
+            if not isinstance(data, dict) or 'positions' not in data or encoding not in MOVE_ENCODINGS:
+                abort(400)
+            return jsonify(library.import_pypot(name, data, encoding=encoding)), 201
+        if library.info(name) is None:
+            abort(404)
+        if request.method == 'DELETE':
+            library.delete(name)
+            return ('', 204)
+        return jsonify(library.info(name))
+    except ValueError:
+        abort(400)
+
+@app.route('/api/moves/<name>/pypot')
+def move_pypot(name):
+    library = MoveLibrary.from_config(pm.config)
+    try:
+        if library.info(name) is None:
+            abort(404)
+        content = json.dumps(library.export_pypot(name))
+    except ValueError:
+        abort(400)
+    except (IOError, OSError):
+        abort(404)  # deleted meanwhile
+    # move names may hold spaces and non ASCII letters
+    return Response(content, mimetype='application/json', headers={
+        'Content-Disposition': 'attachment; filename="{0}.json"; filename*=UTF-8\'\'{1}.json'.format(
+            name.encode('ascii', 'replace').decode('ascii'), quote(name.encode('utf-8')))})
+
+@app.route('/api/moves/<name>/stream')
+def move_stream(name):
+    # the move for playback, one JSON chunk of frames per line
+    library = MoveLibrary.from_config(pm.config)
+    try:
+        if library.info(name) is None:
+            abort(404)
+        chunks = library.chunks(name)
+    except ValueError:
+        abort(400)
+    except (IOError, OSError):
+        abort(404)  # deleted meanwhile
+    return Response(('{}\n'.format(json.dumps(chunk)) for chunk in chunks),
+                    mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
 @app.route('/call_poppy_configure', methods=['POST'])
 def call_poppy_configure():
+    # a motor, several separated by commas, or 'all'
     motor = request.form['motor']
-    pm.update_config('robot.motors', motor)
-    return ('', 204)
+    try:
+        # its config handler submits the job
+        return jsonify(pm.update_config('robot.motors', motor)), 202
+    except ValueError:
+        abort(400)
 
 '''
 @app.route('/ready-to-roll')
@@ -471,6 +783,7 @@ def raw_logs():
         file= pm.config.poppyLog.viewer
     else:
         file= pm.config.poppyLog.puppetMaster
+    serve_log({-3: 'jupyter', -2: 'docs', -1: 'viewer'}.get(id, 'virtualBot' if id > 0 else 'puppetMaster'))
     try:
         with open(file) as f:
             content = f.read()
@@ -481,6 +794,7 @@ def raw_logs():
 
 @app.route('/api/update_raw_logs')
 def update_raw_logs():
+    serve_log('update')
     try:
         with open(pm.config.poppyLog.update) as f:
             content = f.read()
@@ -491,6 +805,7 @@ def update_raw_logs():
 
 @app.route('/api/configure_motors_logs')
 def poppy_config_logs():
+    serve_log('configMotor')
     try:
         with open(pm.config.poppyLog.configMotor) as f:
             content = f.read()
@@ -498,6 +813,179 @@ def poppy_config_logs():
         content = ''
     return Response(content, mimetype='text/plain')
 
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiling', methods=['GET', 'POST'])
+def profiling_settings():
+    if request.method == 'POST':
+        values = request.get_json(silent=True) or request.form
+        changes = {}
+        for key, cast in (('sampleRate', float), ('slowThreshold', float), ('keep', int)):
+            if key in values:
+                try:
+                    changes[key] = cast(values[key])
+                except (TypeError, ValueError):
+                    abort(400)
+        with pm.config_store.edit() as c:
+            # keep within 1..MAX_KEEP profiles, sampleRate within [0, 1]
+            c.as_dict()['profiling'] = bounded_options(dict(profiling_options(c), **changes))
+    return jsonify(options=profiling_options(pm.config), profiles=profiler.profiles())
+
+@app.route('/api/profiling/clear', methods=['POST'])
+def profiling_clear():
+    profiler.clear()
+    return ('', 204)
+
+@app.route('/api/profiling/<id>/<format>')
+def profiling_download(id, format):
+    path = profiler.path(id, format)
+    if path is None:
+        abort(404)
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except IOError:
+        abort(404)
+    return Response(content, mimetype=PROFILE_FORMATS[format], headers={
+        'Content-Disposition': 'attachment; filename=profile-{}.{}'.format(id, format)})
+
+@app.route('/api/jobs')
+def jobs_list():
+    return jsonify(pm.jobs.jobs())
+
+@app.route('/api/jobs/<id>')
+def job_status(id):
+    job = pm.jobs.get(id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+@app.route('/api/jobs/<id>/cancel', methods=['POST'])
+def job_cancel(id):
+    if pm.jobs.get(id) is None:
+        abort(404)
+    pm.jobs.cancel(id)
+    return jsonify(pm.jobs.get(id))
+
+@app.route('/api/jobs/<id>/tail')
+def job_tail(id):
+    job = pm.jobs.get(id)
+    if job is None:
+        abort(404)
+    serve_log('job')
+    return jsonify(read_tail(job['log'], request.args.get('cursor')))
+
+@app.route('/api/jobs/<id>/stream')
+def job_stream(id):
+    job = pm.jobs.get(id)
+    if job is None:
+        abort(404)
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    return stream_response(counted_stream('job', stream_log(job['log'], cursor)))
+
+@app.route('/api/logs/<name>/tail')
+def tail_logs(name):
+    file = log_file(name)
+    if file is None:
+        abort(404)
+    serve_log(name)
+    return jsonify(read_tail(file, request.args.get('cursor')))
+
+@app.route('/api/logs/<name>/stream')
+def stream_logs(name):
+    file = log_file(name)
+    if file is None:
+        abort(404)
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    serve_log(name)
+    return stream_response(counted_stream(g.served_log, stream_log(file, cursor)))
+
+@app.route('/api/logs/stream')
+def stream_several_logs():
+    # ?logs=puppetMaster,jupyter,virtualBot_1: one connection for all the panels of a page,
+    # each log's chunks in events named after it
+    names = [name for name in request.args.get('logs', '').split(',') if name]
+    files = dict((name, log_file(name)) for name in names)
+    if not files or None in files.values():
+        abort(404)
+    cursors = parse_cursors(request.headers.get('Last-Event-ID') or request.args.get('cursors'))
+
+    def counted(events):
+        for name, event in events:
+            if name is not None:
+                LOG_BYTES.inc(len(event), log=log_kind(name))
+            yield event
+
+    return stream_response(counted(multiplex_logs(files, cursors)))
+
+# incremental full-text index of the logs of the services and virtual bots
+log_index = LogIndex()
+
+@app.route('/api/logs/search')
+def search_logs():
+    # ?q=words or prefix*&level=warning&since=...&until=...&instance=0,2&logs=jupyter,docs&context=2&limit=100
+    # (since and until: a timestamp, 'YYYY-MM-DD HH:MM[:SS]' or, when negative, seconds ago)
+    logs = searchable_logs()
+    names = set(name for name in request.args.get('logs', '').split(',') if name)
+    for instance in request.args.get('instance', '').split(','):
+        if instance:
+            try:
+                names.add('virtualBot_{}'.format(int(instance)) if int(instance) > 0 else 'puppetMaster')
+            except ValueError:
+                abort(400)
+    if names:
+        logs = dict((name, path) for name, path in logs.items() if name in names)
+
+    level = request.args.get('level')
+    if level and level.upper() not in LOG_LEVELS + ('WARN', 'FATAL'):
+        abort(400)
+    try:
+        since, until = search_time(request.args.get('since')), search_time(request.args.get('until'))
+    except ValueError:
+        abort(400)
+
+    return jsonify(log_index.search(logs, request.args.get('q', ''), since=since, until=until, level=level,
+                                    context=min(request.args.get('context', 2, type=int), 10),
+                                    limit=min(request.args.get('limit', 100, type=int), 1000)))
+
+def search_time(value):
+    if not value:
+        return None
+    try:
+        value = float(value)
+        return time.time() + value if value < 0 else value
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError('Invalid time: {}'.format(value))
+
+def searchable_logs():
+    # the logs of the services, and of every virtual bot (running or not)
+    logs = dict((name, log_file(name)) for name in ('puppetMaster', 'jupyter', 'docs', 'viewer'))
+    pattern = pm.config.poppyLog.virtualBot.replace('.log', '_{}.log')
+    for path in glob.glob(pattern.format('*')):
+        match = re.match(re.escape(pattern).replace(r'\{\}', r'(\d+)') + '$', path)
+        if match is not None:
+            logs['virtualBot_{}'.format(match.group(1))] = path
+    return logs
+
+def log_file(name):
+    logs = pm.config.poppyLog
+    if name.startswith('virtualBot_'):
+        try:
+            nb = int(name.split('_', 1)[1])
+        except ValueError:
+            return None
+        return logs.virtualBot.replace('.log', '_{}.log'.format(nb))
+    if name in ('puppetMaster', 'update', 'configMotor', 'jupyter', 'docs', 'viewer'):
+        return getattr(logs, name)
+    return None
 
 def get_host():
     host = pm.config.robot.name
@@ -505,12 +993,57 @@ def get_host():
     return host
 
 def check_version():
-    pm.update_config('version.pypot', getattr(__import__('pypot'), '__version__'))
-    pm.update_config('version.creature', getattr(__import__(pm.config.robot.creature.replace('-','_')), '__version__'))
+    try:
+        versions = {
+            'version.pypot': pm.creatures.pypot_version,
+            'version.creature': pm.creatures.version(pm.config.robot.creature),
+        }
+    except KeyError:
+        return {}
+    version = pm.config.version
+    pm.update_configs([(key, value) for key, value in versions.items()
+                       if getattr(version, key.split('.')[1]) != value])
     #pm.update_config('version.snap', 'TODO')
     #pm.update_config('version.viewer', 'TODO')
     #pm.update_config('version.docs', 'TODO')
     #pm.update_config('version.monitor', 'TODO')
+    return versions
+
+def probe_web_access():
+    try:
+        requests.head('https://www.poppy-project.org/', timeout=3)
+        return True
+    except requests.RequestException:
+        return False
+
+def probe_services():
+    services = list(pm.config.services.as_dict().values())
+    _, out = run_command(['systemctl', 'is-active'] + services, timeout=3)
+    return dict(zip(services, [state == 'active' for state in out.split()]))
+
+def probe_notebook_version():
+    from notebook import __version__ as notebook_version
+    return notebook_version
+
+probes = ProbeCache([
+    Probe('web_access', probe_web_access, ttl=60, timeout=4, default=False),
+    Probe('services', probe_services, ttl=10, timeout=4, default={}),
+    Probe('ip', find_local_ip, ttl=60, timeout=2, default='unknown'),
+    Probe('notebook_version', probe_notebook_version, ttl=3600, timeout=10, default='unknown'),
+    # also records the installed versions in the config at startup
+    Probe('versions', check_version, ttl=3600, timeout=30, default={}),
+])
+
+if not args.production:
+    startup()
+    worker_init()
+
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=int(pm.config.poppyPort.puppetMaster))
+    if args.production:
+        options = server_options(pm.config, workers=args.workers, threads=args.threads)
+        options.pop('maxStreams')  # enforced by the app itself
+        serve(app, '0.0.0.0', int(pm.config.poppyPort.puppetMaster), control=startup, worker_init=worker_init,
+              **options)
+    else:
+        app.run(host='0.0.0.0', port=int(pm.config.poppyPort.puppetMaster))
@@ -0,0 +1,138 @@
+import time
+import requests
+
+from io import BytesIO
+from threading import Thread, Lock, Condition
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class FrameGrabber(Thread):
+    """ Single puller of the robot camera frames, shared by all viewers.
+
+    Frames are fetched from the pypot snap server at a fixed rate and
+    re-encoded as JPEG (when Pillow is available, otherwise the PNG frames
+    are served as they are). Only the latest frame is kept: viewers wait for
+    a newer one than the last they sent, so a slow viewer simply skips
+    frames instead of queueing them.
+
+    Grabbers are shared per frame url (see subscribe_to) and stop with
+    their last viewer.
+
+    """
+    _grabbers = {}
+    _grabbers_lock = Lock()
+
+    def __init__(self, url, fps=6, quality=75, timeout=2.0):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.url = url
+        self.period = 1.0 / max(float(fps), 0.1)
+        self.quality = int(quality)
+        self.timeout = timeout
+
+        self.frame = None
+        self.mimetype = 'image/jpeg' if Image is not None else 'image/png'
+        self.seq = 0
+
+        self._viewers = 0
+        self._running = True
+        self._new_frame = Condition()
+        self._session = requests.Session()
+
+    @classmethod
+    def subscribe_to(cls, url, **kwargs):
+        with cls._grabbers_lock:
+            grabber = cls._grabbers.get(url)
+            if grabber is None or not grabber._running:
+                grabber = cls(url, **kwargs)
+                grabber.start()
+                cls._grabbers[url] = grabber
+            grabber._viewers += 1
+            return grabber
+
+    def unsubscribe(self):
+        with FrameGrabber._grabbers_lock:
+            self._viewers -= 1
+            if self._viewers > 0:
+                return
+            self._running = False
+            if FrameGrabber._grabbers.get(self.url) is self:
+                del FrameGrabber._grabbers[self.url]
+
+        with self._new_frame:
+            self._new_frame.notify_all()
+
+    def _encode(self, png):
+        if Image is None:
+            return png
+
+        buf = BytesIO()
+        Image.open(BytesIO(png)).convert('RGB').save(buf, 'JPEG', quality=self.quality)
+        return buf.getvalue()
+
+    def run(self):
+        while self._running:
+            start = time.time()
+            try:
+                r = self._session.get(self.url, timeout=self.timeout)
+                if r.status_code == 200:
+                    frame = self._encode(r.content)
+                    with self._new_frame:
+                        self.frame = frame
+                        self.seq += 1
+                        self._new_frame.notify_all()
+            except (requests.RequestException, IOError):
+                pass
+
+            time.sleep(max(self.period - (time.time() - start), 0))
+
+        self._session.close()
+
+    def wait_frame(self, last_seq, timeout=5.0):
+        """ Returns (seq, frame) for a frame newer than last_seq, or (last_seq, None). """
+        with self._new_frame:
+            if self.seq <= last_seq and self._running:
+                self._new_frame.wait(timeout)
+            if self.seq > last_seq:
+                return self.seq, self.frame
+            return last_seq, None
+
+
+def mjpeg_stream(url, max_fps=None, **kwargs):
+    """ Generator of a multipart/x-mixed-replace body (boundary 'frame').
+
+    When no new frame comes (robot or camera off), the last one is sent
+    again at each wait, or before the first frame, a line break (ignored
+    by the browsers, as the preamble of the body): writing is how a
+    disconnected viewer is noticed (and the grabber released), and the
+    stream goes on once the camera is back.
+
+    """
+    grabber = FrameGrabber.subscribe_to(url, **kwargs)
+    min_period = 1.0 / max_fps if max_fps else 0
+    seq, last = 0, None
+
+    try:
+        while True:
+            start = time.time()
+            seq, frame = grabber.wait_frame(seq)
+            if frame is None:
+                if last is None:
+                    yield b'\r\n'
+                    continue
+                frame = last
+            last = frame
+
+            yield (b'--frame\r\n'
+                   b'Content-Type: ' + grabber.mimetype.encode() + b'\r\n'
+                   b'Content-Length: ' + str(len(frame)).encode() + b'\r\n\r\n' +
+                   frame + b'\r\n')
+
+            time.sleep(max(min_period - (time.time() - start), 0))
+    finally:
+        grabber.unsubscribe()
@@ -1,4 +1,21 @@
+import os
+import copy
+import time
 import yaml
+import tempfile
+
+from types import MappingProxyType
+from collections.abc import Mapping
+from threading import RLock
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+
+CONFIG_DURATION = REGISTRY.histogram(
+    'puppet_master_config_duration_seconds',
+    'Config accesses: reads (served from memory or not), loads (parsing the file) and writes.',
+    ['operation'])
 
 
 class Config(object):
@@ -26,7 +43,7 @@ class Config(object):
 
     def __getattr__(self, key):
         value = self.__config[key]
-        if isinstance(value, dict):
+        if isinstance(value, Mapping):
             return Config(value)
 
         return value
@@ -36,6 +53,122 @@ class Config(object):
         config[key] = value
 
 
+class ConfigStore(object):
+    """ Process-wide, in-memory view of a yaml config file.
+
+    The file is parsed once and then served from memory. It is only
+    re-parsed when its inode, mtime or size changes on disk.
+
+    """
+    _stores = {}
+    _stores_lock = RLock()
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+
+        self._lock = RLock()
+        self._signature = None
+        self._data = None
+        self._frozen = None
+
+    @classmethod
+    def for_file(cls, filename):
+        filename = os.path.abspath(filename)
+
+        with cls._stores_lock:
+            if filename not in cls._stores:
+                cls._stores[filename] = cls(filename)
+            return cls._stores[filename]
+
+    def _stat(self):
+        st = os.stat(self.filename)
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _refresh(self):
+        """ Reloads the file if it changed since it was cached. """
+        start = time.time()
+        signature = self._stat()
+
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    with CONFIG_DURATION.time(operation='load'):
+                        with open(self.filename) as f:
+                            data = yaml.load(f, Loader=yaml.SafeLoader)
+                        self._data, self._frozen = data, _frozen(data)
+                    self._signature = signature
+
+        CONFIG_DURATION.observe(time.time() - start, operation='read')
+
+    @property
+    def data(self):
+        """ Returns a copy of the parsed config dict, reloading it if the file changed. """
+        self._refresh()
+        return copy.deepcopy(self._data)
+
+    @property
+    def config(self):
+        """ Read-only :class:`Config` view (closing it does not write anything).
+
+        Its sections are read-only mappings of the cached config, shared
+        by every reader: setting a value raises TypeError, use edit().
+
+        """
+        self._refresh()
+        return Config(self._frozen)
+
+    def write(self, data):
+        """ Atomically replaces the file and the cache. """
+        with self._lock, CONFIG_DURATION.time(operation='write'):
+            atomic_write(self.filename, yaml.safe_dump(data, default_flow_style=False))
+
+            # the caller keeps data: cache a copy of its own
+            self._data = copy.deepcopy(data)
+            self._frozen = _frozen(data)
+            self._signature = self._stat()
+
+    @contextmanager
+    def edit(self):
+        """ Yields a writable copy of the config, saved back to disk on exit. """
+        with self._lock:
+            c = Config(self.data)
+            yield c
+            self.write(c.as_dict())
+
+
+def _frozen(value):
+    """ Read-only view of a parsed config: mappings proxies and tuples. """
+    if isinstance(value, dict):
+        return MappingProxyType(dict((k, _frozen(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_frozen(v) for v in value)
+    return value
+
+
+def atomic_write(filename, content):
+    """ Writes content to filename through a fsync'ed temp file renamed over it.
+
+    Readers (or a power cut) see either the old or the new file, never a
+    truncated one.
+
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(basename), dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(filename):
+            os.chmod(tmp, os.stat(filename).st_mode & 0o777)
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def attrsetter(item):
     def resolve_attr(obj, attr):
         if not attr:
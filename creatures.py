@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+from threading import RLock
+
+from config import atomic_write
+
+
+DEFAULT_PATH = os.path.expanduser('~/.cache/puppet-master/creatures.json')
+RETRY_INTERVAL = 60.0
+
+
+def installed_versions():
+    """ {distribution: version} of pypot and the poppy-* packages, without importing them. """
+    try:
+        from importlib.metadata import distributions
+        dists = ((d.metadata['Name'], d.version) for d in distributions())
+    except ImportError:
+        import pkg_resources
+        dists = ((d.project_name, d.version) for d in pkg_resources.working_set)
+
+    versions = {}
+    for name, version in dists:
+        if name is None:
+            continue
+        name = name.lower().replace('_', '-')
+        if name == 'pypot' or name.startswith('poppy-'):
+            versions[name] = version
+    return versions
+
+
+def _resolve_group(groups, name, seen=()):
+    motors = []
+    for item in groups.get(name, []):
+        if item in groups and item not in seen:
+            motors += _resolve_group(groups, item, seen + (name, ))
+        else:
+            motors.append(item)
+    return motors
+
+
+def build_manifest():
+    """ Imports pypot and the creatures to describe them (slow). """
+    import pypot
+    from pypot.creatures import installed_poppy_creatures
+
+    creatures = {}
+    for name, RobotCls in installed_poppy_creatures.items():
+        config = RobotCls.default_config
+        module = sys.modules.get(RobotCls.__module__.split('.')[0])
+        groups = config.get('motorgroups', {})
+
+        creatures[name] = {
+            'version': getattr(module, '__version__', None),
+            'motors': sorted(config['motors'].keys()),
+            'aliases': dict((alias, sorted(set(_resolve_group(groups, alias))))
+                            for alias in groups),
+        }
+
+    return {
+        'pypot': getattr(pypot, '__version__', None),
+        'creatures': creatures,
+    }
+
+
+class CreatureManifest(object):
+    """ Cached manifest of the installed creatures (names, versions, motors, aliases).
+
+    Describing the creatures means importing pypot and every creature
+    package, which takes seconds on a Raspberry Pi. The manifest is built
+    in a separate python process (python creatures.py --build <path>) and
+    stored on disk, then served from memory. It is only rebuilt when the
+    installed versions of pypot or of a poppy-* package change, so the web
+    process never imports pypot. When the build fails, an empty manifest is
+    served and the build is tried again after retry_interval seconds.
+
+    """
+    _manifests = {}
+    _manifests_lock = RLock()
+
+    def __init__(self, path=DEFAULT_PATH, retry_interval=RETRY_INTERVAL):
+        self.path = path
+        self.retry_interval = retry_interval
+
+        self._lock = RLock()
+        self._data = None
+        self._failed = None  # time of the last failed build
+
+    @classmethod
+    def for_path(cls, path=DEFAULT_PATH):
+        with cls._manifests_lock:
+            if path not in cls._manifests:
+                cls._manifests[path] = cls(path)
+            return cls._manifests[path]
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None or (self._failed is not None and
+                                      time.time() - self._failed >= self.retry_interval):
+                self._data = self._load()
+            return self._data
+
+    def _load(self):
+        key = installed_versions()
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('key') == key:
+                return data
+        except (IOError, ValueError):
+            pass
+
+        return self.rebuild(key)
+
+    def rebuild(self, key=None):
+        """ Builds the manifest in a python subprocess and stores it. """
+        key = key if key is not None else installed_versions()
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        try:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   '--build', self.path])
+            with open(self.path) as f:
+                data = json.load(f)
+        except (subprocess.CalledProcessError, OSError, IOError, ValueError):
+            # pypot not importable: serve an empty manifest, not cached on disk
+            with self._lock:
+                self._failed = time.time()
+            return {'key': key, 'pypot': None, 'creatures': {}}
+
+        data['key'] = key
+        atomic_write(self.path, json.dumps(data))
+
+        with self._lock:
+            self._data = data
+            self._failed = None
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self._failed = None
+
+    @property
+    def names(self):
+        return sorted(self.data['creatures'])
+
+    @property
+    def pypot_version(self):
+        return self.data['pypot']
+
+    def version(self, creature):
+        return self.data['creatures'][creature]['version']
+
+    def motors(self, creature):
+        return self.data['creatures'][creature]['motors']
+
+    def aliases(self, creature):
+        return self.data['creatures'][creature]['aliases']
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the creature manifest')
+    parser.add_argument('--build', type=str, default=DEFAULT_PATH,
+                        help='where to write the manifest')
+    args = parser.parse_args()
+
+    atomic_write(args.build, json.dumps(build_manifest()))
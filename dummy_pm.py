@@ -29,7 +29,7 @@ Could not start up the robot...
 """
 
 
-def print_command(cmd):
+def print_command(cmd, **kwargs):
     print(' '.join(cmd))
 
 
@@ -41,7 +41,7 @@ class PuppetMaster(pm.PuppetMaster):
         pm.PuppetMaster.__init__(self, DaemonCls, configfile, pidfile)
 
         self.update_config('robot.use-dummy', True)
-        self.update_config('update.logfile', '/tmp/update.log')
+        self.update_config('poppyLog.update', '/tmp/update.log')
 
     def log(self, msg, erase=False):
         if erase:
@@ -58,27 +58,31 @@ class PuppetMaster(pm.PuppetMaster):
         self.log('Stop daemon')
         pm.PuppetMaster.stop(self)
 
-    def update_config(self, key, value):
-        self.log('Update config {}={}'.format(key, value))
-        pm.PuppetMaster.update_config(self, key, value)
+    def update_configs(self, changes):
+        changes = list(changes.items() if hasattr(changes, 'items') else changes)
+        for key, value in changes:
+            self.log('Update config {}={}'.format(key, value))
+        return pm.PuppetMaster.update_configs(self, changes)
 
     def self_update(self):
-        self._updating = True
+        if not self.state.claim('updating'):
+            return
 
-        if os.path.exists(self.config.poppyLog.update):
-            os.remove(self.config.poppyLog.update)
+        try:
+            if os.path.exists(self.config.poppyLog.update):
+                os.remove(self.config.poppyLog.update)
 
-        while True:
-            with open(self.config.poppyLog.update, 'a') as f:
-                f.write('Faking some install...\n')
-            time.sleep(random.random() * 2)
-
-            if random.random() < 0.1:
-                break
+            while True:
+                with open(self.config.poppyLog.update, 'a') as f:
+                    f.write('Faking some install...\n')
+                time.sleep(random.random() * 2)
 
-        with open(self.config.poppyLog.update, 'a') as f:
-            f.write('Your robot is now up-to-date!\n')
+                if random.random() < 0.1:
+                    break
 
-        self._updating = False
+            with open(self.config.poppyLog.update, 'a') as f:
+                f.write('Your robot is now up-to-date!\n')
+        finally:
+            self.state.release('updating')
 
         return True
@@ -0,0 +1,368 @@
+import os
+import time
+import signal
+
+from subprocess import Popen
+from threading import RLock
+from multiprocessing.pool import ThreadPool
+
+from ports import PortAllocator, wait_port
+from shared_state import pid_alive
+
+
+MB = 1024 * 1024
+
+DEFAULTS = {
+    'memoryBudget': 512,
+    'cloneMemory': 150,
+    'overBudget': 'refuse',
+    'concurrency': 2,
+    'readyTimeout': 60,
+}
+
+# cpu usage is measured over windows of at least this many seconds
+CPU_INTERVAL = 2.0
+
+
+def proc_usage(pid):
+    """ Returns (rss in bytes, cpu time in seconds) of pid, read from /proc. """
+    with open('/proc/{}/statm'.format(pid)) as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are the 14th and 15th fields, counted from the pid
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+    return rss, cpu
+
+
+class VirtualBot(object):
+    """ A simulated robot (poppy-services --poppy-simu) started by the fleet.
+
+    process is its Popen in the server process which started it, None in
+    the others (which only know its pid).
+
+    """
+    def __init__(self, id, ports, logfile, pid, started=None, process=None):
+        self.id = id
+        self.ports = tuple(ports)
+        self.logfile = logfile
+        self.pid = pid
+        self.process = process
+        self.started = started if started is not None else time.time()
+        self.ready_time = None
+
+        # (time, cpu time) at the start and end of the last complete window
+        self._window = ((self.started, 0.), None)
+
+    @classmethod
+    def from_record(cls, record, process=None):
+        bot = cls(record['id'], record['ports'], record['log'], record['pid'],
+                  record['started'], process)
+        bot.ready_time = record['ready_time']
+        return bot
+
+    def record(self):
+        return {
+            'id': self.id,
+            'pid': self.pid,
+            'owner': os.getpid(),
+            'ports': list(self.ports),
+            'log': self.logfile,
+            'started': self.started,
+            'ready_time': self.ready_time,
+        }
+
+    @property
+    def alive(self):
+        if self.process is not None:
+            return self.process.poll() is None
+        return pid_alive(self.pid)
+
+    def terminate(self, timeout=5.0):
+        """ SIGTERM, then SIGKILL if still alive after timeout. """
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            if not self.alive:
+                return
+            try:
+                os.kill(self.pid, sig)
+            except OSError:
+                return
+
+            deadline = time.time() + timeout
+            while self.alive and time.time() < deadline:
+                time.sleep(0.05)
+
+    def usage(self):
+        """ Returns (rss, cpu percent), (0, 0.) if gone.
+
+        The cpu percent is the one of the last window of at least
+        CPU_INTERVAL seconds (or since the start during the first one),
+        however often it is called.
+
+        """
+        try:
+            rss, cpu = proc_usage(self.pid)
+        except (IOError, OSError, ValueError, IndexError):
+            return 0, 0.
+
+        now = time.time()
+        start, end = self._window
+        if now - (end or start)[0] >= CPU_INTERVAL:
+            start, end = self._window = ((end or start), (now, cpu))
+        elif end is None:
+            end = (now, cpu)
+
+        (start_time, start_cpu), (end_time, end_cpu) = start, end
+        percent = 100. * (end_cpu - start_cpu) / (end_time - start_time) if end_time > start_time else 0.
+
+        return rss, percent
+
+    def info(self):
+        rss, cpu = self.usage()
+        return {
+            'id': self.id,
+            'pid': self.pid,
+            'alive': self.alive,
+            'ports': dict(zip(('http', 'snap', 'ws'), self.ports)),
+            'log': self.logfile,
+            'started': self.started,
+            'ready_time': self.ready_time,
+            'rss': rss,
+            'cpu': cpu,
+        }
+
+
+class Fleet(object):
+    """ Tracks the virtual bots and keeps them within a memory budget.
+
+    Clones get their ports from a PortAllocator and are started in parallel
+    (at most 'concurrency' at a time). Before launching, the memory the new
+    clones would take (the mean RSS of the running ones, or cloneMemory MB
+    when there is none yet) is checked against memoryBudget MB: with
+    overBudget 'refuse' the clones that do not fit are not started, with
+    'evict' the oldest clones are stopped to make room.
+
+    The options come from the optional 'fleet' config section. The fleet
+    registry is the 'fleet' key of a SharedState, so that every server
+    process sees (and can stop) the clones started by the others.
+
+    """
+    def __init__(self, config_store, log_manager, state, ports=None):
+        self.config_store = config_store
+        self.log_manager = log_manager
+        self.state = state
+        self.ports = ports if ports is not None else PortAllocator(state=state)
+
+        self._lock = RLock()
+        # (id, pid): VirtualBot, keeps the Popen of the clones started here
+        # and the cpu samples between two reads
+        self._bots = {}
+
+    @property
+    def options(self):
+        options = dict(DEFAULTS)
+        options.update(self.config_store.data.get('fleet', {}))
+        return options
+
+    def _bot(self, record):
+        key = (record['id'], record['pid'])
+        bot = self._bots.get(key)
+        if bot is None or (bot.process is not None and record['owner'] != os.getpid()):
+            # unknown here, or a Popen copied by a fork of the process owning it
+            bot = self._bots[key] = VirtualBot.from_record(record)
+        bot.ready_time = record['ready_time']
+        return bot
+
+    def _register(self, bot):
+        def add(registry):
+            registry[str(bot.id)] = bot.record()
+            return registry
+
+        with self._lock:
+            self._bots[(bot.id, bot.pid)] = bot
+            self.state.update('fleet', add, {})
+
+    def _forget(self, bot):
+        removed = []
+
+        def remove(registry):
+            record = registry.get(str(bot.id))
+            if record is not None and record['pid'] == bot.pid:
+                removed.append(registry.pop(str(bot.id)))
+            return registry
+
+        self._bots.pop((bot.id, bot.pid), None)
+        self.state.update('fleet', remove, {})
+
+        # only once, by the process which saw it gone first
+        if removed:
+            self.ports.release(bot.id)
+            self.log_manager.stop_run(bot.logfile)
+
+    @property
+    def bots(self):
+        with self._lock:
+            bots = [self._bot(record) for record in self.state.get('fleet', {}).values()]
+
+            alive = []
+            for bot in bots:
+                if bot.alive:
+                    alive.append(bot)
+                else:
+                    self._forget(bot)
+            return sorted(alive, key=lambda bot: bot.id)
+
+    def __len__(self):
+        return len(self.bots)
+
+    @property
+    def instances(self):
+        """ Full info of the clones (reaping the dead ones), with their memory and cpu usage. """
+        return [bot.info() for bot in self.bots]
+
+    @property
+    def summary(self):
+        """ Id, pid, ports and ready time of the live clones, read from the registry only.
+
+        Cheap enough for every page render or stream tick: no reaping and
+        no /proc read (see instances).
+
+        """
+        return sorted(({
+            'id': record['id'],
+            'pid': record['pid'],
+            'ports': dict(zip(('http', 'snap', 'ws'), record['ports'])),
+            'ready_time': record['ready_time'],
+        } for record in self.state.get('fleet', {}).values() if pid_alive(record['pid'])),
+            key=lambda bot: bot['id'])
+
+    @property
+    def pids(self):
+        return set(record['pid'] for record in self.state.get('fleet', {}).values())
+
+    def memory_used(self):
+        return sum(bot.usage()[0] for bot in self.bots)
+
+    def _clone_memory(self):
+        sizes = [rss for rss in (bot.usage()[0] for bot in self.bots) if rss > 0]
+        if sizes:
+            return sum(sizes) / len(sizes)
+        return self.options['cloneMemory'] * MB
+
+    def _make_room(self, number):
+        """ (how many of number new clones fit in the budget, the bots to evict for them if allowed). """
+        options = self.options
+        budget = options['memoryBudget'] * MB
+        per_clone = self._clone_memory()
+
+        used = self.memory_used()
+        victims = []
+        if options['overBudget'] == 'evict':
+            for bot in sorted(self.bots, key=lambda bot: bot.started):
+                if used + number * per_clone <= budget:
+                    break
+                victims.append(bot)
+                used -= bot.usage()[0]
+
+        free = budget - used
+        return max(0, min(number, int(free // per_clone))), victims
+
+    def _launch(self, nb, ports, creature, logfile, timeout):
+        http, snap, ws = ports
+        self.log_manager.start_run(logfile)
+
+        start = time.time()
+        with open(logfile, 'ab') as f:
+            try:
+                p = Popen(['poppy-services', '--poppy-simu', '--no-browser',
+                           '--http', '--http-port', str(http),
+                           '--snap', '--snap-port', str(snap),
+                           '--ws', '--ws-port', str(ws),
+                           creature],
+                          stdout=f, stderr=f)
+            except OSError:
+                f.write(b'>> ERROR <<\n')
+                self.ports.release(nb)
+                return None
+
+        bot = VirtualBot(nb, ports, logfile, p.pid, process=p)
+        self._register(bot)
+
+        if wait_port(http, timeout, alive=lambda: bot.alive):
+            bot.ready_time = time.time() - start
+            self._register(bot)
+        return bot
+
+    def scale_up(self, number=1):
+        """ Launches number clones, returns a report per requested clone.
+
+        Each report has the clone id (its port offset), ports, log, whether
+        it got ready and in how long, or refused=True if it did not fit in
+        the memory budget.
+
+        """
+        with self._lock:
+            fitting, victims = self._make_room(number)
+            base = [self.config_store.data['poppyPort'][k] for k in ('http', 'snap', 'ws')]
+            allocated = self.ports.allocate(base, fitting) if fitting else []
+
+        # each can take seconds to stop: not under the lock the other requests wait for
+        for bot in victims:
+            self._terminate(bot)
+
+        config = self.config_store.config
+        creature = config.robot.creature
+        logpattern = config.poppyLog.virtualBot
+        options = self.options
+
+        def launch(args):
+            nb, ports = args
+            logfile = logpattern.replace('.log', '_{}.log'.format(nb))
+            bot = self._launch(nb, ports, creature, logfile, options['readyTimeout'])
+            return {
+                'id': nb,
+                'ports': dict(zip(('http', 'snap', 'ws'), ports)),
+                'log': logfile,
+                'ready': bot is not None and bot.ready_time is not None,
+                'time': bot.ready_time if bot is not None else None,
+                'refused': False,
+            }
+
+        reports = []
+        if allocated:
+            pool = ThreadPool(max(1, min(int(options['concurrency']), len(allocated))))
+            try:
+                reports = pool.map(launch, allocated)
+            finally:
+                pool.close()
+
+        reports += [{'refused': True, 'ready': False} for _ in range(number - fitting)]
+        return reports
+
+    def scale_to(self, target):
+        """ Starts or stops (newest first) clones to have target of them. """
+        bots = self.bots
+        if target > len(bots):
+            return self.scale_up(target - len(bots))
+
+        for bot in sorted(bots, key=lambda bot: bot.started, reverse=True)[:len(bots) - target]:
+            self.stop(bot.id)
+        return []
+
+    def stop(self, nb, timeout=5.0):
+        bots = dict((bot.id, bot) for bot in self.bots)
+        if nb not in bots:
+            raise KeyError('No virtual bot #{}'.format(nb))
+        self._terminate(bots[nb], timeout)
+
+    def _terminate(self, bot, timeout=5.0):
+        bot.terminate(timeout)
+
+        with self._lock:
+            self._forget(bot)
+
+    def stop_all(self):
+        for bot in self.bots:
+            self.stop(bot.id)
@@ -0,0 +1,155 @@
+import json
+import time
+import asyncio
+
+from threading import RLock
+
+
+REGISTERS = ('present_position', )
+
+
+class HttpError(IOError):
+    pass
+
+
+async def http_get_json(host, port, path, timeout):
+    """ GET http://host:port/path and decode its JSON body, within timeout seconds. """
+    async def get():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write('GET {} HTTP/1.1\r\nHost: {}:{}\r\nConnection: close\r\n\r\n'.format(
+                path, host, port).encode())
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        head, _, body = response.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = lines[0].split()[1:2]
+        if status != ['200']:
+            raise HttpError('{} {}'.format(path, lines[0]))
+        headers = dict((k.strip().lower(), v.strip())
+                       for k, _, v in (line.partition(':') for line in lines[1:]))
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = _dechunk(body)
+        return json.loads(body.decode('utf-8'))
+
+    return await asyncio.wait_for(get(), timeout)
+
+
+def _dechunk(body):
+    data = b''
+    while body:
+        size, _, body = body.partition(b'\r\n')
+        size = int(size.split(b';')[0], 16)
+        if size == 0:
+            break
+        data, body = data + body[:size], body[size + 2:]
+    return data
+
+
+class FleetState(object):
+    """ State of every virtual bot, collected concurrently with asyncio.
+
+    The bots are queried in parallel, each within deadline seconds: a
+    stuck or slow one is reported as such without delaying the others.
+    pypot's REST server answers one request at a time, so each bot gets
+    at most per_bot requests at once (its motor list, then its registers). The
+    snapshot gives per bot its motor registers, health (ok, timeout,
+    error, or starting while it boots) and the latency of its collection.
+
+    A snapshot is shared by all the clients asking within max_age of it:
+    the callers arriving during a collection wait for it and get its result.
+
+    """
+    def __init__(self, fleet, host='localhost', deadline=1.0, registers=REGISTERS, per_bot=2):
+        self.fleet = fleet
+        self.host = host
+        self.deadline = deadline
+        self.registers = registers
+        self.per_bot = per_bot
+
+        self._lock = RLock()
+        self._snapshot = None
+        self._motors = {}
+
+    async def _collect_bot(self, bot):
+        port = bot['ports']['http']
+        key = (bot['id'], bot['pid'])
+
+        motors = self._motors.get(key)
+        if motors is None:
+            motors = (await http_get_json(self.host, port, '/motor/list.json', self.deadline))['motors']
+            self._motors[key] = motors
+
+        requests = asyncio.Semaphore(self.per_bot)
+
+        async def read(motor, register):
+            async with requests:
+                return await http_get_json(self.host, port, '/motor/{}/register/{}'.format(motor, register),
+                                           self.deadline)
+
+        reads = [(motor, register) for motor in motors for register in self.registers]
+        values = await asyncio.gather(*[read(motor, register) for motor, register in reads])
+
+        result = dict((motor, {}) for motor in motors)
+        for (motor, register), value in zip(reads, values):
+            result[motor][register] = value[register]
+        return result
+
+    async def _collect_one(self, bot):
+        start = time.time()
+        state = {'id': bot['id'], 'port': bot['ports']['http'], 'motors': {}, 'error': None}
+
+        try:
+            state['motors'] = await asyncio.wait_for(self._collect_bot(bot), self.deadline)
+            state['health'] = 'ok'
+        except asyncio.TimeoutError:
+            state['health'] = 'timeout'
+        except (IOError, OSError, ValueError, KeyError) as e:
+            # a bot which never got ready is still booting
+            state['health'] = 'error' if bot['ready_time'] is not None else 'starting'
+            state['error'] = str(e) or repr(e)
+            self._motors.pop((bot['id'], bot['pid']), None)
+
+        state['latency'] = time.time() - start
+        return state
+
+    async def _collect(self, bots):
+        return await asyncio.gather(*[self._collect_one(bot) for bot in bots])
+
+    def collect(self):
+        """ Queries all the bots now, returns the merged snapshot. """
+        bots = self.fleet.summary
+        live = set((bot['id'], bot['pid']) for bot in bots)
+        for key in list(self._motors):
+            if key not in live:
+                del self._motors[key]
+
+        start = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            states = loop.run_until_complete(self._collect(bots)) if bots else []
+        finally:
+            loop.close()
+
+        return {
+            'time': time.time(),
+            'duration': time.time() - start,
+            'instances': dict((str(state['id']), state) for state in states),
+        }
+
+    def snapshot(self, max_age=0.5):
+        """ A snapshot at most max_age seconds old. """
+        with self._lock:
+            if self._snapshot is None or time.time() - self._snapshot['time'] >= max_age:
+                self._snapshot = self.collect()
+            return self._snapshot
+
+    def stream(self, rate=1.0):
+        """ Generator of Server-Sent Events of the snapshots, rate times per second. """
+        period = 1.0 / rate
+        while True:
+            start = time.time()
+            yield 'data: {}\n\n'.format(json.dumps(self.snapshot(max_age=period / 2)))
+            time.sleep(max(0, period - (time.time() - start)))
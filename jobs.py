@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import uuid
+import signal
+import subprocess
+
+from threading import Thread, local
+
+from shared_state import pid_alive
+from metrics import SUBPROCESS_DURATION, command_name
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE = (QUEUED, RUNNING)
+
+DEFAULT_LOG_DIR = '/tmp/puppet-master-jobs'
+DEFAULT_LIMITS = {
+    'system': 1,
+    'robot': 1,
+    'fleet': 1,
+}
+
+_current = local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    """ Fails the job running, keeping result (the outcome of each of its items...). """
+    def __init__(self, message, result=None):
+        Exception.__init__(self, message)
+        self.result = result
+
+
+def current_job():
+    """ The Job run by the calling thread, None outside of a job. """
+    return getattr(_current, 'job', None)
+
+
+def tracked_call(cmd, **kwargs):
+    """ subprocess.call, in a job: logged to the job and killed if it is cancelled. """
+    job = current_job()
+    with SUBPROCESS_DURATION.time(command=command_name(cmd)):
+        if job is None:
+            return subprocess.call(cmd, **kwargs)
+        return job.call(cmd, **kwargs)
+
+
+def tracked_check_call(cmd, **kwargs):
+    returncode = tracked_call(cmd, **kwargs)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return 0
+
+
+class Job(object):
+    """ Handle of a job given to the thread running it. """
+    def __init__(self, runner, id, log):
+        self.runner = runner
+        self.id = id
+        self.log = log
+
+    @property
+    def cancelled(self):
+        record = self.runner.get(self.id)
+        return record is None or record['cancel']
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def write(self, msg):
+        with open(self.log, 'a') as f:
+            f.write(msg)
+
+    def call(self, cmd, stdout=None, stderr=None, **kwargs):
+        """ Runs cmd in its own session, its output going to the job log by default. """
+        self.check_cancelled()
+
+        with open(self.log, 'ab') as log:
+            if stdout is None:
+                stdout, stderr = log, subprocess.STDOUT if stderr is None else stderr
+            p = subprocess.Popen(cmd, stdout=stdout, stderr=stderr,
+                                 preexec_fn=os.setsid, **kwargs)
+
+        self.runner._update(self.id, lambda job: job['children'].append(p.pid))
+        try:
+            returncode = p.wait()
+        finally:
+            self.runner._update(self.id, lambda job: job['children'].remove(p.pid))
+
+        self.check_cancelled()
+        return returncode
+
+
+class JobRunner(object):
+    """ Runs the long operations as background jobs any server process can follow.
+
+    Each job has an id, a concurrency class (at most limits[class] jobs
+    of a class run at once, the others wait in submission order), timing,
+    exit status, and a log where the output of its subprocesses goes.
+    Submitting a job identical to one still queued or running returns the
+    latter. A job is cancelled by killing the sessions of its subprocesses
+    (see tracked_call), or before it starts.
+
+    Jobs are recorded in the 'jobs' key of a SharedState and run in a
+    thread of the process which submitted them.
+
+    """
+    def __init__(self, state, log_dir=DEFAULT_LOG_DIR, limits=None, history=50, poll=0.2):
+        self.state = state
+        self.log_dir = log_dir
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.history = history
+        self.poll = poll
+
+    def _update_jobs(self, func):
+        result = []
+
+        def apply(jobs):
+            result.append(func(jobs))
+            return jobs
+
+        self.state.update('jobs', apply, {})
+        return result[0]
+
+    def _update(self, id, func):
+        def apply(jobs):
+            if id in jobs:
+                func(jobs[id])
+        self._update_jobs(apply)
+
+    def _view(self, job):
+        if job['state'] in ACTIVE and not pid_alive(job['owner']):
+            # its process died (e.g. restarted worker)
+            job = dict(job, state=FAILED, error='server process exited')
+        return job
+
+    def get(self, id):
+        job = self.state.get('jobs', {}).get(id)
+        return self._view(job) if job is not None else None
+
+    def jobs(self):
+        jobs = [self._view(job) for job in self.state.get('jobs', {}).values()]
+        return sorted(jobs, key=lambda job: job['created'], reverse=True)
+
+    def submit(self, kind, func, args=(), concurrency='system'):
+        """ Starts func(*args) as a job, returns its record (or the identical active job's). """
+        key = json.dumps([kind, list(args)])
+
+        def create(jobs):
+            for job in jobs.values():
+                if job['key'] == key and self._view(job)['state'] in ACTIVE:
+                    return None, job
+
+            id = uuid.uuid4().hex[:12]
+            jobs[id] = {
+                'id': id,
+                'kind': kind,
+                'args': list(args),
+                'key': key,
+                'class': concurrency,
+                'state': QUEUED,
+                'owner': os.getpid(),
+                'children': [],
+                'cancel': False,
+                'log': os.path.join(self.log_dir, '{}.log'.format(id)),
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'duration': None,
+                'exit_code': None,
+                'error': None,
+                'result': None,
+            }
+            return id, jobs[id]
+
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        id, job = self._update_jobs(create)
+        if id is None:
+            return dict(job, deduplicated=True)
+
+        t = Thread(target=self._run, args=(Job(self, id, job['log']), func, args))
+        t.daemon = True
+        t.start()
+
+        return job
+
+    def _acquire(self, id):
+        """ Marks the job running if its class has a free slot and it is next in line. """
+        def acquire(jobs):
+            job = jobs[id]
+            if job['cancel']:
+                return False
+
+            same_class = [self._view(j) for j in jobs.values() if j['class'] == job['class']]
+            running = len([j for j in same_class if j['state'] == RUNNING])
+            first = min([j for j in same_class if j['state'] == QUEUED],
+                        key=lambda j: j['created'])
+
+            if running >= self.limits.get(job['class'], 1) or first['id'] != id:
+                return False
+
+            job['state'] = RUNNING
+            job['started'] = time.time()
+            return True
+
+        return self._update_jobs(acquire)
+
+    def _finish(self, id, state, **info):
+        def finish(jobs):
+            job = jobs[id]
+            job.update(info, state=state, finished=time.time(), children=[])
+            if job['started'] is not None:
+                job['duration'] = job['finished'] - job['started']
+
+            finished = sorted([j for j in jobs.values() if j['state'] not in ACTIVE],
+                              key=lambda j: j['finished'])
+            for old in finished[:max(0, len(finished) - self.history)]:
+                del jobs[old['id']]
+                if os.path.exists(old['log']):
+                    os.remove(old['log'])
+
+        self._update_jobs(finish)
+
+    def _run(self, job, func, args):
+        _current.job = job
+        try:
+            while not self._acquire(job.id):
+                if job.cancelled:
+                    self._finish(job.id, CANCELLED)
+                    return
+                time.sleep(self.poll)
+
+            try:
+                result = func(*args)
+            except JobCancelled:
+                self._finish(job.id, CANCELLED)
+            except subprocess.CalledProcessError as e:
+                self._finish(job.id, FAILED, exit_code=e.returncode, error=str(e))
+            except JobFailed as e:
+                self._finish(job.id, FAILED, error=str(e), result=e.result)
+            except Exception as e:
+                self._finish(job.id, FAILED, error=repr(e))
+            else:
+                try:
+                    json.dumps(result)
+                except (TypeError, ValueError):
+                    result = repr(result)
+                self._finish(job.id, SUCCEEDED, exit_code=0, result=result)
+        finally:
+            _current.job = None
+
+    def cancel(self, id):
+        """ Cancels a queued or running job, returns False if it was not active. """
+        def flag(jobs):
+            job = jobs.get(id)
+            if job is None or self._view(job)['state'] not in ACTIVE:
+                return None
+            job['cancel'] = True
+            return list(job['children'])
+
+        children = self._update_jobs(flag)
+        if children is None:
+            return False
+
+        for pid in children:
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        return True
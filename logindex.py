@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import heapq
+
+from array import array
+from threading import RLock
+
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+MAX_BYTES = 8 * 1024 * 1024
+
+# 'ERROR', '[ERROR]' (gunicorn) or '[E 12:00:00.000 NotebookApp]' (jupyter)
+_level = re.compile(r'^\[([DIWEC]) |\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b')
+_level_aliases = {'D': 'DEBUG', 'I': 'INFO', 'W': 'WARNING', 'WARN': 'WARNING',
+                  'E': 'ERROR', 'C': 'CRITICAL', 'FATAL': 'CRITICAL'}
+_timestamp = re.compile(r'(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})')
+_token = re.compile(r'\w+')
+_term = re.compile(r'(\w+)(\*?)')
+
+
+def level_number(name):
+    """ 1 (DEBUG) to 5 (CRITICAL) of a level name, 0 if unknown. """
+    name = _level_aliases.get(name.upper(), name.upper())
+    return LEVELS.index(name) + 1 if name in LEVELS else 0
+
+
+def parse_terms(query):
+    """ [(word, prefix)] of a query: its words (lower case), 'word*' matching the words starting with it. """
+    return [(word, bool(star)) for word, star in _term.findall(query.lower())]
+
+
+class _FileIndex(object):
+    """ Lines of a log with, per line, its time and level, and the lines of each word. """
+    def __init__(self, path):
+        self.path = path
+        self.reset(None)
+
+    def reset(self, inode, offset=0):
+        self.inode = inode
+        self.offset = offset
+        self.partial = offset > 0  # started in the middle of a line
+        self.indexed_bytes = 0
+
+        self.lines = []
+        self.times = array('d')
+        self.levels = bytearray()
+        self.words = {}
+
+    def update(self, max_bytes):
+        """ Indexes the lines appended to the file since the last update. """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.reset(None)
+            return
+
+        if st.st_ino != self.inode or st.st_size < self.offset or self.indexed_bytes > 2 * max_bytes:
+            # new, truncated (rotated) or grown too much: index (the end of) it again
+            self.reset(st.st_ino, max(0, st.st_size - max_bytes))
+        if st.st_size == self.offset:
+            return
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+
+        start = data.find(b'\n') + 1 if self.partial else 0
+        end = data.rfind(b'\n') + 1
+        if end <= start:
+            return  # no complete line yet
+
+        self.partial = False
+        self.offset += end
+        self.indexed_bytes += end - start
+        self._add(data[start:end].decode('utf-8', 'replace').split('\n')[:-1], st.st_mtime)
+
+    def _add(self, lines, mtime):
+        # a line without a timestamp of its own takes the time the file was modified at, when
+        # it was indexed, and one without level either (a traceback...) those of the line before
+        last_time = self.times[-1] if self.times else mtime
+        last_level = self.levels[-1] if self.levels else 0
+        last_stamp = None
+
+        for text in lines:
+            stamp = _timestamp.search(text)
+            level = _level.search(text)
+            if stamp is not None:
+                # consecutive lines mostly share their second
+                if stamp.groups() != last_stamp:
+                    last_stamp = stamp.groups()
+                    try:
+                        stamp_time = time.mktime(time.strptime(' '.join(last_stamp), '%Y-%m-%d %H:%M:%S'))
+                    except ValueError:
+                        stamp_time = mtime
+                line_time = stamp_time
+            else:
+                line_time = mtime if level is not None else last_time
+
+            if level is not None:
+                line_level = level_number(level.group(1) or level.group(2))
+            else:
+                line_level = 0 if stamp is not None else last_level
+
+            n = len(self.lines)
+            self.lines.append(text)
+            self.times.append(line_time)
+            self.levels.append(line_level)
+            for word in set(_token.findall(text.lower())):
+                if word not in self.words:
+                    self.words[word] = array('I')
+                self.words[word].append(n)
+
+            last_time, last_level = line_time, line_level
+
+    def candidates(self, terms):
+        """ Numbers of the lines holding all the terms (all the lines without terms). """
+        if not terms:
+            return range(len(self.lines))
+        if len(terms) == 1 and not terms[0][1]:
+            return self.words.get(terms[0][0], ())
+
+        result = None
+        for word, prefix in terms:
+            if prefix:
+                lines = set()
+                for w, postings in self.words.items():
+                    if w.startswith(word):
+                        lines.update(postings)
+            else:
+                lines = set(self.words.get(word, ()))
+            result = lines if result is None else result & lines
+            if not result:
+                return []
+        return sorted(result)
+
+
+class LogIndex(object):
+    """ Full-text index of logs, maintained incrementally.
+
+    Each log is read once: an update only indexes the lines appended to
+    it since the previous one (up to its last complete line), and indexes
+    it again if it was truncated or rotated. Per log, the index keeps its
+    lines with their time and level, parsed from the usual formats, and
+    the numbers of the lines each word appears in, so that a search only
+    looks at the lines holding its words.
+
+    Only the last max_bytes of a log are indexed (LogManager rotates them
+    well before).
+
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+
+        self._files = {}
+        self._lock = RLock()
+
+    def update(self, logs):
+        """ Indexes what was appended to logs ({name: path}). """
+        with self._lock:
+            for path in logs.values():
+                if path not in self._files:
+                    self._files[path] = _FileIndex(path)
+                self._files[path].update(self.max_bytes)
+
+    def search(self, logs, query='', since=None, until=None, level=None, context=2, limit=100):
+        """ Lines of logs ({name: path}) matching query, newest first.
+
+        A line matches when it holds all the words of query ('word*'
+        matches the words starting with word), its time is between since
+        and until and its level is at least level. Each match comes with
+        context lines before and after it.
+
+        """
+        start = time.time()
+        terms = parse_terms(query)
+        min_level = level_number(level) if level else 0
+
+        filtered = since is not None or until is not None or min_level
+
+        with self._lock:
+            self.update(logs)
+
+            total, found = 0, []
+            for name, path in logs.items():
+                index = self._files[path]
+                candidates = index.candidates(terms)
+                if not filtered:
+                    # the lines of a log are (mostly) in time order: its newest matches are its last ones
+                    total += len(candidates)
+                    candidates = candidates[-limit:] if limit else []
+
+                for n in candidates:
+                    if since is not None and index.times[n] < since:
+                        continue
+                    if until is not None and index.times[n] > until:
+                        continue
+                    if index.levels[n] < min_level:
+                        continue
+                    found.append((index.times[n], n, name))
+                    total += 1 if filtered else 0
+
+            matches = []
+            for line_time, n, name in heapq.nlargest(limit, found):
+                index = self._files[logs[name]]
+                matches.append({
+                    'log': name,
+                    'line': n + 1,
+                    'time': line_time,
+                    'level': LEVELS[index.levels[n] - 1] if index.levels[n] else None,
+                    'text': index.lines[n],
+                    'before': index.lines[max(0, n - context):n],
+                    'after': index.lines[n + 1:n + 1 + context],
+                })
+
+        return {
+            'matches': matches,
+            'total': total,
+            'logs': sorted(logs),
+            'took': time.time() - start,
+        }
@@ -0,0 +1,286 @@
+import os
+import time
+import json
+import gzip
+import errno
+import ctypes
+import ctypes.util
+
+from threading import Thread, RLock
+
+from config import atomic_write
+
+
+DEFAULTS = {
+    'archive': '/tmp/poppy-logs',
+    'maxSize': 1024 * 1024,
+    'maxAge': 7 * 24 * 3600,
+    'maxTotalSize': 20 * 1024 * 1024,
+}
+
+
+FALLOC_FL_COLLAPSE_RANGE = 0x08
+COPY_CHUNK = 64 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = getattr(_libc, 'fallocate64', None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+
+def collapse_head(f, length):
+    """ Removes the first length bytes of file f in place, atomically for its writers.
+
+    Only some filesystems (ext4, xfs) support it, for a length multiple
+    of their block size: returns False otherwise.
+
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    if _fallocate(f.fileno(), FALLOC_FL_COLLAPSE_RANGE, 0, length) == 0:
+        return True
+    if ctypes.get_errno() not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+        raise OSError(ctypes.get_errno(), 'fallocate failed on {}'.format(f.name))
+    return False
+
+
+def _copy(src, dst, length):
+    while length > 0:
+        data = src.read(min(COPY_CHUNK, length))
+        if not data:
+            break
+        dst.write(data)
+        length -= len(data)
+
+
+class LogManager(object):
+    """ Bounded, rotating archive of the logs of poppy-services runs.
+
+    Each run of a managed log (the daemon or a virtual bot) is recorded in
+    an index with its start/stop times. When a run starts, what the log
+    still holds from the previous run is gzipped into the archive instead
+    of being overwritten. While a run is going, the log is rotated (copied
+    to a gzipped segment, then truncated) as soon as it grows over maxSize,
+    so the processes writing to it must open it in append mode.
+
+    Archived segments older than maxAge are removed, then the oldest ones
+    until the archive fits in maxTotalSize.
+
+    """
+    _managers = {}
+    _managers_lock = RLock()
+
+    def __init__(self, archive, maxSize, maxAge, maxTotalSize, check_interval=10.0):
+        self.archive = os.path.abspath(archive)
+        self.max_size = int(maxSize)
+        self.max_age = float(maxAge)
+        self.max_total_size = int(maxTotalSize)
+        self.check_interval = check_interval
+
+        self.index_file = os.path.join(self.archive, 'runs.json')
+
+        self._lock = RLock()
+        self._watched = set()
+        self._thread = None
+
+        if not os.path.exists(self.archive):
+            os.makedirs(self.archive)
+
+    @classmethod
+    def from_config(cls, config):
+        """ Returns the manager of a config's poppyLog section (shared per archive). """
+        options = dict(DEFAULTS)
+        options.update((k, v) for k, v in config.poppyLog.as_dict().items() if k in DEFAULTS)
+
+        archive = os.path.abspath(options['archive'])
+        with cls._managers_lock:
+            if archive not in cls._managers:
+                cls._managers[archive] = cls(**options)
+            return cls._managers[archive]
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return []
+
+    def _save_index(self, runs):
+        atomic_write(self.index_file, json.dumps(runs, indent=1))
+
+    @property
+    def runs(self):
+        with self._lock:
+            return self._load_index()
+
+    def _last_run(self, runs, logfile):
+        for run in reversed(runs):
+            if run['log'] == logfile:
+                return run
+
+    def _archive_segment(self, logfile, run, live=True):
+        """ Moves the content of logfile to a new gzipped segment of run.
+
+        While its process is running (live), what it writes during the
+        archiving must stay in the log: the archived bytes are collapsed
+        out of the file where the filesystem allows it, whole blocks at a
+        time, the rest staying in the log. Elsewhere the bytes appended
+        during the compression are put back after the truncation, which
+        leaves a window of a few microseconds instead of the whole
+        compression.
+
+        """
+        if not os.path.exists(logfile) or os.path.getsize(logfile) == 0:
+            return
+
+        name, _ = os.path.splitext(os.path.basename(logfile))
+        run['rotations'] = run.get('rotations', 0) + 1
+        segment = '{}.{}.{}.log.gz'.format(name, run['id'], run['rotations'])
+        path = os.path.join(self.archive, segment)
+
+        with open(logfile, 'r+b') as f:
+            st = os.fstat(f.fileno())
+            length = st.st_size
+            collapsible = live and _fallocate is not None and st.st_size >= st.st_blksize
+            if collapsible:
+                length -= st.st_size % st.st_blksize
+
+            with gzip.open(path + '.tmp', 'wb') as dst:
+                _copy(f, dst, length)
+            os.rename(path + '.tmp', path)
+
+            if not (collapsible and collapse_head(f, length)):
+                f.seek(length)
+                tail = f.read() if live else b''
+                f.truncate(0)
+                if tail:
+                    # appended, as the process may have written to the file since the truncation
+                    with open(logfile, 'ab') as log:
+                        log.write(tail)
+
+        run['segments'].append(segment)
+
+    def start_run(self, logfile):
+        """ Archives what logfile holds from a previous run and opens a new run. """
+        logfile = os.path.abspath(logfile)
+
+        with self._lock:
+            runs = self._load_index()
+
+            previous = self._last_run(runs, logfile)
+            if previous is None and os.path.exists(logfile):
+                previous = {'id': 'unknown-{}'.format(int(time.time())),
+                            'log': logfile, 'start': None, 'stop': None,
+                            'segments': []}
+                runs.append(previous)
+            if previous is not None:
+                if previous['stop'] is None and os.path.exists(logfile):
+                    previous['stop'] = os.path.getmtime(logfile)
+                # its process is gone: archive all of it
+                self._archive_segment(logfile, previous, live=False)
+
+            now = time.time()
+            runs.append({
+                'id': '{}-{:03d}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                                         int(now * 1000) % 1000),
+                'log': logfile,
+                'start': now,
+                'stop': None,
+                'segments': [],
+            })
+
+            self._enforce_limits(runs)
+            self._save_index(runs)
+
+        self.watch(logfile)
+
+    def stop_run(self, logfile):
+        logfile = os.path.abspath(logfile)
+
+        with self._lock:
+            runs = self._load_index()
+            run = self._last_run(runs, logfile)
+            if run is not None and run['stop'] is None:
+                run['stop'] = time.time()
+                self._save_index(runs)
+
+        self.unwatch(logfile)
+
+    def rotate_if_needed(self, logfile):
+        logfile = os.path.abspath(logfile)
+
+        try:
+            if os.path.getsize(logfile) <= self.max_size:
+                return False
+        except OSError:
+            return False
+
+        with self._lock:
+            runs = self._load_index()
+            run = self._last_run(runs, logfile)
+            if run is None:
+                return False
+
+            self._archive_segment(logfile, run)
+            self._enforce_limits(runs)
+            self._save_index(runs)
+
+        return True
+
+    def _enforce_limits(self, runs):
+        segments = []
+        for run in runs:
+            for segment in run['segments']:
+                path = os.path.join(self.archive, segment)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                segments.append((st.st_mtime, st.st_size, segment))
+        segments.sort()
+
+        now = time.time()
+        total = sum(size for _, size, _ in segments)
+        removed = set()
+        for mtime, size, segment in segments:
+            if now - mtime <= self.max_age and total <= self.max_total_size:
+                break
+            os.remove(os.path.join(self.archive, segment))
+            removed.add(segment)
+            total -= size
+
+        for run in runs:
+            run['segments'] = [s for s in run['segments']
+                               if s not in removed and
+                               os.path.exists(os.path.join(self.archive, s))]
+        runs[:] = [run for run in runs
+                   if run['segments'] or run['stop'] is None or
+                   now - run['stop'] <= self.max_age]
+
+    def watch(self, logfile):
+        """ Checks logfile size every check_interval and rotates it when needed. """
+        with self._lock:
+            self._watched.add(os.path.abspath(logfile))
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._watch_loop)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def unwatch(self, logfile):
+        with self._lock:
+            self._watched.discard(os.path.abspath(logfile))
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+
+            with self._lock:
+                watched = list(self._watched)
+            for logfile in watched:
+                try:
+                    self.rotate_if_needed(logfile)
+                except (IOError, OSError):
+                    pass
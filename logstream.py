@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from threading import Thread, Lock, Event
+
+from logtail import read_tail, parse_cursor
+
+if sys.version_info < (3, 0):
+    from Queue import Queue, Empty, Full
+else:
+    from queue import Queue, Empty, Full
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_event_header = struct.Struct('iIII')
+
+
+class InotifyWaiter(object):
+    """ Waits for changes of a file through inotify on its directory.
+
+    Watching the directory (rather than the file) also reports the file
+    being created, rotated or deleted.
+
+    """
+    def __init__(self, filename):
+        self.basename = os.path.basename(filename).encode()
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE |
+                IN_MOVED_FROM | IN_MOVED_TO)
+        dirname = os.path.dirname(os.path.abspath(filename)).encode()
+        if libc.inotify_add_watch(self.fd, dirname, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed on {}'.format(dirname))
+
+    def wait(self, timeout):
+        """ Returns True if the file changed within timeout seconds. """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return False
+            raise
+
+        i = 0
+        while i + _event_header.size <= len(buf):
+            _, _, _, length = _event_header.unpack_from(buf, i)
+            i += _event_header.size
+            name = buf[i:i + length].rstrip(b'\0')
+            i += length
+            if name == self.basename:
+                return True
+        return False
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StatWaiter(object):
+    """ Fallback for platforms without inotify: polls the file stat. """
+    def __init__(self, filename, poll_interval=0.5):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.filename)
+            return (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            signature = self._stat()
+            if signature != self._signature:
+                self._signature = signature
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self):
+        pass
+
+
+def make_waiter(filename):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWaiter(filename)
+        except (OSError, AttributeError):
+            pass
+    return StatWaiter(filename)
+
+
+class LogWatcher(Thread):
+    """ Single reader of a log file, fanning appended chunks out to subscribers.
+
+    Each subscriber gets its own bounded queue of chunks (dicts as returned
+    by read_tail). A subscriber too slow to empty its queue is not queued
+    more memory: its queue is flushed and it receives a None marker telling
+    it to resync from its own cursor.
+
+    Watchers are shared per file (see subscribe_to) and stop with their last
+    subscriber.
+
+    """
+    _watchers = {}
+    _watchers_lock = Lock()
+
+    def __init__(self, filename, queue_size=64):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.filename = filename
+        self.queue_size = queue_size
+
+        self._subscribers = []
+        self._notify = {}
+        self._lock = Lock()
+        self._stop_event = Event()
+
+        self.cursor = read_tail(filename)['cursor']
+
+    @classmethod
+    def subscribe_to(cls, filename, notify=None):
+        """ Returns the (watcher, queue) of a new subscriber to filename. """
+        filename = os.path.abspath(filename)
+
+        with cls._watchers_lock:
+            watcher = cls._watchers.get(filename)
+            if watcher is None or not watcher.is_alive():
+                watcher = cls(filename)
+                watcher.start()
+                cls._watchers[filename] = watcher
+            return watcher, watcher.subscribe(notify)
+
+    def subscribe(self, notify=None):
+        """ Returns the queue of a new subscriber, setting the notify event (if any) on each chunk. """
+        q = Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.append(q)
+            if notify is not None:
+                self._notify[q] = notify
+        return q
+
+    def unsubscribe(self, q):
+        with LogWatcher._watchers_lock:
+            with self._lock:
+                if q in self._subscribers:
+                    self._subscribers.remove(q)
+                self._notify.pop(q, None)
+                if self._subscribers:
+                    return
+            self._stop_event.set()
+            if LogWatcher._watchers.get(self.filename) is self:
+                del LogWatcher._watchers[self.filename]
+
+    def _publish(self, chunk):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            notify = list(self._notify.values())
+
+        for q in subscribers:
+            try:
+                q.put_nowait(chunk)
+            except Full:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except Empty:
+                        break
+                q.put_nowait(None)
+
+        for event in notify:
+            event.set()
+
+    def run(self):
+        waiter = make_waiter(self.filename)
+        try:
+            while not self._stop_event.is_set():
+                if not waiter.wait(1.0):
+                    continue
+
+                chunk = read_tail(self.filename, self.cursor)
+                self.cursor = chunk['cursor']
+                if chunk['data'] or chunk['reset']:
+                    self._publish(chunk)
+        finally:
+            waiter.close()
+
+
+def _sse(chunk):
+    return 'id: {}\ndata: {}\n\n'.format(chunk['cursor'], json.dumps({
+        'data': chunk['data'],
+        'reset': chunk['reset'],
+        'exists': chunk['exists'],
+    }))
+
+
+class _Follower(object):
+    """ What a client has of a log (its cursor), and the chunks to send it next. """
+    def __init__(self, filename, cursor):
+        self.filename = filename
+        self.cursor = cursor
+
+    def read(self):
+        """ The chunk appended since cursor (the last part of the file without cursor). """
+        chunk = read_tail(self.filename, self.cursor)
+        self.cursor = chunk['cursor']
+        return chunk
+
+    def next(self, chunk):
+        """ The chunk to send for a chunk of the watcher (None for a resync marker), or None. """
+        inode, offset = parse_cursor(self.cursor)
+        if chunk is not None:
+            chunk_inode, end = parse_cursor(chunk['cursor'])
+            if chunk_inode == inode and end <= offset and not chunk['reset']:
+                return None  # already sent by the initial read
+            if chunk['reset'] or (chunk_inode == inode and chunk['offset'] == offset):
+                self.cursor = chunk['cursor']
+                return chunk
+
+        # lagging or out of step with the watcher: resync from our cursor
+        chunk = self.read()
+        return chunk if chunk['data'] or chunk['reset'] else None
+
+
+def stream_log(filename, cursor=None, keepalive=15.0):
+    """ Generator of Server-Sent Events for what is appended to filename.
+
+    Starts from cursor (typically the Last-Event-ID sent by a reconnecting
+    EventSource) or from the last part of the file, and uses the cursor of each
+    chunk as the event id.
+
+    """
+    watcher, q = LogWatcher.subscribe_to(filename)
+    follower = _Follower(filename, cursor)
+
+    try:
+        yield _sse(follower.read())
+
+        while True:
+            try:
+                chunk = q.get(timeout=keepalive)
+            except Empty:
+                yield ': keepalive\n\n'
+                continue
+
+            chunk = follower.next(chunk)
+            if chunk is not None:
+                yield _sse(chunk)
+    finally:
+        watcher.unsubscribe(q)
+
+
+def format_cursors(cursors):
+    """ Event id of the cursors of several logs ({name: cursor}). """
+    return '&'.join('{}={}'.format(name, cursor) for name, cursor in sorted(cursors.items()) if cursor)
+
+
+def parse_cursors(value):
+    """ {name: cursor} of an event id of format_cursors. """
+    return dict(item.split('=', 1) for item in (value or '').split('&') if '=' in item)
+
+
+def multiplex_logs(files, cursors=None, keepalive=15.0):
+    """ Generator of (name, Server-Sent Event) for what is appended to several logs ({name: filename}).
+
+    All the logs share one connection: the events are named after their
+    log, and their id holds the cursors of every log, so that a
+    reconnecting EventSource resumes each of them (cursors, typically
+    parsed from its Last-Event-ID). Keepalives have no name.
+
+    """
+    cursors = cursors or {}
+    notify = Event()
+    followers, subscriptions = {}, {}
+    try:
+        for name, filename in files.items():
+            followers[name] = _Follower(filename, cursors.get(name))
+            subscriptions[name] = LogWatcher.subscribe_to(filename, notify)
+
+        # the cursors of what was sent, for the ids
+        sent = dict((name, cursors.get(name)) for name in files)
+
+        def event(name, chunk):
+            sent[name] = chunk['cursor']
+            return name, 'event: {}\n{}'.format(name, _sse(dict(chunk, cursor=format_cursors(sent))))
+
+        chunks = [(name, follower.read()) for name, follower in sorted(followers.items())]
+        for name, chunk in chunks:
+            yield event(name, chunk)
+
+        while True:
+            if not notify.wait(keepalive):
+                yield None, ': keepalive\n\n'
+                continue
+            notify.clear()
+
+            for name, (_, q) in sorted(subscriptions.items()):
+                while True:
+                    try:
+                        chunk = q.get_nowait()
+                    except Empty:
+                        break
+                    chunk = followers[name].next(chunk)
+                    if chunk is not None:
+                        yield event(name, chunk)
+    finally:
+        for watcher, q in subscriptions.values():
+            watcher.unsubscribe(q)
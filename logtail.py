@@ -0,0 +1,81 @@
+import os
+
+
+TAIL_MAX_BYTES = 64 * 1024
+
+
+def format_cursor(inode, offset):
+    return '{}:{}'.format(inode, offset)
+
+
+def parse_cursor(cursor):
+    """ Parses an 'inode:offset' cursor, returns (None, 0) if absent or invalid. """
+    try:
+        inode, offset = cursor.split(':')
+        return int(inode), max(int(offset), 0)
+    except (AttributeError, ValueError):
+        return None, 0
+
+
+def _utf8_safe_end(data):
+    """ Number of bytes of data that do not end in the middle of a utf-8 char. """
+    for i in range(1, min(4, len(data)) + 1):
+        byte = bytearray(data[-i:])[0]
+        if byte & 0xC0 == 0x80:
+            continue  # continuation byte, keep looking for the lead byte
+        if byte & 0x80 == 0:
+            return len(data)
+        needed = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4
+        return len(data) - i if i < needed else len(data)
+    return len(data)
+
+
+def read_tail(filename, cursor=None, max_bytes=TAIL_MAX_BYTES):
+    """ Reads what was appended to filename since cursor.
+
+    Returns a dict with the new text (data), the byte offset it starts at,
+    the cursor to send next time and a reset flag telling the client to
+    drop what it already has: the file was truncated or rotated (its inode
+    changed), or the client is more than max_bytes behind and only gets
+    the end of the file.
+
+    Without a cursor only the last max_bytes of the file are sent. A
+    missing file is reported with exists=False and an empty cursor.
+
+    """
+    inode, offset = parse_cursor(cursor)
+
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return {'data': '', 'offset': 0, 'cursor': '',
+                'reset': cursor is not None, 'exists': False}
+
+    with f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+
+        reset = False
+        if inode != st.st_ino or offset > size:
+            reset = True
+            offset = 0 if inode is not None else max(size - max_bytes, 0)
+        if size - offset > max_bytes:
+            reset = True
+            offset = size - max_bytes
+
+        f.seek(offset)
+        data = f.read(size - offset)
+
+    if reset and offset > 0:
+        # do not start the text in the middle of a line
+        skip = data.find(b'\n') + 1
+        offset, data = offset + skip, data[skip:]
+    data = data[:_utf8_safe_end(data)]
+
+    return {
+        'data': data.decode('utf-8', 'replace'),
+        'offset': offset,
+        'cursor': format_cursor(st.st_ino, offset + len(data)),
+        'reset': reset,
+        'exists': True,
+    }
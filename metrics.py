@@ -0,0 +1,316 @@
+import os
+import time
+import bisect
+
+from threading import Thread, Lock, RLock
+from contextlib import contextmanager
+
+from shared_state import pid_alive
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+# entry of the 'metrics' shared key adding up the last values of the processes gone
+RETIRED = 'retired'
+
+
+def command_name(cmd):
+    """ Label of a command line: its program, and the one it runs for sudo or python. """
+    words = [os.path.basename(str(w)) for w in cmd[:2]]
+    if len(words) > 1 and (words[0] == 'sudo' or words[0].startswith('python')):
+        return ' '.join(words)
+    return words[0] if words else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def reset(self):
+        self._values = {}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry._record():
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, values, other):
+        for key, value in other:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def lines(self, values):
+        for key, value in sorted(values.items()):
+            yield '{}{} {}'.format(self.name, _format_labels(self.labels, key),
+                                   _format_value(value))
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.registry._record():
+            counts = self._values.get(key)
+            if counts is None:
+                # per bucket counts (not cumulative), +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def merge(self, values, other):
+        for key, counts in other:
+            key = tuple(key)
+            if key not in values:
+                values[key] = list(counts)
+            else:
+                values[key] = [a + b for a, b in zip(values[key], counts)]
+
+    def lines(self, values):
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name,
+                                              _format_labels(self.labels, key,
+                                                             [('le', _format_value(float(bound)))]),
+                                              cumulative)
+            labels = _format_labels(self.labels, key)
+            yield '{}_sum{} {}'.format(self.name, labels, _format_value(counts[-1]))
+            yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class Gauge(Metric):
+    """ Value computed at scrape time by func(), a number or {label values: number}. """
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help, func, labels=()):
+        Metric.__init__(self, registry, name, help, labels)
+        self.func = func
+
+    def lines(self, values):
+        try:
+            value = self.func()
+        except Exception:
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for key, v in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key, )
+            yield '{}{} {}'.format(self.name, _format_labels(self.labels, key), _format_value(v))
+
+
+class Registry(object):
+    """ Counters and histograms of the server, exported in the Prometheus text format.
+
+    Recording a value only takes a lock and a dict update. With a
+    SharedState (see share), each server process publishes its values in
+    the 'metrics' key every interval seconds (if they changed) and at
+    each scrape, and the scrape adds up the values of the live processes:
+    any worker of the production server answers for the whole server.
+    Gauges are computed by the process answering the scrape.
+
+    The last values published by a process are kept once it is gone (a
+    worker recycled...), added up with those of the other dead processes,
+    so that the counters never go down. The values recorded before a fork
+    are dropped by the child, the parent still reports them. The thread publishing them is only started
+    by start(), to be called once forked.
+
+    """
+    def __init__(self):
+        self.metrics = []
+        self.state = None
+        self.interval = 5.0
+
+        self._lock = RLock()
+        self._pid = os.getpid()
+        self._changes = 0
+        self._published = None
+        self._publisher = None
+        self._publish_lock = Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help, labels, buckets))
+
+    def gauge(self, name, help, func, labels=()):
+        return self._add(Gauge(self, name, help, func, labels))
+
+    def _add(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def share(self, state, interval=5.0):
+        """ Aggregates the metrics of the processes using state. """
+        self.state = state
+        self.interval = interval
+
+    @contextmanager
+    def _record(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._lock:
+            self._changes += 1
+            yield
+
+    def _after_fork(self):
+        self._lock = RLock()
+        self._publish_lock = Lock()
+        self._pid = os.getpid()
+        self._changes = 0
+        self._published = None
+        self._publisher = None
+        for metric in self.metrics:
+            metric.reset()
+
+    def start(self):
+        """ Publishes the values of this process every interval, from a thread (if shared). """
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._lock:
+            if self.state is None or self._publisher is not None:
+                return
+            self._publisher = Thread(target=self._publish_loop)
+            self._publisher.daemon = True
+        self._publisher.start()
+
+    def _publish_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except Exception:
+                pass
+
+    def snapshot(self):
+        with self._lock:
+            return dict((m.name, [[list(k), v] for k, v in m._values.items()])
+                        for m in self.metrics if m.kind != 'gauge')
+
+    def publish(self):
+        """ Stores the values of this process in the shared state, if they changed. """
+        if self.state is None:
+            return
+
+        with self._publish_lock:
+            changes = self._changes
+            if changes == self._published:
+                return
+            snapshot = self.snapshot()
+            pid = str(os.getpid())
+
+            def put(processes):
+                processes = self._retire(processes)
+                processes[pid] = snapshot
+                return processes
+
+            self.state.update('metrics', put, {})
+            self._published = changes
+
+    def _retire(self, processes):
+        """ processes ({pid: snapshot}) with the snapshots of the dead ones folded into RETIRED. """
+        dead = [p for p in processes if p != RETIRED and not pid_alive(int(p))]
+        if not dead:
+            return processes
+
+        processes = dict(processes)
+        retired = processes.get(RETIRED, {})
+        folded = {}
+        for m in self.metrics:
+            if m.kind == 'gauge':
+                continue
+            values = {}
+            for snapshot in [retired] + [processes[p] for p in dead]:
+                m.merge(values, snapshot.get(m.name, []))
+            folded[m.name] = [[list(k), v] for k, v in values.items()]
+
+        for p in dead:
+            del processes[p]
+        processes[RETIRED] = folded
+        return processes
+
+    def _collect(self):
+        """ {metric name: {label values: value}} of all the processes, alive or gone. """
+        if self.state is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.publish()
+            processes = self.state.get('metrics', {})
+            if self._retire(processes) is not processes:
+                processes = self.state.update('metrics', self._retire, {})
+            snapshots = list(processes.values())
+
+        values = dict((m.name, {}) for m in self.metrics)
+        for snapshot in snapshots:
+            for m in self.metrics:
+                if m.kind != 'gauge' and m.name in snapshot:
+                    m.merge(values[m.name], snapshot[m.name])
+        return values
+
+    def render(self):
+        """ All the metrics in the Prometheus text exposition format. """
+        values = self._collect()
+
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.help))
+            lines.append('# TYPE {} {}'.format(m.name, m.kind))
+            lines.extend(m.lines(values[m.name]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+SUBPROCESS_DURATION = REGISTRY.histogram(
+    'puppet_master_subprocess_duration_seconds',
+    'Duration of the commands run by the server.',
+    ['command'], buckets=COMMAND_BUCKETS)
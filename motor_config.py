@@ -0,0 +1,105 @@
+import sys
+import json
+import time
+import subprocess
+
+from config import atomic_write
+
+
+TOOL = 'poppy-configure'
+
+
+def _tool_entry_point():
+    """ The function behind the poppy-configure command, None if it cannot be imported. """
+    try:
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group='console_scripts', name=TOOL)
+        else:
+            eps = [ep for ep in eps.get('console_scripts', []) if ep.name == TOOL]
+    except ImportError:
+        import pkg_resources
+        eps = pkg_resources.iter_entry_points('console_scripts', TOOL)
+
+    for ep in eps:
+        try:
+            return ep.load()
+        except Exception:
+            return None
+    return None
+
+
+def _run_in_process(main, creature, motor):
+    argv = sys.argv
+    sys.argv = [TOOL, creature, motor]
+    try:
+        main()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError('{} exited with {}'.format(TOOL, e.code))
+    finally:
+        sys.argv = argv
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def _run_subprocess(creature, motor):
+    subprocess.check_call([TOOL, creature, motor])
+
+
+def configure(creature, motors):
+    """ Configures motors one after the other, returns [{motor, ok, duration, error}].
+
+    The poppy-configure tool is run inside this process when it can be
+    imported, so pypot, the creature and the serial ports are loaded and
+    discovered once for the whole batch instead of once per motor.
+    A failed motor does not stop the batch.
+
+    """
+    main = _tool_entry_point()
+
+    results = []
+    for motor in motors:
+        print('=== Configuring {} ==='.format(motor))
+        sys.stdout.flush()
+
+        start = time.time()
+        error = None
+        try:
+            if main is not None:
+                _run_in_process(main, creature, motor)
+            else:
+                _run_subprocess(creature, motor)
+        except Exception as e:
+            error = str(e) or repr(e)
+
+        results.append({
+            'motor': motor,
+            'ok': error is None,
+            'duration': time.time() - start,
+            'error': error,
+        })
+        print('=== {}: {} ({:.1f}s) ==='.format(motor, 'OK' if error is None else 'FAILED: ' + error,
+                                               results[-1]['duration']))
+        sys.stdout.flush()
+
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Configure several motors in a row')
+    parser.add_argument('creature', type=str,
+                        help='creature, as given to poppy-configure (e.g. ergo-jr)')
+    parser.add_argument('motors', type=str, nargs='+')
+    parser.add_argument('--results', type=str,
+                        help='where to write the per motor results (JSON)')
+    args = parser.parse_args()
+
+    results = configure(args.creature, args.motors)
+    if args.results:
+        atomic_write(args.results, json.dumps(results))
+
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
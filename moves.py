@@ -0,0 +1,386 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import fcntl
+import tempfile
+
+from array import array
+from threading import RLock
+from contextlib import contextmanager
+
+from config import atomic_write
+
+
+DEFAULT_PATH = os.path.expanduser('~/.local/share/puppet-master/moves')
+
+MAGIC = b'PMOVE1\n'
+ENCODINGS = ('float32', 'delta')
+BLOCK_SIZE = 250
+
+_valid_name = re.compile(r'^[\w\-. ]+$')
+
+
+def _pack(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack(typecode, data):
+    a = array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tolist()
+
+
+def _encode_series(series, encoding, resolution):
+    """ Bytes of the values of a motor: float32, or quantised to resolution as int32 then int16 deltas. """
+    if encoding == 'float32':
+        return _pack('f', series)
+
+    q = [int(round(v / resolution)) for v in series]
+    deltas = [b - a for a, b in zip(q, q[1:])]
+    if any(d < -32768 or d > 32767 for d in deltas):
+        raise OverflowError('step too large for the delta encoding')
+    return _pack('i', q[:1]) + _pack('h', deltas)
+
+
+def _decode_series(data, encoding, resolution):
+    if encoding == 'float32':
+        return _unpack('f', data)
+
+    first, deltas = _unpack('i', data[:4])[0], _unpack('h', data[4:])
+    values, q = [first * resolution], first
+    for d in deltas:
+        q += d
+        values.append(q * resolution)
+    return values
+
+
+def from_pypot(data):
+    """ Move dict (framerate, timestamps, positions and speeds per motor) of a pypot Move JSON.
+
+    Raises ValueError if data is not shaped like one: positions must map
+    timestamps to {motor: position or [position, speed]} frames.
+
+    """
+    positions = data.get('positions') if isinstance(data, dict) else None
+    if not isinstance(positions, dict) or not all(isinstance(frame, dict) for frame in positions.values()):
+        raise ValueError('Not a pypot move: positions must map timestamps to frames')
+
+    try:
+        return _from_pypot(float(data.get('framerate', 50.0)), positions)
+    except (TypeError, IndexError) as e:
+        raise ValueError('Not a pypot move: {}'.format(e))
+
+
+def _from_pypot(framerate, frames):
+    timed = sorted(((float(t), frame) for t, frame in frames.items()), key=lambda item: item[0])
+    motors = sorted(set(m for _, frame in timed for m in frame))
+
+    positions = dict((m, []) for m in motors)
+    speeds = dict((m, []) for m in motors)
+    has_speeds = False
+    for _, frame in timed:
+        for m in motors:
+            value = frame.get(m)
+            if isinstance(value, (list, tuple)):
+                position, speed = value[0], value[1] if len(value) > 1 else 0.0
+                has_speeds = has_speeds or len(value) > 1
+            elif value is None:
+                # not recorded in this frame: hold the previous value
+                position = positions[m][-1] if positions[m] else 0.0
+                speed = speeds[m][-1] if speeds[m] else 0.0
+            else:
+                position, speed = value, 0.0
+            positions[m].append(float(position))
+            speeds[m].append(float(speed))
+
+    return {
+        'framerate': framerate,
+        'timestamps': [t for t, _ in timed],
+        'positions': positions,
+        'speeds': speeds if has_speeds else None,
+    }
+
+
+def to_pypot(move):
+    """ pypot Move JSON of a move dict. """
+    motors = sorted(move['positions'])
+    speeds = move.get('speeds')
+
+    positions = {}
+    for i, t in enumerate(move['timestamps']):
+        positions[repr(t)] = dict((m, [move['positions'][m][i],
+                                       speeds[m][i] if speeds else 0.0])
+                                  for m in motors)
+    return {'framerate': move['framerate'], 'positions': positions}
+
+
+class MoveLibrary(object):
+    """ Recorded moves stored as compact binary arrays, with a metadata index.
+
+    A move is a series of timestamped positions (and speeds, when
+    recorded) per motor, as recorded by pypot's MoveRecorder. Each one is
+    a file: a JSON header followed by blocks of BLOCK_SIZE frames, each
+    holding the timestamps and, per motor, its values as float32 (by
+    default), or with the optional 'delta' encoding, quantised to
+    resolution degrees and stored as int16 steps (zlib compressed), which
+    is smaller but rounds the values. Blocks decode independently, so a
+    move is played back as a stream of chunks without decoding it whole.
+
+    index.json holds the metadata of every move (name, duration, motors,
+    frames, size...), so listing them reads no move at all. It is updated
+    under a file lock, as several server processes may write it.
+
+    """
+    _libraries = {}
+    _libraries_lock = RLock()
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.index_file = os.path.join(path, 'index.json')
+
+    @classmethod
+    def for_path(cls, path=DEFAULT_PATH):
+        with cls._libraries_lock:
+            if path not in cls._libraries:
+                cls._libraries[path] = cls(path)
+            return cls._libraries[path]
+
+    @classmethod
+    def from_config(cls, config):
+        """ Returns the library of a config's 'moves' section (optional). """
+        path = config.as_dict().get('moves', {}).get('library') or DEFAULT_PATH
+        return cls.for_path(os.path.expanduser(path))
+
+    def _file(self, name):
+        if not _valid_name.match(name) or name.startswith('.'):
+            raise ValueError('Invalid move name: {!r}'.format(name))
+        return os.path.join(self.path, '{}.move'.format(name))
+
+    @contextmanager
+    def _locked_index(self):
+        """ Yields the index for update, written back on exit. """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.index()
+            yield index
+            atomic_write(self.index_file, json.dumps(index, indent=1, sort_keys=True))
+
+    def index(self):
+        """ {name: metadata} of the moves. """
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def list(self):
+        return sorted(self.index().values(), key=lambda move: move['name'])
+
+    def info(self, name):
+        return self.index().get(name)
+
+    def save(self, name, move, encoding='float32', resolution=0.01, block_size=BLOCK_SIZE):
+        """ Stores a move dict (see from_pypot), returns its metadata. """
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown encoding: {}'.format(encoding))
+
+        filename = self._file(name)
+        try:
+            blocks = self._encode(move, encoding, resolution, block_size)
+        except OverflowError:
+            encoding = 'float32'
+            blocks = self._encode(move, encoding, resolution, block_size)
+
+        motors = sorted(move['positions'])
+        timestamps = move['timestamps']
+        header = {
+            'framerate': move['framerate'],
+            'motors': motors,
+            'frames': len(timestamps),
+            'speeds': move.get('speeds') is not None,
+            'encoding': encoding,
+            'resolution': resolution,
+            'block_size': block_size,
+            'blocks': [],
+        }
+        offset = 0
+        for start, data in blocks:
+            header['blocks'].append([start, offset, len(data)])
+            offset += len(data)
+
+        content = MAGIC + json.dumps(header).encode() + b'\n' + b''.join(data for _, data in blocks)
+
+        info = {
+            'name': name,
+            'duration': timestamps[-1] - timestamps[0] if timestamps else 0.0,
+            'framerate': move['framerate'],
+            'frames': len(timestamps),
+            'motors': motors,
+            'encoding': encoding,
+            'size': len(content),
+            'created': time.time(),
+        }
+
+        # written aside, then renamed in place along with the index update, so that
+        # concurrent saves of a move leave the file and its index entry in agreement
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(name), suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._locked_index() as index:
+                os.rename(tmp, filename)
+                index[name] = info
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return info
+
+    def _encode(self, move, encoding, resolution, block_size):
+        motors = sorted(move['positions'])
+        channels = [move['positions']] + ([move['speeds']] if move.get('speeds') is not None else [])
+        timestamps = move['timestamps']
+
+        blocks = []
+        for start in range(0, len(timestamps), block_size):
+            end = start + block_size
+            parts = [_pack('d', timestamps[start:end])]
+            for channel in channels:
+                for m in motors:
+                    data = _encode_series(channel[m][start:end], encoding, resolution)
+                    parts.append(_pack('I', [len(data)]) + data)
+            data = b''.join(parts)
+            blocks.append((start, zlib.compress(data) if encoding == 'delta' else data))
+        return blocks
+
+    def _read_header(self, f):
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a move file')
+        header = json.loads(f.readline().decode())
+        return header, f.tell()
+
+    def chunks(self, name):
+        """ Iterator of the move by block: {start, timestamps, positions, speeds}.
+
+        The file is opened and its header read by the call itself: a
+        missing or invalid move raises there, and a move deleted while
+        iterated is still read whole.
+
+        """
+        f = open(self._file(name), 'rb')
+        try:
+            header, data_start = self._read_header(f)
+        except:
+            f.close()
+            raise
+        return self._blocks(f, header, data_start)
+
+    def _blocks(self, f, header, data_start):
+        with f:
+            motors = header['motors']
+            channels = 2 if header['speeds'] else 1
+
+            for start, offset, length in header['blocks']:
+                f.seek(data_start + offset)
+                data = f.read(length)
+                if header['encoding'] == 'delta':
+                    data = zlib.decompress(data)
+
+                frames = min(header['block_size'], header['frames'] - start)
+                timestamps = _unpack('d', data[:8 * frames])
+                pos = 8 * frames
+
+                values = []
+                for _ in range(channels):
+                    series = {}
+                    for m in motors:
+                        size = _unpack('I', data[pos:pos + 4])[0]
+                        series[m] = _decode_series(data[pos + 4:pos + 4 + size],
+                                                   header['encoding'], header['resolution'])
+                        pos += 4 + size
+                    values.append(series)
+
+                yield {
+                    'start': start,
+                    'timestamps': timestamps,
+                    'positions': values[0],
+                    'speeds': values[1] if channels > 1 else None,
+                }
+
+    def read(self, name):
+        """ The whole move dict. """
+        with open(self._file(name), 'rb') as f:
+            header, _ = self._read_header(f)
+
+        move = {
+            'framerate': header['framerate'],
+            'timestamps': [],
+            'positions': dict((m, []) for m in header['motors']),
+            'speeds': dict((m, []) for m in header['motors']) if header['speeds'] else None,
+        }
+        for chunk in self.chunks(name):
+            move['timestamps'] += chunk['timestamps']
+            for m in header['motors']:
+                move['positions'][m] += chunk['positions'][m]
+                if move['speeds'] is not None:
+                    move['speeds'][m] += chunk['speeds'][m]
+        return move
+
+    def import_pypot(self, name, data, **options):
+        return self.save(name, from_pypot(data), **options)
+
+    def export_pypot(self, name):
+        return to_pypot(self.read(name))
+
+    def delete(self, name):
+        filename = self._file(name)
+        with self._locked_index() as index:
+            index.pop(name, None)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Manage the move library')
+    parser.add_argument('--library', type=str, default=DEFAULT_PATH)
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('list')
+    p = sub.add_parser('import', help='import a pypot move (.json)')
+    p.add_argument('file', type=str)
+    p.add_argument('--name', type=str)
+    p.add_argument('--encoding', choices=ENCODINGS, default='float32')
+    p = sub.add_parser('export', help='export a move as pypot JSON')
+    p.add_argument('name', type=str)
+    p.add_argument('file', type=str)
+    args = parser.parse_args()
+
+    library = MoveLibrary(args.library)
+    if args.command == 'import':
+        with open(args.file) as f:
+            data = json.load(f)
+        name = args.name or os.path.splitext(os.path.basename(args.file))[0]
+        print(library.import_pypot(name, data, encoding=args.encoding))
+    elif args.command == 'export':
+        with open(args.file, 'w') as f:
+            json.dump(library.export_pypot(args.name), f)
+    else:
+        for move in library.list():
+            print('{name:24} {duration:8.2f}s {frames:7} frames {size:9} bytes  {encoding:8} {motors}'.format(
+                **dict(move, motors=','.join(move['motors']))))
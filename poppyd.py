@@ -1,27 +1,84 @@
 #!/usr/bin/env python
 
 import os
-import yaml
+import time
 import signal
+import socket
 
 from subprocess import Popen
 
+from config import ConfigStore
+from logmanager import LogManager
+from shared_state import SharedState, pid_alive
+from metrics import REGISTRY
+from supervisor import (Supervisor, RestartPolicy,
+                        STARTING, READY, CRASHED, STOPPED)
+
+DAEMON_TRANSITIONS = REGISTRY.counter(
+    'puppet_master_daemon_transitions_total',
+    'State changes of the robot API, by new state.', ['state'])
+DAEMON_RESTARTS = REGISTRY.counter(
+    'puppet_master_daemon_restarts_total',
+    'Automatic restarts of the robot API after a crash.')
+
 class Daemon(object):
-    def __init__(self, pidfile, logfile):
+    """ Starts, stops and supervises the robot API.
+
+    With a SharedState, the state of the supervised daemon is published
+    in the 'daemon' key so that every server process sees it, and the
+    process which started a run stays its supervisor: other processes
+    stop it by flagging the run stopped before terminating it.
+
+    """
+    def __init__(self, pidfile, logfile, log_manager=None, restart_policy=None,
+                 state=None):
         self.pidfile = os.path.abspath(pidfile)
         self.logfile = os.path.abspath(logfile)
+        self.log_manager = log_manager
+        self.state = state
+
+        self._run = None
+        self._owner = None
+
+        self.supervisor = Supervisor(self._spawn, restart_policy,
+                                     ready_check=self.is_ready,
+                                     on_transition=self._on_transition,
+                                     stop_check=self._stop_requested)
 
     def get_command(self):
         raise NotImplementedError
 
+    def is_ready(self):
+        return True
+
     def start(self):
         if 'running' in self.status():
             raise SystemError('pidfile {} already exist. '
                               'Daemon already running?'.format(self.pidfile))
 
+        if self.supervisor.state == CRASHED:
+            self.supervisor.stop()
+
+        if self.log_manager is not None:
+            self.log_manager.start_run(self.logfile)
+
+        # a new run: any other supervisor (e.g. one waiting to restart a
+        # crashed run) sees it and gives up
+        self._run = '{}-{}'.format(os.getpid(), time.time())
+        self._owner = os.getpid()
+        if self.state is not None:
+            self.state.set('daemon', {'run': self._run, 'owner': self._owner,
+                                      'state': STOPPED, 'stop_requested': False})
+
+        self.supervisor.start()
+
+        return('Poppy daemon is now running!')
+
+    def _spawn(self):
         cmd = self.get_command()
 
-        with open(self.logfile, 'w') as log:
+        # append mode, so the log manager can rotate it under the child
+        with open(self.logfile, 'a') as log:
 
             if '--disable-camera' in cmd:
                 log.write('Starting API without camera... \n')
@@ -33,25 +90,122 @@ class Daemon(object):
             with open(self.pidfile, 'w') as f:
                 f.write('{}'.format(p.pid))
 
-        return('Poppy daemon is now running!')
+        return p
+
+    def _on_transition(self, supervisor, state):
+        DAEMON_TRANSITIONS.inc(state=state)
+        if state == STARTING and supervisor.consecutive_restarts > 0:
+            DAEMON_RESTARTS.inc()
+
+        if self._current() and state in (CRASHED, STOPPED) and os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
+
+        if state == CRASHED:
+            with open(self.logfile, 'a') as log:
+                if supervisor.last_error is not None:
+                    log.write('API could not be restarted ({})!\n'.format(supervisor.last_error))
+                else:
+                    log.write('API crashed (exit code {})!\n'.format(supervisor.last_exit_code))
+
+        if self.state is not None:
+            info = dict(supervisor.info(), run=self._run, owner=self._owner)
+
+            def publish(record):
+                if record is None or record.get('run') != self._run:
+                    return record
+                return dict(info, stop_requested=record.get('stop_requested', False))
+
+            self.state.update('daemon', publish)
+
+    def _current(self):
+        """ False once another process started a newer run. """
+        if self.state is None:
+            return True
+        record = self.state.get('daemon')
+        return record is None or record.get('run') == self._run
+
+    def _stop_requested(self):
+        if self.state is None:
+            return False
+        record = self.state.get('daemon')
+        return (record is not None and
+                (record.get('run') != self._run or record.get('stop_requested', False)))
+
+    @property
+    def owned(self):
+        """ True if the current run is supervised by this very process (not a fork of it). """
+        return self.supervisor.spawned and self._owner == os.getpid()
+
+    def info(self):
+        """ State of the supervised daemon, seen from any process, None if unknown. """
+        if self.state is not None:
+            record = self.state.get('daemon')
+            if record is not None and pid_alive(record['owner']) and 'pid' in record:
+                if record['state'] in (STARTING, READY):
+                    record['uptime'] = time.time() - record['started_at']
+                return record
+
+        if self.owned:
+            return self.supervisor.info()
+        return None
 
     def stop(self):
         if 'stopped' in self.status():
             raise SystemError('pidfile {} does not exist. '
                               'Daemon already stopped?'.format(self.pidfile))
 
-        with open(self.pidfile) as f:
-            pid = int(f.read())
-
-        os.kill(pid, signal.SIGTERM)
-        os.remove(self.pidfile)
-
-        with open(self.logfile, 'w') as log:
+        info = self.info()
+        if self.owned and info is not None and info.get('run', self._run) == self._run:
+            self.supervisor.stop()
+        elif info is not None:
+            # supervised by another server process
+            self._stop_other(info)
+        else:
+            # started by another process (e.g. poppyd.py start)
+            with open(self.pidfile) as f:
+                pid = int(f.read())
+
+            os.kill(pid, signal.SIGTERM)
+            os.remove(self.pidfile)
+
+        with open(self.logfile, 'a') as log:
             log.write('API stopped!\n')
             log.close()
 
+        if self.log_manager is not None:
+            self.log_manager.stop_run(self.logfile)
+
         return('Poppy daemon is now stopped!')
 
+    def _request_stop(self):
+        if self.state is not None:
+            self.state.update('daemon', lambda record: (dict(record, stop_requested=True)
+                                                        if record is not None else None))
+
+    def _stop_other(self, info, timeout=5.0):
+        self._request_stop()
+        if info['pid'] is None:
+            # crashed: its supervisor gives up restarting it
+            return
+
+        try:
+            os.kill(info['pid'], signal.SIGTERM)
+        except OSError:
+            pass
+
+        # until its supervisor saw the exit and published it
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            info = self.info()
+            if info is None or info['state'] not in (STARTING, READY):
+                return
+            time.sleep(0.05)
+
+        try:
+            os.kill(info['pid'], signal.SIGKILL)
+        except OSError:
+            pass
+
     def restart(self):
         if 'running' in self.status():
             self.stop()
@@ -60,26 +214,47 @@ class Daemon(object):
         return('Poppy daemon has been restarted!')
 
     def status(self):
+        info = self.info()
+        if info is not None:
+            # supervised by a server process: answer from its published state
+            if info['state'] in (STARTING, READY):
+                return 'Poppy daemon is running ({}).'.format(info['state'])
+            return 'Poppy daemon is {}.'.format(info['state'])
+
         return 'Poppy daemon is {}.'.format('running'
                                             if os.path.exists(self.pidfile) else
                                             'stopped')
 
     def force_clean(self):
-        os.remove(self.pidfile)
+        self._request_stop()
+        if self.owned:
+            self.supervisor.stop()
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
 
 
 class PoppyDaemon(Daemon):
     def __init__(self, configfile, pidfile):
         self.configfile = configfile
+        self.config_store = ConfigStore.for_file(configfile)
+
+        config = self.config_store.data
 
-        with open(self.configfile) as f:
-            config = yaml.load(f, Loader=yaml.SafeLoader)
+        Daemon.__init__(self, pidfile, config['poppyLog']['puppetMaster'],
+                        LogManager.from_config(self.config_store.config),
+                        RestartPolicy.from_config(self.config_store.config),
+                        SharedState.from_config(self.config_store.config))
 
-        Daemon.__init__(self, pidfile, config['poppyLog']['puppetMaster'])
+    def is_ready(self):
+        port = int(self.config_store.config.poppyPort.http)
+        try:
+            socket.create_connection(('localhost', port), timeout=0.2).close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
 
     def get_command(self):
-        with open(self.configfile) as f:
-            config = yaml.load(f, Loader=yaml.SafeLoader)
+        config = self.config_store.data
 
         cmd = [
             'poppy-services',
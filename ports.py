@@ -0,0 +1,120 @@
+import time
+import errno
+import socket
+
+from threading import Lock
+
+
+def is_port_free(port, host='localhost'):
+    """ True if nothing listens on port and it can be bound right now. """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(0.1)
+    try:
+        if s.connect_ex((host, port)) == 0:
+            return False
+    finally:
+        s.close()
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('', port))
+        return True
+    except socket.error as e:
+        if e.errno in (errno.EADDRINUSE, errno.EACCES):
+            return False
+        raise
+    finally:
+        s.close()
+
+
+def wait_port(port, timeout, alive=None, host='localhost', poll=0.2):
+    """ Waits until something listens on port, returns False on timeout.
+
+    alive() is checked between attempts to give up early (e.g. when the
+    process that should open the port already exited).
+
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(poll)
+        try:
+            if s.connect_ex((host, port)) == 0:
+                return True
+        finally:
+            s.close()
+
+        if alive is not None and not alive():
+            return False
+        time.sleep(poll)
+    return False
+
+
+class PortAllocator(object):
+    """ Hands out free (http, snap, ws) port triples for the virtual bots.
+
+    A triple is base_ports + offset, with the same offset on the three
+    ports, and is only given if all three pass the connect and bind probes.
+    Handed out triples are kept in a registry until released, so concurrent
+    allocations never return the same ports, even before the processes
+    using them have opened them. With a SharedState, the registry is its
+    'ports' key, shared by all the server processes.
+
+    """
+    def __init__(self, max_offset=100, state=None):
+        self.max_offset = max_offset
+        self.state = state
+
+        self._lock = Lock()
+        self._allocated = {}
+
+    def _update(self, func):
+        """ Returns func(registry) run while no one else can change the registry. """
+        with self._lock:
+            if self.state is None:
+                return func(self._allocated)
+
+            result = []
+
+            def apply(registry):
+                registry = dict((int(k), tuple(v)) for k, v in registry.items())
+                result.append(func(registry))
+                return dict((str(k), list(v)) for k, v in registry.items())
+
+            self.state.update('ports', apply, {})
+            return result[0]
+
+    def allocate(self, base_ports, number=1):
+        """ Returns [(offset, (http, snap, ws)), ...] for number new instances. """
+        return self._update(lambda registry: self._allocate(registry, base_ports, number))
+
+    def _allocate(self, registry, base_ports, number):
+        allocated = []
+        taken = set(p for ports in registry.values() for p in ports)
+
+        for offset in range(1, self.max_offset + 1):
+            if len(allocated) == number:
+                break
+
+            ports = tuple(int(p) + offset for p in base_ports)
+            if offset in registry or taken.intersection(ports):
+                continue
+            if all(is_port_free(p) for p in ports):
+                registry[offset] = ports
+                taken.update(ports)
+                allocated.append((offset, ports))
+
+        if len(allocated) < number:
+            for offset, _ in allocated:
+                del registry[offset]
+            raise SystemError('Could not find {} free port triples.'.format(number))
+
+        return allocated
+
+    def release(self, offset):
+        self._update(lambda registry: registry.pop(offset, None))
+
+    @property
+    def allocated(self):
+        return self._update(dict)
@@ -0,0 +1,173 @@
+import time
+import socket
+
+from subprocess import Popen, PIPE
+from threading import Thread, Timer, Lock, RLock, Event
+
+from metrics import SUBPROCESS_DURATION, command_name
+
+
+def run_command(cmd, timeout):
+    """ Runs cmd, killing it after timeout seconds. Returns (returncode, stdout). """
+    with SUBPROCESS_DURATION.time(command=command_name(cmd)):
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        killer = Timer(timeout, p.kill)
+        killer.start()
+        try:
+            out, _ = p.communicate()
+        finally:
+            killer.cancel()
+    return p.returncode, out.decode('utf-8', 'replace')
+
+
+def find_local_ip():
+    """ IP of the interface used to reach the outside (no packet is sent). """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(('8.8.8.8', 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+
+class Probe(object):
+    """ A system check whose result can be cached for ttl seconds.
+
+    func() is given timeout seconds to answer: past that the probe result
+    is its default value. A late answer is dropped, and the probe is not
+    run again while it is still hung (busy), so that hung calls do not
+    pile up threads.
+
+    """
+    def __init__(self, name, func, ttl=60.0, timeout=3.0, default=None):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self.timeout = timeout
+        self.default = default
+
+        self.value = default
+        self.error = None
+        self.updated = None
+        self.duration = None
+
+        self._generation = 0
+        self._thread = None
+        self._lock = Lock()
+
+    @property
+    def busy(self):
+        """ Whether the last call of func did not return yet (timed out or not). """
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def stale(self):
+        return self.updated is None or time.time() - self.updated > self.ttl
+
+    def _store(self, value, error, start, generation):
+        with self._lock:
+            if generation != self._generation:
+                return  # a late answer of a run which timed out
+            self._generation += 1
+            self.value, self.error = value, error
+            self.updated = time.time()
+            self.duration = self.updated - start
+
+    def run(self):
+        start = time.time()
+        done = Event()
+        generation = self._generation
+
+        def call():
+            try:
+                value, error = self.func(), None
+            except Exception as e:
+                value, error = self.default, repr(e)
+            self._store(value, error, start, generation)
+            done.set()
+
+        self._thread = Thread(target=call)
+        self._thread.daemon = True
+        self._thread.start()
+
+        if not done.wait(self.timeout):
+            self._store(self.default, 'timeout after {}s'.format(self.timeout), start, generation)
+
+
+class ProbeCache(object):
+    """ Runs probes concurrently in the background and serves their cached results.
+
+    Reads never block on a probe: they return the last result (the probe
+    default until it first answered) and schedule a refresh of stale
+    probes. Once started, a background thread also refreshes every probe
+    when its ttl expires, so pages render from fresh cached state.
+
+    """
+    def __init__(self, probes=(), interval=1.0):
+        self.interval = interval
+
+        self._probes = {}
+        self._running = set()
+        self._lock = RLock()
+        self._thread = None
+
+        for probe in probes:
+            self.add(probe)
+
+    def add(self, probe):
+        self._probes[probe.name] = probe
+
+    def __getitem__(self, name):
+        self.refresh_stale([name])
+        return self._probes[name].value
+
+    def values(self):
+        self.refresh_stale()
+        return dict((name, probe.value) for name, probe in self._probes.items())
+
+    def status(self):
+        return dict((name, {'value': probe.value, 'error': probe.error,
+                            'updated': probe.updated, 'duration': probe.duration})
+                    for name, probe in self._probes.items())
+
+    def _run(self, probe):
+        try:
+            probe.run()
+        finally:
+            with self._lock:
+                self._running.discard(probe.name)
+
+    def refresh(self, names=None, wait=False):
+        """ Runs the probes (all by default) concurrently, each in its own thread. """
+        threads = []
+        with self._lock:
+            for name in names if names is not None else list(self._probes):
+                if name in self._running or self._probes[name].busy:
+                    continue
+                self._running.add(name)
+
+                t = Thread(target=self._run, args=(self._probes[name], ))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        if wait:
+            for t in threads:
+                t.join()
+
+    def refresh_stale(self, names=None, wait=False):
+        names = names if names is not None else list(self._probes)
+        self.refresh([name for name in names if self._probes[name].stale], wait)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                self.refresh_stale()
+                time.sleep(self.interval)
+
+        self._thread = Thread(target=loop)
+        self._thread.daemon = True
+        self._thread.start()
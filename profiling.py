@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import uuid
+import random
+import cProfile
+
+from threading import Thread, Lock, Event, get_ident
+from collections import Counter
+
+
+DEFAULT_DIR = '/tmp/puppet-master-profiles'
+
+DEFAULTS = {
+    'sampleRate': 0.0,
+    'slowThreshold': 0.0,
+    'keep': 20,
+}
+MAX_KEEP = 200
+
+FORMATS = {
+    'pstats': 'application/octet-stream',
+    'collapsed': 'text/plain',
+}
+
+
+def profiling_options(config):
+    """ Options of the config's 'profiling' section (optional), within their bounds. """
+    options = dict(DEFAULTS)
+    options.update((k, v) for k, v in config.as_dict().get('profiling', {}).items() if k in DEFAULTS)
+    return bounded_options(options)
+
+
+def bounded_options(options):
+    """ options with sampleRate in [0, 1], slowThreshold >= 0 and keep in [1, MAX_KEEP]. """
+    return dict(options,
+                sampleRate=min(max(float(options['sampleRate']), 0.0), 1.0),
+                slowThreshold=max(float(options['slowThreshold']), 0.0),
+                keep=min(max(int(options['keep']), 1), MAX_KEEP))
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(Thread):
+    """ Samples the stacks of the watched threads every interval seconds.
+
+    It sleeps while no thread is watched.
+
+    """
+    def __init__(self, interval=0.005):
+        Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+
+        self._lock = Lock()
+        self._watched = {}
+        self._wake = Event()
+
+    def watch(self, ident):
+        """ Starts sampling thread ident, returns the Counter of its stacks. """
+        stacks = Counter()
+        with self._lock:
+            self._watched[ident] = stacks
+        self._wake.set()
+        return stacks
+
+    def unwatch(self, ident):
+        with self._lock:
+            self._watched.pop(ident, None)
+
+    def run(self):
+        while True:
+            with self._lock:
+                watched = list(self._watched.items())
+                if not watched:
+                    self._wake.clear()
+
+            if not watched:
+                self._wake.wait()
+                continue
+
+            frames = sys._current_frames()
+            for ident, stacks in watched:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[_stack(frame)] += 1
+            del frames
+
+            time.sleep(self.interval)
+
+
+class Capture(object):
+    def __init__(self, profile, stacks):
+        self.start = time.time()
+        self.profile = profile
+        self.stacks = stacks
+
+
+class RequestProfiler(object):
+    """ Profiles a fraction of the requests, and the requests slower than a threshold.
+
+    A sampled request runs under cProfile. Every captured request (sampled,
+    or any request when a slow threshold is set) has the stack of its
+    thread sampled every few milliseconds; it is kept if it was sampled
+    or slower than the threshold.
+
+    Only the last keep profiles are kept: their files (pstats for the
+    sampled requests, collapsed stacks for all of them, as read by
+    flamegraph.pl or speedscope) are in profile_dir, listed in the
+    'profiles' key of a SharedState so that any server process serves them.
+
+    """
+    def __init__(self, state, profile_dir=DEFAULT_DIR, interval=0.005):
+        self.state = state
+        self.profile_dir = profile_dir
+        self.interval = interval
+
+        self._lock = Lock()
+        self._sampler = None
+        self._pid = None
+
+    def _sampler_thread(self):
+        # threads do not survive a fork: one sampler per process
+        with self._lock:
+            if self._sampler is None or self._pid != os.getpid():
+                self._sampler = StackSampler(self.interval)
+                self._sampler.start()
+                self._pid = os.getpid()
+            return self._sampler
+
+    def begin(self, sample_rate=0.0, slow_threshold=0.0):
+        """ Starts capturing the calling thread's request, returns None if it is not. """
+        sampled = sample_rate > 0 and random.random() < sample_rate
+        if not sampled and not slow_threshold:
+            return None
+
+        profile = None
+        if sampled:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is active
+                profile = None
+
+        return Capture(profile, self._sampler_thread().watch(get_ident()))
+
+    def end(self, capture, slow_threshold=0.0, keep=DEFAULTS['keep'], **info):
+        """ Stops the capture, stores it if it was sampled or slow, returns its record or None. """
+        duration = time.time() - capture.start
+        if capture.profile is not None:
+            capture.profile.disable()
+        self._sampler_thread().unwatch(get_ident())
+
+        if capture.profile is not None:
+            reason = 'sampled'
+        elif slow_threshold and duration >= slow_threshold:
+            reason = 'slow'
+        else:
+            return None
+
+        return self._store(capture, dict(info, reason=reason, duration=duration,
+                                         started=capture.start), keep)
+
+    def _path(self, id, format):
+        return os.path.join(self.profile_dir, '{}.{}'.format(id, format))
+
+    def _store(self, capture, record, keep):
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        id = uuid.uuid4().hex[:12]
+        formats = ['collapsed']
+        with open(self._path(id, 'collapsed'), 'w') as f:
+            for stack, count in capture.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        if capture.profile is not None:
+            capture.profile.dump_stats(self._path(id, 'pstats'))
+            formats.append('pstats')
+
+        record = dict(record, id=id, pid=os.getpid(), formats=formats,
+                      samples=sum(capture.stacks.values()))
+
+        dropped = []
+
+        def add(profiles):
+            profiles = profiles + [record]
+            dropped.extend(profiles[:max(0, len(profiles) - keep)])
+            return profiles[len(dropped):]
+
+        self.state.update('profiles', add, [])
+        for old in dropped:
+            self._remove(old)
+        return record
+
+    def _remove(self, record):
+        for format in record['formats']:
+            path = self._path(record['id'], format)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def profiles(self):
+        """ The kept profiles, most recent first. """
+        return list(reversed(self.state.get('profiles', [])))
+
+    def get(self, id):
+        for record in self.state.get('profiles', []):
+            if record['id'] == id:
+                return record
+        return None
+
+    def path(self, id, format):
+        """ File of a profile in format, None if there is none. """
+        record = self.get(id)
+        if record is None or format not in record['formats']:
+            return None
+        return self._path(id, format)
+
+    def clear(self):
+        dropped = []
+
+        def drop(profiles):
+            dropped.extend(profiles)
+            return []
+
+        self.state.update('profiles', drop, [])
+        for record in dropped:
+            self._remove(record)
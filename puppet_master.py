@@ -1,27 +1,43 @@
 import os
+import sys
+import json
 import time
-import requests
+import subprocess
 
-from subprocess import call, check_call, Popen
-from contextlib import closing
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
 
 from poppyd import PoppyDaemon
-from config import Config, attrsetter
-from pypot.creatures import installed_poppy_creatures
-from pypot.server.snap import find_local_ip
+from config import ConfigStore, attrsetter
+from logmanager import LogManager
+from robot_client import RobotClient
+from robot_state import RobotState
+from fleet import Fleet
+from fleet_state import FleetState
+from creatures import CreatureManifest
+from shared_state import SharedState
+from metrics import REGISTRY
+# job aware call/check_call: the output of the commands run by a job goes to
+# its log, and they are killed if it gets cancelled
+from jobs import JobRunner, JobFailed, tracked_call as call, tracked_check_call as check_call
+
+MOTOR_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'motor_config.py')
 
 class PuppetMaster(object):
     def __init__(self, DaemonCls, configfile, pidfile):
         self.configfile = os.path.abspath(configfile)
+        self.config_store = ConfigStore.for_file(self.configfile)
         self.pidfile = os.path.abspath(pidfile)
         self.logfile = self.config.poppyLog.puppetMaster
+        self.log_manager = LogManager.from_config(self.config)
+        # control-plane state, shared by all the server processes
+        self.state = SharedState.from_config(self.config)
 
         self.daemon = DaemonCls(self.configfile, self.pidfile)
 
         self.config_handlers = {
             'robot.name': self._change_hostname,
-            'robot.motors': self._configure_motors,
+            'robot.motors': self.configure_motors,
             'wifi.start': self._set_wifi,
             'wifi.ssid': self._change_wifi,
             'wifi.psk': self._change_wifi,
@@ -29,8 +45,15 @@ class PuppetMaster(object):
             'hotspot.ssid': self._set_hotspot,
             'hotspot.psk': self._set_hotspot
         }
-        self._updating = False
-        self.nb_clone = 0
+        self._robot = None
+        self._robot_lock = Lock()
+        self.robot_state = RobotState(lambda: self.robot)
+        self.creatures = CreatureManifest.for_path()
+        self.fleet = Fleet(self.config_store, self.log_manager, self.state)
+        self.fleet_state = FleetState(self.fleet)
+        self.jobs = JobRunner(self.state)
+
+        REGISTRY.share(self.state)
 
     def start(self):
         self.daemon.start()
@@ -39,6 +62,12 @@ class PuppetMaster(object):
     def running(self):
         return 'running' in self.daemon.status()
 
+    @property
+    def daemon_state(self):
+        """ State, restart and crash counts of the supervised API. """
+        info = self.daemon.info()
+        return info if info is not None else self.daemon.supervisor.info()
+
     def stop(self):
         try:
             self.daemon.stop()
@@ -53,44 +82,91 @@ class PuppetMaster(object):
 
     def force_clean(self):
         self.daemon.force_clean()
-        call(['pkill', '-f', 'poppy-services'])
+        # only the real robot: the virtual bots (the pids of the fleet) are stopped through the fleet
+        try:
+            # poppy-services itself (or run by python), not anything with it in its arguments
+            pids = subprocess.check_output(['pgrep', '-f', r'^(\S*/)?(python[0-9.]* )?(\S*/)?poppy-services( |$)']).split()
+        except (subprocess.CalledProcessError, OSError):
+            pids = []
+        clones = self.fleet.pids
+        pids = [pid.decode() for pid in pids if int(pid) not in clones]
+        if pids:
+            call(['kill'] + pids)
 
     @property
     def config(self):
-        return Config.from_file(self.configfile)
+        return self.config_store.config
+
+    @property
+    def robot(self):
+        """ Pooled REST client of the robot, rebuilt if its ports changed. """
+        ports = self.config.poppyPort
+        url = 'http://localhost:{}'.format(ports.http)
+        snap_url = 'http://localhost:{}'.format(ports.snap)
+
+        with self._robot_lock:
+            if self._robot is None or (self._robot.url, self._robot.snap_url) != (url, snap_url):
+                if self._robot is not None:
+                    # the threads still using it finish their calls (see RobotClient.close)
+                    self._robot.close()
+                self._robot = RobotClient(http_port=ports.http, snap_port=ports.snap)
+            return self._robot
 
     def update_config(self, key, value):
-        with closing(self.config) as c:
-            attrsetter(key)(c, value)
+        """ Sets a 'section.key', returns what its config handler returned (None without). """
+        return self.update_configs([(key, value)]).get(key)
 
-        if key in self.config_handlers:
-            self.config_handlers[key](value)
+    def update_configs(self, changes):
+        """ Applies several 'section.key' changes as a single transaction.
 
-    def self_update(self):
-        if self._updating:
-            return
+        All keys are written in one atomic file replace, then each affected
+        config handler is run once, with the last value set for its keys.
+        Returns {key: result} of the handlers run, by the last key set for
+        each.
 
-        self._updating = True
+        """
+        changes = list(changes.items() if hasattr(changes, 'items') else changes)
+        if not changes:
+            return {}
 
-        if self.running:
-            self.stop()
-            flag=True
-        else:
-            flag=False
+        with self.config_store.edit() as c:
+            for key, value in changes:
+                attrsetter(key)(c, value)
 
-        if os.path.exists(self.config.poppyLog.update):
-            os.remove(self.config.poppyLog.update)
-        success = check_call(['poppy-update'])
+        handlers = OrderedDict()
+        for key, value in changes:
+            if key in self.config_handlers:
+                handler = self.config_handlers[key]
+                handlers.pop(handler, None)
+                handlers[handler] = key, value
 
-        if flag: self.start()
+        return dict((key, handler(value)) for handler, (key, value) in handlers.items())
 
-        self._updating = False
+    def self_update(self):
+        if not self.state.claim('updating'):
+            return
+
+        try:
+            if self.running:
+                self.stop()
+                flag=True
+            else:
+                flag=False
+
+            if os.path.exists(self.config.poppyLog.update):
+                os.remove(self.config.poppyLog.update)
+            success = check_call(['poppy-update'])
+            self.creatures.invalidate()
+
+            if flag: self.start()
+        finally:
+            self.state.release('updating')
 
         return success
 
     @property
     def is_updating(self):
-        return self._updating
+        return self.state.holder('updating') is not None
 
     def _change_hostname(self, name):
         call(['sudo', 'raspi-config', '--change-hostname', name])
@@ -105,12 +181,35 @@ class PuppetMaster(object):
 
     def _get_robot_motor_list(self):
         try:
-            RobotCls = installed_poppy_creatures[self.config.robot.creature]
-            return sorted(RobotCls.default_config['motors'].keys())
+            return self.creatures.motors(self.config.robot.creature)
         except KeyError:
             return ['']
 
-    def _configure_motors(self, motor):
+    def _motor_list(self, motors):
+        """ motors as a list: 'all', a name, or names separated by commas. """
+        if isinstance(motors, str):
+            if motors.strip() == 'all':
+                try:
+                    return self.creatures.motors(self.config.robot.creature)
+                except KeyError:
+                    raise ValueError('Unknown creature: {}'.format(self.config.robot.creature))
+            motors = motors.replace(',', ' ').split()
+        motors = [m for m in motors if m]
+        if not motors:
+            raise ValueError('No motor given')
+        return motors
+
+    def configure_motors(self, motors):
+        """ Configures motors ('all', names or a list) in a background job, returns the job.
+
+        Raises ValueError if there is no motor to configure.
+
+        """
+        return self.jobs.submit('configure', self._configure_motors, (self._motor_list(motors), ),
+                                concurrency='robot')
+
+    def _configure_motors(self, motors):
+        # the API holds the serial ports: stopped once for the whole batch
         if self.running:
             self.stop()
             flag=True
@@ -118,11 +217,32 @@ class PuppetMaster(object):
             flag=False
 
         creature = self.config.robot.creature.split('poppy-')[1]
-        with open(self.config.poppyLog.configMotor,"wb") as f:
-            check_call(['poppy-configure', creature, motor], stdout=f, stderr=f)
-            f.close()
-
-        if flag: self.start()
+        results_file = '{}.results'.format(self.config.poppyLog.configMotor)
+        if os.path.exists(results_file):
+            os.remove(results_file)
+        exit_code = 0
+        try:
+            with open(self.config.poppyLog.configMotor, "wb") as f:
+                try:
+                    check_call([sys.executable, MOTOR_CONFIG, creature] + list(motors) +
+                               ['--results', results_file], stdout=f, stderr=f)
+                except subprocess.CalledProcessError as e:
+                    exit_code = e.returncode  # some motors failed (see the results), or it crashed
+            try:
+                with open(results_file) as f:
+                    results = json.load(f)
+                os.remove(results_file)
+            except (IOError, OSError, ValueError):
+                # crashed before writing them (see the log)
+                error = 'motor_config.py exited with code {} before configuring it'.format(exit_code)
+                results = [{'motor': m, 'ok': False, 'duration': 0.0, 'error': error} for m in motors]
+        finally:
+            if flag: self.start()
+
+        failed = [r['motor'] for r in results if not r['ok']]
+        if failed:
+            raise JobFailed('Could not configure {}'.format(', '.join(failed)), results)
+        return results
 
     def _set_wifi(self, state):
         tmp_file='/tmp/tmp.txt'
@@ -173,54 +293,27 @@ class PuppetMaster(object):
                 pass
 
     def clone(self, number=1):
-        http, snap, ws = int(self.config.poppyPort.http), int(self.config.poppyPort.snap), int(self.config.poppyPort.ws)
-        nb_try = 0
-        status = 'occuped'
-        while status == 'occuped':
-            nb_try+=1
-            http+=1
-            snap+=1
-            ws+=1
-            try:
-                requests.get('http://localhost:{}'.format(http))
-            except:
-                status = 'free'
-        for nb in range (number):
-            with open(self.config.poppyLog.virtualBot.replace('.log', '_{}.log'.format(nb+nb_try)), 'wb') as f:
-                try:
-                    Popen(['poppy-services', '--poppy-simu', '--no-browser',
-                           '--http', '--http-port', str(http),
-                           '--snap', '--snap-port', str(snap),
-                           '--ws', '--ws-port', str(ws),
-                           self.config.robot.creature],
-                           stdout=f, stderr=f)
-                    f.close()
-                except:
-                    f.write('>> ERROR <<')
-                    f.close()
-                    return 'ECHEC'
-            self.nb_clone+=1
-            http+=1
-            snap+=1
-            ws+=1
-
-    def restart_services(self):
-        def delayed_restart_services(command, sec=2):
-            time.sleep(sec)
-            call(command)
+        return self.fleet.scale_up(number)
 
+    @property
+    def nb_clone(self):
+        return len(self.fleet)
+
+    def restart_services(self, delay=2):
         cmd=['sudo','systemctl','restart']
         for service in self.config.services.as_dict().values():
             cmd.append(service)
 
-        Thread(target=delayed_restart_services(cmd)).start()
+        # puppet-master is restarted too: leaves time to answer the request
+        time.sleep(delay)
+        call(cmd)
 
     def reboot(self):
         try:
             if not self.running: self.start()
-            for m in self.get_motors():
-                self.send_value(m, 'compliant', True)
-                self.send_value(m, 'led', 'off')
+            motors = self.get_motors()
+            self.robot.set_register_many(motors, 'compliant', True)
+            self.robot.set_register_many(motors, 'led', 'off')
             self.stop()
         except:
             pass
@@ -234,9 +327,9 @@ class PuppetMaster(object):
     def shutdown(self):
         try:
             if not self.running: self.start()
-            for m in self.get_motors():
-                self.send_value(m, 'compliant', True)
-                self.send_value(m, 'led', 'off')
+            motors = self.get_motors()
+            self.robot.set_register_many(motors, 'compliant', True)
+            self.robot.set_register_many(motors, 'led', 'off')
             self.stop()
         except:
             pass
@@ -247,18 +340,13 @@ class PuppetMaster(object):
         Thread(target=delayed_halt).start()
 
     def get_motors(self, alias='motors'):
-        r = requests.get('http://localhost:{}/motor/{}/list.json'.format(self.config.poppyPort.http, alias)).json()
-        return r[alias]
+        return self.robot.get_motors(alias)
 
     def send_value(self, motor, register, value):
-        url = 'http://localhost:{}/motor/{}/register/{}/value.json'
-        r = requests.post(url.format(self.config.poppyPort.http, motor, register), json=value)
-        return r
+        return self.robot.set_register(motor, register, value)
 
 
 if __name__ == '__main__':
-    import sys
-
     configfile = os.path.expanduser('~/.poppy_config.yaml')
     pidfile = '/tmp/puppet-master-pid.lock'
 
@@ -0,0 +1,133 @@
+import requests
+
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+def _retry(retries, backoff):
+    # setting a register is idempotent, so POST can be retried too
+    methods = frozenset(['GET', 'POST'])
+    try:
+        return Retry(total=retries, connect=retries, read=retries,
+                     backoff_factor=backoff, allowed_methods=methods)
+    except TypeError:
+        return Retry(total=retries, connect=retries, read=retries,
+                     backoff_factor=backoff, method_whitelist=methods)
+
+
+class RobotClient(object):
+    """ Keep-alive client of the pypot REST API of a robot.
+
+    All calls go through one requests.Session holding a pool of persistent
+    connections to the pypot http server, with a timeout and a retry policy
+    (with exponential backoff) on every call. The *_many calls run on a
+    pool of pool_size threads, shared by all the threads using the client:
+    close() only terminates it once the calls running on it are done.
+
+    """
+    def __init__(self, host='localhost', http_port=8080, snap_port=6969,
+                 timeout=2.0, retries=2, backoff=0.1, pool_size=8):
+        self.url = 'http://{}:{}'.format(host, http_port)
+        self.snap_url = 'http://{}:{}'.format(host, snap_port)
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                              max_retries=_retry(retries, backoff))
+        self.session.mount('http://', adapter)
+
+        self._pool = None
+        self._pool_lock = Lock()
+        self._pool_users = 0
+        self._closed = False
+
+    def _get(self, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        r = self.session.get(self.url + path, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def get_motors(self, alias='motors'):
+        return self._get('/motor/{}/list.json'.format(alias)).json()[alias]
+
+    def get_aliases(self):
+        return self._get('/motor/alias/list.json').json()['alias']
+
+    def get_running_primitives(self):
+        return self._get('/primitive/running/list.json').json()['running_primitives']
+
+    def get_register(self, motor, register):
+        return self._get('/motor/{}/register/{}'.format(motor, register)).json()[register]
+
+    def set_register(self, motor, register, value):
+        r = self.session.post(
+            self.url + '/motor/{}/register/{}/value.json'.format(motor, register),
+            json=value, timeout=self.timeout)
+        r.raise_for_status()
+        return r
+
+    def set_register_many(self, motors, register, value):
+        """ Sets register to value on all motors, in parallel over the pool.
+
+        Returns a {motor: error} dict of the motors that could not be set.
+
+        """
+        def set_one(motor):
+            try:
+                self.set_register(motor, register, value)
+            except requests.RequestException as e:
+                return motor, e
+            return motor, None
+
+        return dict((motor, e) for motor, e in self._map(set_one, motors)
+                    if e is not None)
+
+    def get_registers_many(self, motors, registers):
+        """ Reads registers of all motors, in parallel over the pool.
+
+        Returns a {motor: {register: value}} dict, raises the first error.
+
+        """
+        reads = [(motor, register) for motor in motors for register in registers]
+        values = self._map(lambda read: self.get_register(*read), reads)
+
+        result = dict((motor, {}) for motor in motors)
+        for (motor, register), value in zip(reads, values):
+            result[motor][register] = value
+        return result
+
+    def _map(self, func, items):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.pool_size)
+            pool = self._pool
+            self._pool_users += 1
+        try:
+            return pool.map(func, items)
+        finally:
+            with self._pool_lock:
+                self._pool_users -= 1
+                self._release_pool()
+
+    def _release_pool(self):
+        # with the pool lock held: once closed, by the last call using the pool
+        if self._closed and self._pool_users == 0 and self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def is_snap_reachable(self):
+        try:
+            return self.session.get(self.snap_url, timeout=self.timeout).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def close(self):
+        """ Releases the connections, and the thread pool once unused. """
+        with self._pool_lock:
+            self._closed = True
+            self._release_pool()
+        # the requests in flight finish, their connections are not reused
+        self.session.close()
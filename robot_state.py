@@ -0,0 +1,102 @@
+import time
+import requests
+
+from threading import RLock
+
+
+REGISTERS = ('present_position', 'compliant')
+FIELDS = ('aliases', 'motors', 'running_primitives')
+
+
+def offline_snapshot(error, fields=FIELDS):
+    """ Snapshot of a robot that cannot be reached. """
+    snapshot = {'connected': False, 'error': error}
+    for field in fields:
+        snapshot[field] = [] if field == 'running_primitives' else {}
+    return snapshot
+
+
+class RobotState(object):
+    """ Snapshot of a robot shared by all the web clients, fetched at most once per ttl.
+
+    The snapshot gathers the motor aliases, the registers of every motor
+    (position and compliance) and the running primitives in one document.
+    It is fetched through the pooled REST client of the robot, by a single
+    thread at a time: the requests arriving while it is fetched wait for
+    it and get the same snapshot, so any number of browsers cost one
+    upstream fetch per ttl (per server process). The aliases rarely change
+    and are only fetched every alias_ttl.
+
+    Each field of the snapshot (see FIELDS) is cached on its own, so a
+    client polling a single one (get(['running_primitives'])) only costs
+    the fetch of that field, not the registers of every motor.
+
+    A failed fetch is cached too (connected is False), so that a stopped
+    robot is not hammered either.
+
+    """
+    def __init__(self, client, ttl=0.5, alias_ttl=30.0, registers=REGISTERS):
+        self.client = client
+        self.ttl = ttl
+        self.alias_ttl = alias_ttl
+        self.registers = registers
+
+        self._lock = RLock()
+        self._field_locks = dict((field, RLock()) for field in FIELDS)
+        self._cache = {}  # field: (value, fetched, error)
+
+    def _fetch(self, robot, field):
+        if field == 'aliases':
+            return dict((alias, robot.get_motors(alias)) for alias in robot.get_aliases())
+        if field == 'motors':
+            return robot.get_registers_many(robot.get_motors(), self.registers)
+        return robot.get_running_primitives()
+
+    def _cached(self, field):
+        with self._lock:
+            entry = self._cache.get(field)
+        if entry is None:
+            return None
+        ttl = self.alias_ttl if field == 'aliases' and entry[2] is None else self.ttl
+        return entry if time.time() - entry[1] < ttl else None
+
+    def get(self, fields=FIELDS):
+        """ The snapshot of fields (all by default), each fetched again if older than its ttl. """
+        snapshot = {'connected': True}
+        fetched = []
+        robot, error = None, None
+        for field in fields:
+            with self._field_locks[field]:
+                entry = self._cached(field)
+                if entry is None:
+                    if error is None:
+                        robot = robot or self.client()
+                        try:
+                            entry = (self._fetch(robot, field), time.time(), None)
+                        except (requests.RequestException, ValueError, KeyError) as e:
+                            error = str(e)
+                    if entry is None:
+                        # the next fields would fail alike
+                        entry = (offline_snapshot(error, [field])[field], time.time(), error)
+                    with self._lock:
+                        self._cache[field] = entry
+
+            snapshot[field] = entry[0]
+            fetched.append(entry[1])
+            if entry[2] is not None:
+                snapshot.update(connected=False, error=entry[2])
+        snapshot['time'] = min(fetched) if fetched else time.time()
+        return snapshot
+
+    def invalidate(self):
+        """ Makes the next get fetch the registers and primitives again (e.g. after a write). """
+        with self._lock:
+            for field in FIELDS:
+                if field != 'aliases':
+                    self._cache.pop(field, None)
+
+    def set_register(self, motors, register, value):
+        """ Sets register to value on all motors, returns {motor: error} of the failures. """
+        errors = self.client().set_register_many(motors, register, value)
+        self.invalidate()
+        return dict((motor, str(e)) for motor, e in errors.items())
@@ -0,0 +1,167 @@
+import os
+import sys
+import errno
+import signal
+import traceback
+
+from threading import Lock
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+DEFAULTS = {
+    'workers': 2,
+    'threads': 8,
+    'keepalive': 5,
+    'gracefulTimeout': 10,
+    'maxStreams': 0,
+}
+
+
+def server_options(config, **overrides):
+    """ Options of the config's 'server' section (optional), then the non None overrides. """
+    options = dict(DEFAULTS)
+    options.update((k, v) for k, v in config.as_dict().get('server', {}).items() if k in DEFAULTS)
+    options.update((k, v) for k, v in overrides.items() if v is not None)
+    return options
+
+
+def stream_limit(options):
+    """ Streams a process may serve at once: maxStreams, by default (0) all its threads but 2. """
+    return int(options.get('maxStreams') or max(1, int(options['threads']) - 2))
+
+
+class StreamLimiter(object):
+    """ Caps the long-lived responses (SSE, MJPEG...) a process serves at once.
+
+    Each open stream holds one of the threads of its gthread worker until
+    the client goes away: with all of them streaming, the worker would
+    answer no page anymore. Past limit streams, open() refuses new ones so
+    that some threads are always left for the other requests.
+
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+
+        self._lock = Lock()
+
+    def open(self, chunks):
+        """ chunks counted as an open stream until closed, None (not counted) past the limit. """
+        with self._lock:
+            if self.count >= self.limit:
+                return None
+            self.count += 1
+        return _OpenStream(self, chunks)
+
+    def _release(self):
+        with self._lock:
+            self.count -= 1
+
+
+class _OpenStream(object):
+    # an object rather than a generator: the WSGI server closes it even if it was never iterated
+    def __init__(self, limiter, chunks):
+        self._limiter = limiter
+        self._chunks = chunks
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            self._limiter._release()
+
+
+if BaseApplication is not None:
+    class Application(BaseApplication):
+        """ gunicorn application serving an already loaded WSGI app. """
+        def __init__(self, app, options):
+            self.app = app
+            self.options = options
+            BaseApplication.__init__(self)
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.app
+
+
+def serve(app, host, port, control=None, worker_init=None, workers=2, threads=8, keepalive=5,
+          gracefulTimeout=10):
+    """ Serves app with gunicorn until it is shut down.
+
+    Requests are handled by workers processes with a pool of threads each
+    over keep-alive connections. Long-lived log, camera and robot streams
+    each hold a thread for as long as they last, which is why the app caps
+    them below threads per worker (see StreamLimiter). SIGTERM stops accepting connections and lets the requests
+    in flight finish for up to gracefulTimeout seconds.
+
+    The workers are forks of this process, so they share the app (and its
+    secret key) but not its threads: the state they must agree on lives in
+    the SharedState. The gunicorn arbiter runs in a child process, as it
+    reaps any child of its own, while this one runs control() once the
+    arbiter is forked: the threads it starts (supervisors, probes...) would
+    otherwise be forked in the middle of holding their locks. Likewise,
+    worker_init() runs in each worker once it is forked, to start the
+    threads of the worker itself (its probes...).
+
+    """
+    if BaseApplication is None:
+        raise ImportError('The production server needs gunicorn (pip install gunicorn).')
+
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': int(workers),
+        'worker_class': 'gthread',
+        'threads': int(threads),
+        'keepalive': int(keepalive),
+        'graceful_timeout': int(gracefulTimeout),
+        'preload_app': True,
+    }
+    if worker_init is not None:
+        options['post_fork'] = lambda server, worker: worker_init()
+
+    arbiter = os.fork()
+    if arbiter == 0:
+        code = 0
+        try:
+            Application(app, options).run()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def forward(signum, frame):
+        os.kill(arbiter, signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, forward)
+
+    if control is not None:
+        control()
+
+    while True:
+        try:
+            _, status = os.waitpid(arbiter, 0)
+            return status
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
@@ -0,0 +1,143 @@
+import os
+import copy
+import json
+import time
+import errno
+import sqlite3
+
+from threading import RLock, local
+from contextlib import contextmanager
+
+
+DEFAULT_PATH = '/tmp/puppet-master-state.db'
+
+
+def pid_alive(pid):
+    """ True if the process pid runs (an exited but not yet reaped one does not). """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, OSError, IndexError):
+        return True
+
+
+class SharedState(object):
+    """ Small key/value store of JSON values shared by the server processes.
+
+    It holds the control-plane state (update in progress, daemon state,
+    virtual bots and their ports) in a SQLite file, so every worker of the
+    production server sees the same truth. Each thread of each process
+    uses its own connection. update() is a read-modify-write done in an
+    immediate transaction: no other process can write the store meanwhile.
+
+    """
+    _states = {}
+    _states_lock = RLock()
+
+    def __init__(self, path=DEFAULT_PATH, timeout=10.0):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+
+        self._local = local()
+
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS state '
+                       '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    @classmethod
+    def for_path(cls, path=DEFAULT_PATH):
+        path = os.path.abspath(path)
+        with cls._states_lock:
+            if path not in cls._states:
+                cls._states[path] = cls(path)
+            return cls._states[path]
+
+    @classmethod
+    def from_config(cls, config):
+        """ Returns the store of a config's 'server' section (optional). """
+        return cls.for_path(config.as_dict().get('server', {}).get('stateFile', DEFAULT_PATH))
+
+    def _connection(self):
+        # connections can neither be shared between threads nor used across a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _get(self, db, key, default):
+        row = db.execute('SELECT value FROM state WHERE key = ?', (key, )).fetchone()
+        return json.loads(row[0]) if row is not None else copy.deepcopy(default)
+
+    def _put(self, db, key, value):
+        if value is None:
+            db.execute('DELETE FROM state WHERE key = ?', (key, ))
+        else:
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                       (key, json.dumps(value)))
+
+    def get(self, key, default=None):
+        return self._get(self._connection(), key, default)
+
+    def set(self, key, value):
+        """ Sets key to value (None deletes it). """
+        with self._transaction() as db:
+            self._put(db, key, value)
+
+    def delete(self, key):
+        self.set(key, None)
+
+    def update(self, key, func, default=None):
+        """ Atomically sets key to func(current value or default), returns the new value. """
+        with self._transaction() as db:
+            value = func(self._get(db, key, default))
+            self._put(db, key, value)
+        return value
+
+    def clear(self):
+        with self._transaction() as db:
+            db.execute('DELETE FROM state')
+
+    def claim(self, key, **info):
+        """ Takes key for this process unless a live process holds it, returns True if taken. """
+        taken = []
+
+        def take(holder):
+            if holder is not None and pid_alive(holder['pid']):
+                return holder
+            taken.append(True)
+            return dict(info, pid=os.getpid(), since=time.time())
+
+        self.update(key, take)
+        return bool(taken)
+
+    def holder(self, key):
+        """ What the live process holding key claimed it with, None if it is free. """
+        holder = self.get(key)
+        if holder is not None and pid_alive(holder['pid']):
+            return holder
+        return None
+
+    def release(self, key):
+        self.update(key, lambda holder: (None if holder is not None and
+                                         holder['pid'] == os.getpid() else
+                                         holder))
@@ -0,0 +1,207 @@
+import time
+import signal
+
+from collections import deque
+from threading import Thread, RLock, Event
+
+
+STARTING = 'starting'
+READY = 'ready'
+CRASHED = 'crashed'
+STOPPED = 'stopped'
+
+
+class RestartPolicy(object):
+    """ When and how fast a crashed process is restarted.
+
+    mode is 'always' (any unexpected exit), 'on-failure' (non-zero exit
+    code) or 'never'. The n-th consecutive restart waits
+    backoff * 2 ** n seconds (capped at maxBackoff); a process that stayed
+    up stableTime seconds resets that count. After maxRestarts consecutive
+    restarts, the process is left crashed.
+
+    """
+    def __init__(self, mode='on-failure', maxRestarts=5, backoff=1.0,
+                 maxBackoff=60.0, stableTime=60.0):
+        self.mode = mode
+        self.max_restarts = int(maxRestarts)
+        self.backoff = float(backoff)
+        self.max_backoff = float(maxBackoff)
+        self.stable_time = float(stableTime)
+
+    @classmethod
+    def from_config(cls, config):
+        """ Builds the policy of a config 'supervisor' section (optional). """
+        return cls(**config.as_dict().get('supervisor', {}))
+
+    def should_restart(self, returncode, consecutive):
+        if consecutive >= self.max_restarts:
+            return False
+        if self.mode == 'always':
+            return True
+        if self.mode == 'on-failure':
+            return returncode != 0
+        return False
+
+    def delay(self, consecutive):
+        return min(self.backoff * 2 ** consecutive, self.max_backoff)
+
+
+class Supervisor(object):
+    """ Owns a child process and keeps an in-memory state machine of it.
+
+    spawn() must return a started Popen. The process is STARTING until
+    ready_check() returns True, then READY. Its exit is seen as soon as it
+    happens (the supervising thread blocks in Popen.wait, i.e. waitpid):
+    it is then STOPPED if stop() was asked, CRASHED otherwise, and
+    restarted according to the RestartPolicy. A restart whose spawn()
+    fails (OSError: binary gone, EMFILE...) counts as a crash, without
+    exit code and with last_error set, and is retried the same way.
+
+    on_transition(supervisor, state) is called on every state change.
+    stop_check() tells whether another process asked for the stop: when
+    it returns True, an exit is STOPPED and no restart is attempted.
+
+    """
+    def __init__(self, spawn, policy=None, ready_check=None, on_transition=None,
+                 stop_check=None, ready_poll=0.5, history=50):
+        self.spawn = spawn
+        self.policy = policy if policy is not None else RestartPolicy(mode='never')
+        self.ready_check = ready_check if ready_check is not None else lambda: True
+        self.on_transition = on_transition
+        self.stop_check = stop_check if stop_check is not None else lambda: False
+        self.ready_poll = ready_poll
+
+        self.state = STOPPED
+        self.process = None
+        self.spawned = False
+        self.restarts = 0
+        self.crashes = 0
+        self.consecutive_restarts = 0
+        self.last_exit_code = None
+        self.last_error = None
+        self.started_at = None
+        self.transitions = deque(maxlen=history)
+
+        self._lock = RLock()
+        self._stop_event = Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self.state in (STARTING, READY)
+
+    def _set_state(self, state):
+        self.state = state
+        self.transitions.append((time.time(), state))
+        if self.on_transition is not None:
+            self.on_transition(self, state)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                raise SystemError('Process already supervised.')
+
+            self._stop_event.clear()
+            self.consecutive_restarts = 0
+            self._thread = Thread(target=self._supervise)
+            self._thread.daemon = True
+
+            self._spawn()
+            self._thread.start()
+
+    def _spawn(self):
+        self.process = self.spawn()
+        self.last_error = None
+        self.spawned = True
+        self.started_at = time.time()
+        self._set_state(STARTING)
+
+    def _stop_asked(self):
+        return self._stop_event.is_set() or self.stop_check()
+
+    def _supervise(self):
+        spawned = True
+        while True:
+            if spawned:
+                p = self.process
+
+                while self.state == STARTING and p.poll() is None:
+                    if self.ready_check():
+                        self._set_state(READY)
+                        break
+                    self._stop_event.wait(self.ready_poll)
+
+                returncode = p.wait()
+            else:
+                returncode = None
+
+            with self._lock:
+                self.last_exit_code = returncode
+                if self._stop_asked():
+                    self._set_state(STOPPED)
+                    return
+
+                self.crashes += 1
+                self._set_state(CRASHED)
+
+                if spawned and time.time() - self.started_at >= self.policy.stable_time:
+                    self.consecutive_restarts = 0
+                if not self.policy.should_restart(returncode, self.consecutive_restarts):
+                    return
+                delay = self.policy.delay(self.consecutive_restarts)
+
+            if self._stop_event.wait(delay):
+                with self._lock:
+                    self._set_state(STOPPED)
+                return
+
+            with self._lock:
+                if self._stop_asked():
+                    self._set_state(STOPPED)
+                    return
+                self.consecutive_restarts += 1
+                self.restarts += 1
+                try:
+                    self._spawn()
+                    spawned = True
+                except OSError as e:
+                    # counted as a crash of the restart
+                    self.last_error = 'Could not start the process: {}'.format(e)
+                    spawned = False
+
+    def stop(self, timeout=5.0):
+        """ Terminates the process (killed after timeout) and stops supervising. """
+        with self._lock:
+            self._stop_event.set()
+            p = self.process
+
+            if p is not None and p.poll() is None:
+                p.send_signal(signal.SIGTERM)
+
+        if p is not None:
+            deadline = time.time() + timeout
+            while p.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if p.poll() is None:
+                p.kill()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        with self._lock:
+            if self.state != STOPPED:
+                self._set_state(STOPPED)
+
+    def info(self):
+        return {
+            'state': self.state,
+            'pid': self.process.pid if self.process is not None and self.running else None,
+            'restarts': self.restarts,
+            'crashes': self.crashes,
+            'last_exit_code': self.last_exit_code,
+            'last_error': self.last_error,
+            'started_at': self.started_at,
+            'uptime': time.time() - self.started_at if self.running else None,
+            'transitions': list(self.transitions),
+        }
@@ -0,0 +1,118 @@
+import sys
+import time
+import threading
+
+import pytest
+
+from jobs import (JobRunner, JobFailed, current_job, tracked_call,
+                  QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED)
+from shared_state import SharedState
+
+
+@pytest.fixture
+def runner(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    return JobRunner(state, log_dir=str(tmp_path / 'jobs'), poll=0.01)
+
+
+def wait_state(runner, id, states, timeout=10.0):
+    deadline = time.time() + timeout
+    while runner.get(id)['state'] not in states:
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+    return runner.get(id)
+
+
+def test_result(runner):
+    job = runner.submit('add', lambda a, b: a + b, (1, 2))
+    job = wait_state(runner, job['id'], (SUCCEEDED, ))
+    assert job['result'] == 3 and job['exit_code'] == 0
+
+
+def test_identical_active_job_is_deduplicated(runner):
+    release = threading.Event()
+
+    job = runner.submit('update', release.wait, (10, ))
+    again = runner.submit('update', release.wait, (10, ))
+    other = runner.submit('update', release.wait, (20, ))
+
+    assert again['id'] == job['id'] and again['deduplicated']
+    assert other['id'] != job['id']
+
+    release.set()
+    wait_state(runner, job['id'], (SUCCEEDED, ))
+    assert runner.submit('update', release.wait, (10, ))['id'] != job['id']
+
+
+def test_concurrency_class_queues(runner):
+    release = threading.Event()
+
+    first = runner.submit('a', release.wait, (10, ), concurrency='robot')
+    second = runner.submit('b', release.wait, (10, ), concurrency='robot')
+    wait_state(runner, first['id'], (RUNNING, ))
+    time.sleep(0.1)
+    assert runner.get(second['id'])['state'] == QUEUED
+
+    release.set()
+    wait_state(runner, second['id'], (SUCCEEDED, ))
+
+
+def test_cancel_queued(runner):
+    release = threading.Event()
+    called = []
+
+    first = runner.submit('a', release.wait, (10, ))
+    second = runner.submit('b', called.append, (1, ))
+    assert runner.cancel(second['id'])
+    release.set()
+
+    assert wait_state(runner, second['id'], (CANCELLED, SUCCEEDED))['state'] == CANCELLED
+    wait_state(runner, first['id'], (SUCCEEDED, ))
+    assert called == []
+    assert not runner.cancel(second['id'])
+
+
+def test_cancel_kills_subprocess(runner):
+    def work():
+        return tracked_call([sys.executable, '-c', 'import time; time.sleep(30)'])
+
+    job = runner.submit('sleep', work)
+    deadline = time.time() + 10
+    while not runner.get(job['id'])['children']:
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+    started = time.time()
+    assert runner.cancel(job['id'])
+    assert wait_state(runner, job['id'], (CANCELLED, FAILED, SUCCEEDED))['state'] == CANCELLED
+    assert time.time() - started < 5
+
+
+def test_failures(runner):
+    def fail():
+        raise JobFailed('2 robots failed', {'a': 'ok', 'b': 'error'})
+
+    job = wait_state(runner, runner.submit('fail', fail)['id'], (FAILED, ))
+    assert job['error'] == '2 robots failed'
+    assert job['result'] == {'a': 'ok', 'b': 'error'}
+
+    job = wait_state(runner, runner.submit('boom', lambda: 1 / 0)['id'], (FAILED, ))
+    assert 'ZeroDivisionError' in job['error']
+
+
+def test_job_log(runner):
+    def work():
+        current_job().write('hello\n')
+        return tracked_call([sys.executable, '-c', 'print("from child")'])
+
+    job = wait_state(runner, runner.submit('log', work)['id'], (SUCCEEDED, ))
+    with open(job['log']) as f:
+        assert f.read() == 'hello\nfrom child\n'
+
+
+def test_history_is_bounded(runner):
+    runner.history = 2
+    for n in range(4):
+        wait_state(runner, runner.submit('n', lambda n: n, (n, ))['id'], (SUCCEEDED, ))
+
+    assert [job['result'] for job in runner.jobs()] == [3, 2]
@@ -0,0 +1,77 @@
+import os
+
+from logtail import read_tail, parse_cursor
+
+
+def append(path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def test_follows_appends(tmp_path):
+    log = str(tmp_path / 'poppy.log')
+    append(log, 'one\n')
+
+    tail = read_tail(log)
+    assert tail['data'] == 'one\n' and tail['exists']
+
+    append(log, 'two\n')
+    tail = read_tail(log, tail['cursor'])
+    assert tail['data'] == 'two\n'
+    assert tail['offset'] == 4 and not tail['reset']
+
+    assert read_tail(log, tail['cursor'])['data'] == ''
+
+
+def test_truncation_resets(tmp_path):
+    log = str(tmp_path / 'poppy.log')
+    append(log, 'a long first line\n')
+    cursor = read_tail(log)['cursor']
+
+    open(log, 'w').close()
+    append(log, 'new\n')
+
+    tail = read_tail(log, cursor)
+    assert tail['reset']
+    assert tail['data'] == 'new\n' and tail['offset'] == 0
+
+
+def test_rotation_resets(tmp_path):
+    log = str(tmp_path / 'poppy.log')
+    append(log, 'before\n')
+    cursor = read_tail(log)['cursor']
+
+    os.rename(log, log + '.1')
+    append(log, 'after rotation, longer than before\n')
+
+    tail = read_tail(log, cursor)
+    assert tail['reset']
+    assert tail['data'] == 'after rotation, longer than before\n'
+    assert parse_cursor(tail['cursor'])[0] == os.stat(log).st_ino
+
+
+def test_far_behind_gets_whole_lines(tmp_path):
+    log = str(tmp_path / 'poppy.log')
+    append(log, ''.join('line {}\n'.format(i) for i in range(100)))
+
+    tail = read_tail(log, max_bytes=20)
+    assert tail['reset']
+    assert tail['data'] == 'line 98\nline 99\n'
+
+
+def test_does_not_split_utf8(tmp_path):
+    log = str(tmp_path / 'poppy.log')
+    with open(log, 'wb') as f:
+        f.write(u'café'.encode('utf-8')[:-1])
+
+    tail = read_tail(log)
+    assert tail['data'] == 'caf'
+
+    with open(log, 'ab') as f:
+        f.write(u'é'.encode('utf-8')[-1:])
+    assert read_tail(log, tail['cursor'])['data'] == u'é'
+
+
+def test_missing_file(tmp_path):
+    tail = read_tail(str(tmp_path / 'missing.log'), '1:10')
+    assert not tail['exists'] and tail['reset'] and tail['cursor'] == ''
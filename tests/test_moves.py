@@ -0,0 +1,105 @@
+import math
+
+import pytest
+
+from moves import MoveLibrary, from_pypot, to_pypot
+
+
+def recorded(frames=600, speeds=True):
+    positions = {}
+    for i in range(frames):
+        t = i / 50.0
+        positions[repr(t)] = {
+            'm1': [30 * math.sin(t), 1.5] if speeds else 30 * math.sin(t),
+            'm2': [-10.0 + i * 0.01, 0.0] if speeds else -10.0 + i * 0.01,
+        }
+    return {'framerate': 50.0, 'positions': positions}
+
+
+@pytest.fixture
+def library(tmp_path):
+    return MoveLibrary(str(tmp_path / 'moves'))
+
+
+def test_float32_round_trip(library):
+    move = from_pypot(recorded())
+    info = library.save('wave', move, block_size=100)
+
+    assert info['encoding'] == 'float32'
+    assert info['frames'] == 600 and info['motors'] == ['m1', 'm2']
+    assert library.info('wave')['size'] == info['size']
+
+    read = library.read('wave')
+    assert read['timestamps'] == move['timestamps']
+    for m in ('m1', 'm2'):
+        assert read['positions'][m] == pytest.approx(move['positions'][m], abs=1e-4)
+        assert read['speeds'][m] == pytest.approx(move['speeds'][m], abs=1e-4)
+
+
+def test_delta_round_trip(library):
+    move = from_pypot(recorded(speeds=False))
+    info = library.save('wave', move, encoding='delta', resolution=0.01)
+
+    assert info['encoding'] == 'delta'
+    read = library.read('wave')
+    assert read['speeds'] is None
+    for m in ('m1', 'm2'):
+        assert read['positions'][m] == pytest.approx(move['positions'][m], abs=0.01)
+
+
+def test_delta_falls_back_to_float32(library):
+    move = from_pypot({'positions': {'0.0': {'m1': 0.0}, '0.02': {'m1': 1000.0}}})
+    assert library.save('jump', move, encoding='delta', resolution=0.01)['encoding'] == 'float32'
+    assert library.read('jump')['positions']['m1'] == [0.0, 1000.0]
+
+
+def test_chunks(library):
+    library.save('wave', from_pypot(recorded()), block_size=250)
+    chunks = list(library.chunks('wave'))
+    assert [c['start'] for c in chunks] == [0, 250, 500]
+    assert [len(c['timestamps']) for c in chunks] == [250, 250, 100]
+
+
+def test_pypot_export(library):
+    data = recorded(frames=3)
+    library.import_pypot('small', data)
+
+    exported = library.export_pypot('small')
+    assert from_pypot(exported)['timestamps'] == from_pypot(data)['timestamps']
+    assert to_pypot(from_pypot(exported)) == exported
+
+
+def test_frames_are_sorted_and_gaps_held():
+    move = from_pypot({'positions': {'0.04': {'m1': 3.0},
+                                     '0.0': {'m1': 1.0, 'm2': 5.0},
+                                     '0.02': {'m1': 2.0}}})
+    assert move['timestamps'] == [0.0, 0.02, 0.04]
+    assert move['positions'] == {'m1': [1.0, 2.0, 3.0], 'm2': [5.0, 5.0, 5.0]}
+    assert move['speeds'] is None
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'positions': []},
+    {'positions': {'0.0': 1.0}},
+    {'positions': {'zero': {'m1': 1.0}}},
+    {'positions': {'0.0': {'m1': []}}},
+    {'positions': {'0.0': {'m1': 'up'}}},
+])
+def test_invalid_pypot_moves(data):
+    with pytest.raises(ValueError):
+        from_pypot(data)
+
+
+def test_delete(library):
+    library.save('wave', from_pypot(recorded(frames=10)))
+    library.delete('wave')
+    assert library.list() == []
+    with pytest.raises(IOError):
+        library.read('wave')
+
+
+def test_invalid_names(library):
+    for name in ('../escape', '.hidden', ''):
+        with pytest.raises(ValueError):
+            library.save(name, from_pypot(recorded(frames=2)))
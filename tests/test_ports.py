@@ -0,0 +1,105 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from ports import PortAllocator
+from shared_state import SharedState
+
+
+BASE_PORTS = (28000, 28100, 28200)
+
+
+@pytest.fixture
+def state(tmp_path):
+    return SharedState(str(tmp_path / 'state.db'))
+
+
+def test_allocations_do_not_overlap():
+    allocator = PortAllocator()
+
+    first = allocator.allocate(BASE_PORTS, 2)
+    second = allocator.allocate(BASE_PORTS)
+
+    offsets = [offset for offset, _ in first + second]
+    assert len(set(offsets)) == 3
+    for offset, ports in first + second:
+        assert ports == tuple(p + offset for p in BASE_PORTS)
+
+
+def test_release_frees_the_offset():
+    allocator = PortAllocator()
+    [(offset, _)] = allocator.allocate(BASE_PORTS)
+
+    allocator.release(offset)
+    assert offset not in allocator.allocated
+    assert allocator.allocate(BASE_PORTS)[0][0] == offset
+
+
+def test_busy_port_is_skipped():
+    allocator = PortAllocator()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('', BASE_PORTS[1] + 1))
+    s.listen(1)
+    try:
+        [(offset, _)] = allocator.allocate(BASE_PORTS)
+    finally:
+        s.close()
+    assert offset != 1
+
+
+def test_not_enough_ports():
+    allocator = PortAllocator(max_offset=2)
+    with pytest.raises(SystemError):
+        allocator.allocate(BASE_PORTS, 3)
+    assert allocator.allocated == {}
+
+
+def test_registry_is_shared(state):
+    first = PortAllocator(state=state)
+    second = PortAllocator(state=SharedState(state.path))
+
+    [(offset, ports)] = first.allocate(BASE_PORTS)
+    assert second.allocated == {offset: ports}
+    assert second.allocate(BASE_PORTS)[0][0] != offset
+
+
+def test_claim(state):
+    assert state.claim('update', kind='system')
+    assert state.holder('update')['kind'] == 'system'
+    assert state.holder('update')['pid'] == os.getpid()
+
+    state.release('update')
+    assert state.holder('update') is None
+
+
+def test_claim_held_by_live_process(state):
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        state.set('update', {'pid': child.pid, 'since': 0})
+        assert not state.claim('update')
+
+        # a release by another process leaves the claim alone
+        state.release('update')
+        assert state.holder('update')['pid'] == child.pid
+    finally:
+        child.kill()
+        child.wait()
+
+    assert state.claim('update')
+    assert state.holder('update')['pid'] == os.getpid()
+
+
+def test_update_is_atomic_across_processes(state):
+    code = ('import sys; sys.path.insert(0, {!r}); '
+            'from shared_state import SharedState; '
+            's = SharedState({!r}); '
+            '[s.update("n", lambda n: n + 1, 0) for _ in range(50)]'
+            .format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), state.path))
+    children = [subprocess.Popen([sys.executable, '-c', code]) for _ in range(4)]
+    for child in children:
+        assert child.wait() == 0
+
+    assert state.get('n') == 200
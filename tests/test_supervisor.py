@@ -0,0 +1,105 @@
+import sys
+import time
+import subprocess
+
+from supervisor import Supervisor, RestartPolicy, READY, CRASHED, STOPPED
+
+
+def command(code):
+    return [sys.executable, '-c', code]
+
+
+def wait_for(check, timeout=10.0):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.02)
+
+
+def test_backoff_delays():
+    policy = RestartPolicy(backoff=0.5, maxBackoff=3.0)
+    assert [policy.delay(n) for n in range(5)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+
+
+def test_restart_modes():
+    assert RestartPolicy(mode='on-failure').should_restart(1, 0)
+    assert not RestartPolicy(mode='on-failure').should_restart(0, 0)
+    assert RestartPolicy(mode='always').should_restart(0, 0)
+    assert not RestartPolicy(mode='never').should_restart(1, 0)
+    assert not RestartPolicy(mode='always', maxRestarts=2).should_restart(1, 2)
+
+
+def test_crashed_process_is_restarted_until_max_restarts():
+    policy = RestartPolicy(mode='on-failure', maxRestarts=2, backoff=0.01)
+    s = Supervisor(lambda: subprocess.Popen(command('import sys; sys.exit(3)')), policy)
+    s.start()
+
+    wait_for(lambda: s.crashes == 3)
+    wait_for(lambda: not s._thread.is_alive())
+
+    assert s.state == CRASHED
+    assert s.restarts == 2
+    assert s.last_exit_code == 3
+
+
+def test_stable_process_resets_consecutive_restarts():
+    policy = RestartPolicy(mode='always', maxRestarts=1, backoff=0.01, stableTime=0.0)
+    s = Supervisor(lambda: subprocess.Popen(command('pass')), policy)
+    s.start()
+
+    wait_for(lambda: s.restarts >= 3)
+    s.stop()
+    assert s.state == STOPPED
+
+
+def test_stop_is_not_a_crash():
+    s = Supervisor(lambda: subprocess.Popen(command('import time; time.sleep(30)')),
+                   RestartPolicy(mode='always', backoff=0.01))
+    s.start()
+    wait_for(lambda: s.state == READY)
+
+    s.stop()
+    assert s.state == STOPPED
+    assert s.crashes == 0 and s.restarts == 0
+
+
+def test_failed_respawn_is_retried():
+    attempts = []
+
+    def spawn():
+        attempts.append(time.time())
+        if len(attempts) == 2:
+            raise OSError(24, 'Too many open files')
+        return subprocess.Popen(command('import time, sys; time.sleep(0.1); sys.exit(1)'
+                                        if len(attempts) == 1 else
+                                        'import time; time.sleep(30)'))
+
+    s = Supervisor(spawn, RestartPolicy(mode='on-failure', backoff=0.01))
+    s.start()
+
+    wait_for(lambda: len(attempts) == 2)
+    wait_for(lambda: s.state == READY)
+    try:
+        assert len(attempts) == 3
+        assert s.crashes == 2
+        assert s.last_error is None
+    finally:
+        s.stop()
+
+
+def test_failed_respawn_is_reported():
+    attempts = []
+
+    def spawn():
+        attempts.append(True)
+        if len(attempts) > 1:
+            raise OSError(2, 'No such file or directory')
+        return subprocess.Popen(command('import sys; sys.exit(1)'))
+
+    s = Supervisor(spawn, RestartPolicy(mode='on-failure', maxRestarts=2, backoff=0.01))
+    s.start()
+    wait_for(lambda: not s._thread.is_alive())
+
+    assert s.state == CRASHED
+    assert s.last_exit_code is None
+    assert 'Could not start the process' in s.info()['last_error']
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import base64
+import socket
+import struct
+import hashlib
+
+from threading import Thread, Lock, Event
+
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class WebSocketClient(object):
+    """ Minimal blocking WebSocket (RFC 6455) client, enough to read the pypot ws server. """
+    def __init__(self, host, port, path='/', timeout=5.0, read_timeout=30.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.settimeout(timeout)
+        self._buffer = b''
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall('GET {} HTTP/1.1\r\n'
+                          'Host: {}:{}\r\n'
+                          'Upgrade: websocket\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Sec-WebSocket-Key: {}\r\n'
+                          'Sec-WebSocket-Version: 13\r\n\r\n'.format(path, host, port, key).encode())
+
+        while b'\r\n\r\n' not in self._buffer:
+            self._fill()
+        head, self._buffer = self._buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict((k.strip().lower(), v.strip())
+                       for k, _, v in (line.partition(':') for line in lines[1:]))
+
+        accept = base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+        if lines[0].split()[1:2] != ['101'] or headers.get('sec-websocket-accept') != accept:
+            self.sock.close()
+            raise IOError('WebSocket handshake refused: {}'.format(lines[0]))
+        self.sock.settimeout(read_timeout)
+
+    def _fill(self):
+        data = self.sock.recv(64 * 1024)
+        if not data:
+            raise IOError('WebSocket connection closed')
+        self._buffer += data
+
+    def _read(self, n):
+        while len(self._buffer) < n:
+            self._fill()
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def _send(self, opcode, payload=b''):
+        # client frames are masked
+        mask = os.urandom(4)
+        header = struct.pack('!B', 0x80 | opcode)
+        if len(payload) < 126:
+            header += struct.pack('!B', 0x80 | len(payload))
+        elif len(payload) < 1 << 16:
+            header += struct.pack('!BH', 0x80 | 126, len(payload))
+        else:
+            header += struct.pack('!BQ', 0x80 | 127, len(payload))
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(bytearray(payload)))
+        self.sock.sendall(header + mask + masked)
+
+    def _frame(self):
+        b1, b2 = struct.unpack('!BB', self._read(2))
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        mask = self._read(4) if b2 & 0x80 else None
+        payload = self._read(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(bytearray(payload)))
+        return bool(b1 & 0x80), b1 & 0x0F, payload
+
+    def recv(self):
+        """ Next text (str) or binary (bytes) message, answering pings on the way. """
+        message, opcode = b'', None
+        while True:
+            fin, op, payload = self._frame()
+            if op == OP_PING:
+                self._send(OP_PONG, payload)
+                continue
+            if op == OP_PONG:
+                continue
+            if op == OP_CLOSE:
+                try:
+                    self._send(OP_CLOSE, payload[:2])
+                except socket.error:
+                    pass
+                raise IOError('WebSocket closed by the server')
+
+            if op != OP_CONTINUATION:
+                opcode = op
+            message += payload
+            if fin:
+                return message.decode('utf-8') if opcode == OP_TEXT else message
+
+    def close(self):
+        try:
+            self._send(OP_CLOSE, struct.pack('!H', 1000))
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class Subscription(object):
+    """ What a client of a relay receives: a filtered view of the last message, at most max_rate per second.
+
+    Only the last message is kept, never a queue: a client slower than
+    the robot (or than its max_rate) skips the messages it had no time
+    to send, and skipped counts them.
+
+    """
+    def __init__(self, motors=None, registers=None, max_rate=None):
+        self.motors = set(motors) if motors else None
+        self.registers = set(registers) if registers else None
+        self.max_rate = max_rate
+
+        self.skipped = 0
+
+        self._lock = Lock()
+        self._event = Event()
+        self._message = None
+        self._sent = 0
+
+    def publish(self, message):
+        with self._lock:
+            if self._message is not None:
+                self.skipped += 1
+            self._message = message
+        self._event.set()
+
+    def filter(self, message):
+        if not isinstance(message, dict) or (self.motors is None and self.registers is None):
+            return message
+        return dict((motor, registers if not isinstance(registers, dict) or self.registers is None else
+                     dict((k, v) for k, v in registers.items() if k in self.registers))
+                    for motor, registers in message.items()
+                    if self.motors is None or motor in self.motors)
+
+    def get(self, timeout):
+        """ The next message to send (filtered), None if there was none for timeout seconds. """
+        if self.max_rate:
+            wait = self._sent + 1.0 / self.max_rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+        if not self._event.wait(timeout):
+            return None
+
+        with self._lock:
+            message, self._message = self._message, None
+            self._event.clear()
+        self._sent = time.time()
+        return self.filter(message)
+
+
+class WsRelay(Thread):
+    """ Single upstream WebSocket connection to a robot, fanned out to subscriptions.
+
+    The pypot ws server pushes the state of all the motors ({motor:
+    {register: value}}, as JSON) on each connection it has. A relay holds
+    one connection per robot (the real one or a virtual bot) and server
+    process, reconnecting if it drops, and hands each message to its
+    subscriptions.
+
+    Relays are shared per host and port (see subscribe_to) and close with
+    their last subscription.
+
+    """
+    _relays = {}
+    _relays_lock = Lock()
+
+    def __init__(self, host, port, retry=1.0):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.host = host
+        self.port = port
+        self.retry = retry
+
+        self.connected = False
+        self.messages = 0
+
+        self._subscriptions = []
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._client = None
+
+    @classmethod
+    def subscribe_to(cls, host, port, **options):
+        """ Returns the (relay, subscription) of a new client of the ws server at host:port. """
+        with cls._relays_lock:
+            relay = cls._relays.get((host, port))
+            if relay is None or not relay.is_alive():
+                relay = cls(host, port)
+                relay.start()
+                cls._relays[(host, port)] = relay
+            return relay, relay.subscribe(**options)
+
+    def subscribe(self, **options):
+        subscription = Subscription(**options)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with WsRelay._relays_lock:
+            with self._lock:
+                if subscription in self._subscriptions:
+                    self._subscriptions.remove(subscription)
+                if self._subscriptions:
+                    return
+            self._stop_event.set()
+            if WsRelay._relays.get((self.host, self.port)) is self:
+                del WsRelay._relays[(self.host, self.port)]
+
+        client = self._client
+        if client is not None:
+            client.close()
+
+    def _publish(self, message):
+        self.messages += 1
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.publish(message)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._client = WebSocketClient(self.host, self.port)
+                self.connected = True
+                while not self._stop_event.is_set():
+                    message = self._client.recv()
+                    try:
+                        message = json.loads(message)
+                    except (TypeError, ValueError):
+                        continue
+                    self._publish(message)
+            except (IOError, OSError, socket.error):
+                pass
+            finally:
+                self.connected = False
+                if self._client is not None:
+                    self._client.close()
+                    self._client = None
+
+            self._stop_event.wait(self.retry)
+
+
+def sse_stream(relay, subscription, keepalive=15.0):
+    """ Generator of Server-Sent Events of the messages of subscription. """
+    try:
+        while True:
+            message = subscription.get(keepalive)
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            yield 'data: {}\n\n'.format(json.dumps(message))
+    finally:
+        relay.unsubscribe(subscription)